@@ -1,9 +1,10 @@
 from aiohttp import web
 import json
-from logging import INFO
-from azure.eventgrid import EventGridEvent, SystemEventNames
+import logging
+import secrets
+import time
 from azure.core.messaging import CloudEvent
-from typing import List, Optional, Union, TYPE_CHECKING
+from typing import Any, List, Optional, Union, TYPE_CHECKING
 from azure.communication.callautomation import (
     PhoneNumberIdentifier)
 from azure.communication.callautomation.aio import CallAutomationClient
@@ -14,27 +15,73 @@ from azure.communication.callautomation import (
     MediaStreamingContentType,
     MediaStreamingAudioChannelType,
     )
-from azure.communication.phonenumbers import PhoneNumbersClient,PhoneNumberCapabilityType, PhoneNumberAssignmentType, PhoneNumberType, PhoneNumberCapabilities
-import json
-import requests
+
+from acs.callstore import CallStore, InMemoryCallStore
+from acs.events import CallEventDispatcher
+
+logger = logging.getLogger("acs.caller")
 
 class OutboundCall:
     target_number: str
     source_number: str
     acs_connection_string: str
     acs_callback_path: str
+    # Calls are looked up here rather than on the instance, callbacks may reach a different worker or replica
+    call_store: CallStore
+    call_automation_client: Optional[CallAutomationClient] = None
+    # Callback events are routed through here, register extra handlers to react to call state changes
+    events: CallEventDispatcher
+    # The media socket URL carries a token only this call knows, stored under this prefix until the call ends
+    media_token_prefix: str = "media:"
 
-    def __init__(self, acs_connection_string: str, acs_source_number: str, acs_callback_path: str):
+    def __init__(self, acs_connection_string: str, acs_source_number: str, acs_callback_path: str, call_store: Optional[CallStore] = None):
         self.acs_connection_string = acs_connection_string
         self.source_number = acs_source_number
         self.acs_callback_path = acs_callback_path
+        self.call_store = call_store if call_store is not None else InMemoryCallStore()
+        self.events = CallEventDispatcher()
+        self.events.register("Microsoft.Communication.CallConnected", self._on_call_connected)
+        self.events.register("Microsoft.Communication.CallDisconnected", self._on_call_disconnected)
+        self.events.register("Microsoft.Communication.CreateCallFailed", self._on_call_disconnected)
+        for event_type, state in [("Microsoft.Communication.MediaStreamingStarted", "streaming"),
+                                  ("Microsoft.Communication.MediaStreamingStopped", "streaming_stopped"),
+                                  ("Microsoft.Communication.MediaStreamingFailed", "streaming_failed")]:
+            self.events.register(event_type, lambda event, state=state: self._update_call_state(event, state))
+
+    def _get_client(self) -> CallAutomationClient:
+        if self.call_automation_client is None:
+            self.call_automation_client = CallAutomationClient.from_connection_string(self.acs_connection_string)
+        return self.call_automation_client
 
-    async def call(self, target_number: str):
-        self.call_automation_client = CallAutomationClient.from_connection_string(self.acs_connection_string)
-        self.target_participant = PhoneNumberIdentifier(target_number)
-        self.source_caller = PhoneNumberIdentifier(self.source_number)
+    # ACS streaming formats the middle tier can bridge to the realtime API, keyed by sample rate
+    _audio_formats = {
+        16000: AudioFormat.PCM16_K_MONO,
+        24000: AudioFormat.PCM24_K_MONO,
+    }
 
-        websocket_url = 'wss://' + self.acs_callback_path + '/realtime'
+    @classmethod
+    def parse_sample_rate(cls, value: Any) -> int:
+        # sample_rate comes from request bodies, anything ACS can't stream is a client error
+        try:
+            sample_rate = int(value)
+        except (TypeError, ValueError):
+            sample_rate = None
+        if sample_rate not in cls._audio_formats:
+            raise ValueError(f"sample_rate must be one of {', '.join(str(rate) for rate in cls._audio_formats)}")
+        return sample_rate
+
+    async def place_call(self, target_number: str, sample_rate: int = 24000) -> str:
+        sample_rate = self.parse_sample_rate(sample_rate)
+        # Nothing call specific is kept on the instance, concurrent calls only share the client
+        target_participant = PhoneNumberIdentifier(target_number)
+        source_caller = PhoneNumberIdentifier(self.source_number)
+
+        # Stored before the call exists, ACS may open the media socket before create_call returns
+        media_token = secrets.token_urlsafe(32)
+        await self.call_store.set(self.media_token_prefix + media_token, { 'sample_rate': sample_rate })
+
+        # The middle tier resamples to and from the realtime API's 24 kHz, lower rates save bandwidth per call
+        websocket_url = 'wss://' + self.acs_callback_path + '/realtime?transport=acs&token=' + media_token
 
         media_streaming_options = MediaStreamingOptions(
                         transport_url=websocket_url,
@@ -43,44 +90,84 @@ class OutboundCall:
                         audio_channel_type=MediaStreamingAudioChannelType.MIXED,
                         start_media_streaming=True,
                         enable_bidirectional=True,
-                        audio_format=AudioFormat.PCM24_K_MONO)
+                        audio_format=self._audio_formats[sample_rate])
+
+        try:
+            call_connection_properties = await self._get_client().create_call(target_participant,
+                                                                        'https://' + self.acs_callback_path + '/acs',
+                                                                        source_caller_id_number=source_caller,
+                                                                        media_streaming = media_streaming_options)
+        except BaseException:
+            await self.call_store.delete(self.media_token_prefix + media_token)
+            raise
+
+        await self.call_store.set(call_connection_properties.call_connection_id, {
+            'target_number': target_number,
+            'source_number': self.source_number,
+            'sample_rate': sample_rate,
+            'media_token': media_token,
+            'state': 'created',
+            'created_at': time.time()
+        })
+        return call_connection_properties.call_connection_id
+
+    async def call(self, target_number: str, sample_rate: int = 24000):
+        call_connection_id = await self.place_call(target_number, sample_rate)
 
-        call_connection_properties = await self.call_automation_client.create_call(self.target_participant, 
-                                                                    'https://' + self.acs_callback_path + '/acs',
-                                                                    source_caller_id_number=self.source_caller,
-                                                                    media_streaming = media_streaming_options)
-        
         call_connection = {
             'call_established': True,
-            'connection_id': call_connection_properties.call_connection_id
+            'connection_id': call_connection_id
         }
 
         return web.json_response(call_connection)
 
+    async def _update_call_state(self, event: CloudEvent, state: str):
+        call_connection_id = event.data['callConnectionId']
+        call = await self.call_store.get(call_connection_id)
+        if call is not None:
+            call['state'] = state
+            await self.call_store.set(call_connection_id, call)
+
+    async def _on_call_connected(self, event: CloudEvent):
+        call_connection_id = event.data['callConnectionId']
+        logger.info("Call connected %s", call_connection_id)
+        await self._update_call_state(event, 'connected')
+        call_connection_client = self._get_client().get_call_connection(call_connection_id)
+        call_connection_properties = await call_connection_client.get_call_properties()
+        logger.info("Media streaming of call %s: %s", call_connection_id, call_connection_properties.media_streaming_subscription)
+
+    async def lookup_media_token(self, media_token: str) -> Optional[dict[str, Any]]:
+        # For RTMiddleTier.acs_media_lookup, media sockets are only accepted for calls placed here
+        return await self.call_store.get(self.media_token_prefix + media_token)
+
+    async def _on_call_disconnected(self, event: CloudEvent):
+        logger.info("Call ended %s %s", event.type, event.data['callConnectionId'])
+        call = await self.call_store.get(event.data['callConnectionId'])
+        if call is not None and call.get('media_token'):
+            await self.call_store.delete(self.media_token_prefix + call['media_token'])
+        await self.call_store.delete(event.data['callConnectionId'])
+
     async def _outbound_call_handler(self, request):
-        print("Outbound call handler")
-        cloudevent = await request.json()
-        for event_dict in cloudevent:
-            # Parsing callback events
-            event = CloudEvent.from_dict(event_dict)
-            call_connection_id = event.data['callConnectionId']
-            print("%s event received for call connection id: %s", event.type, call_connection_id)
-            call_connection_client = self.call_automation_client.get_call_connection(call_connection_id)
-            # target_participant = PhoneNumberIdentifier(self.target_number)
-            if event.type == "Microsoft.Communication.CallConnected":
-                print("Call connected")
-                print(call_connection_id)
-                call_connection_properties = call_connection_client.get_call_properties()
-                print(call_connection_properties)
-                media_streaming_subscription = call_connection_properties.media_streaming_subscription
-                print(media_streaming_subscription)
-                return web.Response(status=200)
-        
-        return web.Response(status=500)
+        try:
+            events = [CloudEvent.from_dict(event_dict) for event_dict in await request.json()]
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning("Invalid callback payload: %s", e)
+            return web.Response(status=400)
+        # Acknowledge right away, the handlers run in the background
+        self.events.dispatch(events)
+        return web.Response(status=200)
 
     async def _get_source_number(self):
        return self.source_number
 
 
+    async def _on_cleanup(self, app: web.Application):
+        await self.events.close()
+        if self.call_automation_client is not None:
+            await self.call_automation_client.close()
+            self.call_automation_client = None
+        await self.call_store.close()
+
     def attach_to_app(self, app, path):
         app.router.add_post(path, self._outbound_call_handler)
+        app.on_cleanup.append(self._on_cleanup)
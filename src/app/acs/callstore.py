@@ -0,0 +1,71 @@
+import json
+import time
+from typing import Any, Optional
+
+class CallStore:
+    # Call state shared between workers and replicas, ACS callbacks for a call can land on any of them
+    ttl: int
+
+    def __init__(self, ttl: int = 24 * 60 * 60):
+        self.ttl = ttl
+
+    async def get(self, call_connection_id: str) -> Optional[dict[str, Any]]:
+        raise NotImplementedError
+
+    async def set(self, call_connection_id: str, call: dict[str, Any]):
+        raise NotImplementedError
+
+    async def delete(self, call_connection_id: str):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class InMemoryCallStore(CallStore):
+    # Only correct with a single worker process, the default for local development
+    def __init__(self, ttl: int = 24 * 60 * 60):
+        super().__init__(ttl)
+        self._calls: dict[str, tuple[float, dict[str, Any]]] = {}
+
+    async def get(self, call_connection_id: str) -> Optional[dict[str, Any]]:
+        entry = self._calls.get(call_connection_id)
+        if entry is None:
+            return None
+        expires_at, call = entry
+        if expires_at <= time.monotonic():
+            del self._calls[call_connection_id]
+            return None
+        return call
+
+    async def set(self, call_connection_id: str, call: dict[str, Any]):
+        self._calls[call_connection_id] = (time.monotonic() + self.ttl, call)
+
+    async def delete(self, call_connection_id: str):
+        self._calls.pop(call_connection_id, None)
+
+class RedisCallStore(CallStore):
+    key_prefix: str = "acs:call:"
+
+    def __init__(self, url: str, ttl: int = 24 * 60 * 60):
+        super().__init__(ttl)
+        # Imported here, single worker setups never load it
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+
+    async def get(self, call_connection_id: str) -> Optional[dict[str, Any]]:
+        value = await self._redis.get(self.key_prefix + call_connection_id)
+        return json.loads(value) if value is not None else None
+
+    async def set(self, call_connection_id: str, call: dict[str, Any]):
+        await self._redis.set(self.key_prefix + call_connection_id, json.dumps(call), ex=self.ttl)
+
+    async def delete(self, call_connection_id: str):
+        await self._redis.delete(self.key_prefix + call_connection_id)
+
+    async def close(self):
+        await self._redis.aclose()
+
+def create_call_store(url: Optional[str]) -> CallStore:
+    if url:
+        return RedisCallStore(url)
+    return InMemoryCallStore()
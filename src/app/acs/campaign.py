@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import random
+import time
+import uuid
+from typing import Any, Optional
+from aiohttp import web
+
+from acs.caller import OutboundCall
+from backend.admission import AdmissionController, AdmissionRejected, Lease, client_key
+
+logger = logging.getLogger("campaign")
+
+class RateLimiter:
+    # Spaces out acquisitions to at most `rate` per second, callers queue up in arrival order
+    interval: float
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class CallCampaign:
+    # Dials a batch of numbers in the background, e.g. end-of-day debriefs for a whole team
+    caller: OutboundCall
+    max_concurrent: int
+    calls_per_second: float
+    max_attempts: int
+    backoff_base: float
+    # Larger batches are refused, every number is a call and a status entry
+    max_batch_size: int = 500
+    # Campaign status lives in the call store next to the calls, so any worker or replica can report it.
+    # Only the worker that accepted a campaign dials it and writes its status
+    key_prefix: str = "campaign:"
+    # The /call admission controller. Submitting counts as a call for the user's limits, and every dial takes
+    # a call slot, waiting (without using up an attempt) while the realtime sessions it leads to are full
+    admission: Optional[AdmissionController]
+    capacity_poll_interval: float = 1.0
+
+    def __init__(self, caller: OutboundCall, max_concurrent: int = 5, calls_per_second: float = 1.0,
+                 max_attempts: int = 3, backoff_base: float = 2.0, admission: Optional[AdmissionController] = None):
+        self.caller = caller
+        self.admission = admission
+        self.max_concurrent = max_concurrent
+        self.calls_per_second = calls_per_second
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._rate_limiter = RateLimiter(calls_per_second)
+        self._tasks: set[asyncio.Task] = set()
+        # Writes of one campaign's status go out in the order they were made
+        self._save_lock = asyncio.Lock()
+
+    async def _save(self, campaign: dict[str, Any]):
+        async with self._save_lock:
+            try:
+                await self.caller.call_store.set(self.key_prefix + campaign["campaign_id"], campaign)
+            except Exception as e:
+                # Dialing goes on, the next update writes the status again
+                logger.warning("Saving the status of campaign %s failed: %s", campaign["campaign_id"], e)
+
+    async def _update(self, campaign: dict[str, Any], status: dict[str, Any], **changes: Any):
+        status.update(changes)
+        await self._save(campaign)
+
+    async def _admit(self, campaign: dict[str, Any], status: dict[str, Any]) -> Optional[Lease]:
+        if self.admission is None:
+            return None
+        while True:
+            try:
+                # Already admitted per user on submission, only capacity is left to check
+                return await self.admission.acquire(None)
+            except AdmissionRejected as e:
+                if status["state"] != "waiting_for_capacity":
+                    await self._update(campaign, status, state="waiting_for_capacity")
+                await asyncio.sleep(min(e.retry_after, self.capacity_poll_interval))
+
+    async def _dial(self, campaign: dict[str, Any], status: dict[str, Any], sample_rate: int):
+        for attempt in range(1, self.max_attempts + 1):
+            async with self._semaphore:
+                lease = await self._admit(campaign, status)
+                try:
+                    await self._rate_limiter.wait()
+                    await self._update(campaign, status, attempts=attempt, state="dialing")
+                    connection_id = await self.caller.place_call(status["target_number"], sample_rate)
+                    await self._update(campaign, status, connection_id=connection_id, state="placed")
+                    return
+                except Exception as e:
+                    logger.warning("Calling %s failed (attempt %d): %s", status["target_number"], attempt, e)
+                    status["error"] = str(e)
+                finally:
+                    if lease is not None:
+                        lease.release()
+            if attempt < self.max_attempts:
+                await self._update(campaign, status, state="retrying")
+                # Exponential backoff with jitter so retries of a throttled batch don't arrive together
+                await asyncio.sleep(self.backoff_base ** attempt * (0.5 + random.random()))
+        await self._update(campaign, status, state="failed")
+
+    async def submit(self, target_numbers: list[str], sample_rate: int = 24000) -> str:
+        campaign_id = str(uuid.uuid4())
+        calls = [{ "target_number": number, "state": "queued", "attempts": 0 } for number in target_numbers]
+        campaign = { "campaign_id": campaign_id, "created_at": time.time(), "calls": calls }
+        # Stored before dialing starts, a status request right after submitting must find it
+        await self.caller.call_store.set(self.key_prefix + campaign_id, campaign)
+        for status in calls:
+            task = asyncio.create_task(self._dial(campaign, status, sample_rate))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return campaign_id
+
+    async def _submit_handler(self, request: web.Request):
+        body = await request.json()
+        target_numbers = body.get("target_numbers")
+        if (not isinstance(target_numbers, list) or len(target_numbers) == 0 or
+            not all(isinstance(number, str) for number in target_numbers)):
+            return web.json_response({ "error": "target_numbers must be a non-empty list of phone numbers" }, status=400)
+        if len(target_numbers) > self.max_batch_size:
+            return web.json_response({ "error": f"At most {self.max_batch_size} target_numbers per campaign" }, status=400)
+        try:
+            sample_rate = self.caller.parse_sample_rate(body.get("sample_rate", 24000))
+        except ValueError as e:
+            return web.json_response({ "error": str(e) }, status=400)
+        if self.admission is not None:
+            try:
+                lease = await self.admission.acquire(client_key(request))
+            except AdmissionRejected as e:
+                return e.response()
+            # Only the submission is held against the user, the dials are paced by the campaign itself
+            lease.release()
+        campaign_id = await self.submit(target_numbers, sample_rate)
+        return web.json_response({ "campaign_id": campaign_id, "queued": len(target_numbers) }, status=202)
+
+    async def _status_handler(self, request: web.Request):
+        campaign = await self.caller.call_store.get(self.key_prefix + request.match_info["campaign_id"])
+        if campaign is None:
+            return web.json_response({ "error": "Unknown campaign" }, status=404)
+        return web.json_response(campaign)
+
+    async def _on_cleanup(self, app: web.Application):
+        for task in list(self._tasks):
+            task.cancel()
+
+    def attach_to_app(self, app: web.Application, path: str):
+        app.router.add_post(path, self._submit_handler)
+        app.router.add_get(path + "/{campaign_id}", self._status_handler)
+        app.on_cleanup.append(self._on_cleanup)
@@ -0,0 +1,43 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+from azure.core.messaging import CloudEvent
+
+logger = logging.getLogger("acs.events")
+
+EventHandler = Callable[[CloudEvent], Awaitable[None]]
+
+class CallEventDispatcher:
+    # Routes ACS callback events to async handlers by event type. Dispatching only schedules the work, so
+    # the callback can be acknowledged before any slow handler runs and ACS doesn't retry the batch
+    handlers: dict[str, list[EventHandler]]
+
+    def __init__(self):
+        self.handlers = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def register(self, event_type: str, handler: EventHandler):
+        self.handlers.setdefault(event_type, []).append(handler)
+
+    def dispatch(self, events: list[CloudEvent]):
+        task = asyncio.create_task(self._process(events))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, events: list[CloudEvent]):
+        # Events of one batch are handled in order, they usually describe consecutive states of a call
+        for event in events:
+            handlers = self.handlers.get(event.type)
+            if handlers is None:
+                logger.debug("No handler for %s", event.type)
+                continue
+            for handler in handlers:
+                try:
+                    await handler(event)
+                except Exception:
+                    logger.exception("Handling %s failed", event.type)
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -3,16 +3,22 @@ import os
 from pathlib import Path
 import time
 import json
+from typing import TYPE_CHECKING
 from aiohttp import web
 from azure.core.credentials import AzureKeyCredential
-from azure.identity import AzureDeveloperCliCredential, DefaultAzureCredential
 from dotenv import load_dotenv
 
 from backend.tools import _generate_report_tool, _generate_report_tool_schema, _get_report_fields_tool_schema
 from backend.rtmt import RTMiddleTier, Tool
+from backend.upstream import Upstream
+from backend.admission import AdmissionController, AdmissionRejected, client_key
+from backend import metrics
 
-from acs.caller import OutboundCall
-from reportstore.cosmosdb import CosmosDBStore
+# ACS, Cosmos DB and azure.identity are imported only when configured, they account for most of the
+# import time and scale-from-zero replicas shouldn't pay for what they don't use
+if TYPE_CHECKING:
+    from acs.caller import OutboundCall
+    from reportstore.cosmosdb import CosmosDBStore
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("voicerag")
@@ -24,13 +30,16 @@ async def create_app():
     llm_endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
     llm_deployment = os.environ.get("AZURE_OPENAI_COMPLETION_DEPLOYMENT_NAME")
     llm_key = os.environ.get("AZURE_OPENAI_API_KEY")
+    if not llm_endpoint:
+        raise ValueError("AZURE_OPENAI_ENDPOINT must be set to the Azure OpenAI resource serving the realtime deployment")
 
     credential = None
 
-    cosmos: CosmosDBStore = None
-    caller: OutboundCall = None
+    cosmos: "CosmosDBStore" = None
+    caller: "OutboundCall" = None
     
     if not llm_key:
+        from azure.identity import AzureDeveloperCliCredential, DefaultAzureCredential
         if tenant_id := os.environ.get("AZURE_TENANT_ID"):
             logger.info(
                 "Using AzureDeveloperCliCredential with tenant_id %s", tenant_id)
@@ -44,20 +53,50 @@ async def create_app():
     if (os.environ.get("COSMOSDB_ACCOUNT_ENDPOINT") is not None and
             os.environ.get("COSMOSDB_DATABASE_NAME") is not None and
             os.environ.get("COSMOSDB_CONTAINER_NAME") is not None):
-        
+        from reportstore.cosmosdb import CosmosDBStore
+
         cosmos = CosmosDBStore(
             os.environ.get("COSMOSDB_ACCOUNT_ENDPOINT"),
             os.environ.get("COSMOSDB_DATABASE_NAME"),
             os.environ.get("COSMOSDB_CONTAINER_NAME"),
+            os.environ.get("COSMOSDB_REPORTS_CONTAINER_NAME", "reports"),
+            os.environ.get("REPORT_SPILL_PATH", "reports-spill.jsonl"),
         )    
 
     app = web.Application()
 
+    if (cosmos is not None):
+        cosmos.admin_token = os.environ.get("ADMIN_TOKEN")
+        cosmos.attach_to_app(app)
+
     rtmt = RTMiddleTier(llm_endpoint, llm_deployment, llm_credential)
+    rtmt.suppress_silence = os.environ.get("SUPPRESS_SILENCE", "false").lower() == "true"
+    rtmt.archive_dir = os.environ.get("SESSION_ARCHIVE_DIR")
+    # Further deployments, e.g. in other regions, as a JSON list of {"endpoint", "deployment", "key"}.
+    # Entries without a key use the credentials above
+    for extra in json.loads(os.environ.get("AZURE_OPENAI_UPSTREAMS", "[]")):
+        rtmt.upstreams.add(Upstream(extra["endpoint"], extra["deployment"], extra.get("key")))
+    # Per worker limits, multiply by the worker and replica count for the totals
+    rtmt.admission = AdmissionController(
+        "realtime",
+        max_concurrent=int(os.environ.get("REALTIME_MAX_SESSIONS", 100)),
+        max_concurrent_per_user=int(os.environ.get("REALTIME_MAX_SESSIONS_PER_USER", 5)),
+        rate=10, burst=20,
+        rate_per_user=1, burst_per_user=5)
+    call_admission = AdmissionController(
+        "call",
+        max_concurrent=10, max_concurrent_per_user=2,
+        rate=2, burst=5,
+        rate_per_user=0.2, burst_per_user=3,
+        queue_timeout=0,
+        downstream=rtmt.admission)
 
     if (os.environ.get("ACS_CONNECTION_STRING") is not None and 
         os.environ.get("ACS_SOURCE_NUMBER") is not None):
-        
+        from acs.caller import OutboundCall
+        from acs.campaign import CallCampaign
+        from acs.callstore import create_call_store
+
         callback_path = os.environ.get("ACS_CALLBACK_PATH")
 
         if (os.environ.get("ACS_CALLBACK_PATH") is None):
@@ -66,9 +105,12 @@ async def create_app():
         caller = OutboundCall(
             os.environ.get("ACS_CONNECTION_STRING"),
             os.environ.get("ACS_SOURCE_NUMBER"),
-            callback_path
+            callback_path,
+            create_call_store(os.environ.get("CALL_STORE_REDIS_URL"))
         )
         caller.attach_to_app(app, "/acs")
+        rtmt.acs_media_lookup = caller.lookup_media_token
+        CallCampaign(caller, admission=call_admission).attach_to_app(app, "/calls")
 
     if (cosmos is not None):
         rtmt.system_message = (
@@ -84,11 +126,13 @@ async def create_app():
         )
         rtmt.tools["generate_report"] = Tool(
             schema=_generate_report_tool_schema,
-            target=lambda args: cosmos.write_report(args),
+            target=cosmos.write_report,
+            stream_arguments=True,
         )
         rtmt.tools["get_questions"] = Tool(
             schema=_get_report_fields_tool_schema,
-            target=lambda args: cosmos.get_report_fields(args),
+            target=cosmos.get_report_fields,
+            prefetch=cosmos.prefetch_report_fields,
         )
     else:
         rtmt.system_message = (
@@ -104,7 +148,7 @@ async def create_app():
             "You must engage the user in a conversation and ask the questions in the script. The user will provide the answers to the questions."
         )
         rtmt.tools["generate_report"] = Tool(
-            target=_generate_report_tool, schema=_generate_report_tool_schema
+            target=_generate_report_tool, schema=_generate_report_tool_schema, stream_arguments=True
         )
         
     rtmt.attach_to_app(app, "/realtime")
@@ -123,10 +167,21 @@ async def create_app():
 
     async def call(request):
         if (caller is not None):
-            body = await request.json()
-            print(body)
-            target_number = body['target_number']
-            return await caller.call(target_number)
+            try:
+                lease = await call_admission.acquire(client_key(request))
+            except AdmissionRejected as e:
+                return e.response()
+            try:
+                body = await request.json()
+                print(body)
+                target_number = body['target_number']
+                try:
+                    sample_rate = caller.parse_sample_rate(body.get('sample_rate', 24000))
+                except ValueError as e:
+                    return web.json_response({ 'error': str(e) }, status=400)
+                return await caller.call(target_number, sample_rate)
+            finally:
+                lease.release()
         else:
             return web.Response(text="Outbound calling is not configured")
 
@@ -148,10 +203,19 @@ async def create_app():
         
         return web.json_response(acs_status)
 
+    async def ready(request):
+        # Readiness probe, the process accepts sockets before its dependencies are warmed up
+        checks = { 'realtime': rtmt.ready }
+        if (cosmos is not None):
+            checks['cosmos'] = cosmos.ready
+        return web.json_response(checks, status=200 if all(checks.values()) else 503)
+
     app.router.add_get('/', index)
     app.router.add_static('/static/', path=str(static_directory), name='static')
     app.router.add_post('/call', call)
     app.router.add_get('/status', acs_status)
+    app.router.add_get('/ready', ready)
+    metrics.attach_to_app(app, '/metrics')
 
     return app
 
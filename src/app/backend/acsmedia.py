@@ -0,0 +1,96 @@
+import base64
+import json
+import logging
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger("acsmedia")
+
+# The realtime API consumes and produces 16-bit mono PCM at 24 kHz
+REALTIME_SAMPLE_RATE = 24000
+SUPPORTED_SAMPLE_RATES = (8000, 16000, 24000)
+
+class Resampler:
+    # Streaming PCM16 resampler for one direction of a call. Filter history and the interpolation position
+    # carry over from one chunk to the next, so 20 ms chunks join up without a click at every boundary
+    src_rate: int
+    dst_rate: int
+
+    def __init__(self, src_rate: int, dst_rate: int):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        self._step = src_rate / dst_rate
+        # Box filter over the decimation window, cheap anti-aliasing that's good enough for speech
+        width = int(round(src_rate / dst_rate)) if dst_rate < src_rate else 1
+        self._kernel = np.full(width, 1.0 / width, dtype=np.float32) if width > 1 else None
+        self._history = np.zeros(width - 1, dtype=np.float32)
+        # Last sample of the previous chunk, and where the next output sample falls relative to it
+        self._last: Optional[np.ndarray] = None
+        self._position = 0.0
+
+    def process(self, pcm: bytes) -> bytes:
+        if self.src_rate == self.dst_rate or len(pcm) == 0:
+            return pcm
+        samples = np.frombuffer(pcm, dtype="<i2").astype(np.float32)
+        if self._kernel is not None:
+            padded = np.concatenate((self._history, samples))
+            self._history = padded[len(padded) - len(self._history):]
+            samples = np.convolve(padded, self._kernel, mode="valid")
+        if self._last is not None:
+            samples = np.concatenate((self._last, samples))
+        end = len(samples) - 1
+        count = int(np.floor((end - self._position) / self._step)) + 1 if end >= self._position else 0
+        positions = self._position + np.arange(count, dtype=np.float64) * self._step
+        resampled = np.interp(positions, np.arange(len(samples), dtype=np.float64), samples)
+        self._position += count * self._step - end
+        self._last = samples[-1:]
+        return np.clip(np.rint(resampled), -32768, 32767).astype("<i2").tobytes()
+
+class AcsMediaAdapter:
+    # Translates between ACS bidirectional media streaming messages and the realtime API protocol
+    sample_rate: int
+
+    def __init__(self, sample_rate: int = REALTIME_SAMPLE_RATE):
+        if sample_rate not in SUPPORTED_SAMPLE_RATES:
+            raise ValueError(f"Unsupported ACS sample rate {sample_rate}, expected one of {SUPPORTED_SAMPLE_RATES}")
+        self._set_sample_rate(sample_rate)
+
+    def _set_sample_rate(self, sample_rate: int):
+        self.sample_rate = sample_rate
+        self._inbound = Resampler(sample_rate, REALTIME_SAMPLE_RATE)
+        self._outbound = Resampler(REALTIME_SAMPLE_RATE, sample_rate)
+
+    def to_realtime(self, data: str) -> Optional[str]:
+        message = json.loads(data)
+        match message.get("kind"):
+            case "AudioMetadata":
+                sample_rate = message["audioMetadata"].get("sampleRate", self.sample_rate)
+                if sample_rate == self.sample_rate:
+                    pass
+                elif sample_rate in SUPPORTED_SAMPLE_RATES:
+                    self._set_sample_rate(sample_rate)
+                else:
+                    logger.warning("ACS announced unsupported sample rate %s, keeping %s", sample_rate, self.sample_rate)
+                return None
+            case "AudioData":
+                pcm = base64.b64decode(message["audioData"]["data"])
+                pcm = self._inbound.process(pcm)
+                return json.dumps({
+                    "type": "input_audio_buffer.append",
+                    "audio": base64.b64encode(pcm).decode("ascii")
+                })
+        return None
+
+    def from_realtime_audio(self, pcm: bytes) -> str:
+        pcm = self._outbound.process(pcm)
+        # Outbound ACS messages use PascalCase members, unlike the inbound ones
+        return json.dumps({
+            "Kind": "AudioData",
+            "AudioData": { "Data": base64.b64encode(pcm).decode("ascii") },
+            "StopAudio": None
+        })
+
+    def stop_audio(self) -> str:
+        # Flushes audio ACS has buffered for playback, used when the caller barges in
+        return json.dumps({ "Kind": "StopAudio", "AudioData": None, "StopAudio": {} })
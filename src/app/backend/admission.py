@@ -0,0 +1,197 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+from aiohttp import web
+
+from backend import metrics
+
+def client_key(request: web.Request) -> str:
+    # The signed-in user when Container Apps authentication is on, otherwise the caller's address
+    principal = request.headers.get("X-MS-CLIENT-PRINCIPAL-ID")
+    if principal:
+        return principal
+    # The ingress appends the address it saw, earlier entries come from the client and can be made up
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded:
+        return forwarded.split(",")[-1].strip()
+    return request.remote or "unknown"
+
+class AdmissionRejected(Exception):
+    reason: str
+    status: int
+    retry_after: float
+
+    def __init__(self, reason: str, status: int, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+    def response(self) -> web.Response:
+        return web.json_response(
+            { "error": "Too many requests" if self.status == 429 else "Server is at capacity", "reason": self.reason },
+            status=self.status,
+            headers={ "Retry-After": str(max(1, math.ceil(self.retry_after))) })
+
+class TokenBucket:
+    rate: float
+    burst: float
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def try_take(self) -> float:
+        # Takes a token and returns 0, or returns how long until one is available
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    @property
+    def full(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+class _User:
+    active: int
+    bucket: TokenBucket
+
+    def __init__(self, bucket: TokenBucket):
+        self.active = 0
+        self.bucket = bucket
+
+class Lease:
+    def __init__(self, controller: "AdmissionController", key: Optional[str]):
+        self._controller = controller
+        self._key = key
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self._key)
+
+class AdmissionController:
+    # Caps concurrency and arrival rate of a route, globally and per user, so a burst can't oversubscribe
+    # the upstream quota or the event loop. Over the per-user limits or the rate requests are rejected
+    # straight away (429). When only the global concurrency is exhausted they wait up to queue_timeout for
+    # a slot, with at most max_queued waiting, before being turned away (503)
+    route: str
+    max_concurrent: int
+    max_concurrent_per_user: int
+    rate: float
+    burst: float
+    rate_per_user: float
+    burst_per_user: float
+    queue_timeout: float
+    max_queued: int
+    # Work admitted here goes on to need a slot there, e.g. a placed call needs a realtime session
+    downstream: Optional["AdmissionController"]
+    # Idle users are forgotten past this many, their buckets would be full again anyway
+    max_tracked_users: int = 10000
+
+    def __init__(self, route: str, max_concurrent: int, max_concurrent_per_user: int, rate: float, burst: float,
+                 rate_per_user: float, burst_per_user: float, queue_timeout: float = 2.0, max_queued: int = 50,
+                 downstream: Optional["AdmissionController"] = None):
+        self.route = route
+        self.max_concurrent = max_concurrent
+        self.max_concurrent_per_user = max_concurrent_per_user
+        self.rate = rate
+        self.burst = burst
+        self.rate_per_user = rate_per_user
+        self.burst_per_user = burst_per_user
+        self.queue_timeout = queue_timeout
+        self.max_queued = max_queued
+        self.downstream = downstream
+        self.active = 0
+        self.queued = 0
+        self._bucket = TokenBucket(rate, burst)
+        self._users: OrderedDict[str, _User] = OrderedDict()
+        # Requests waiting for a slot in arrival order, a released slot is handed straight to the first one
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def saturated(self) -> bool:
+        return self.active >= self.max_concurrent
+
+    def _reject(self, reason: str, status: int, retry_after: float):
+        metrics.ADMISSION_REJECTED.inc(1, (self.route, reason))
+        raise AdmissionRejected(reason, status, retry_after)
+
+    def _user(self, key: str) -> _User:
+        user = self._users.get(key)
+        if user is None:
+            user = self._users[key] = _User(TokenBucket(self.rate_per_user, self.burst_per_user))
+            if len(self._users) > self.max_tracked_users:
+                for idle_key in [k for k, u in self._users.items() if k != key and u.active == 0 and u.bucket.full]:
+                    del self._users[idle_key]
+        self._users.move_to_end(key)
+        return user
+
+    async def acquire(self, key: Optional[str]) -> Lease:
+        # A key of None skips the per-user and rate limits, for work that was already admitted elsewhere
+        # (e.g. the media socket of an outbound call) and only has to fit in the global capacity
+        if self.downstream is not None and self.downstream.saturated:
+            self._reject("downstream_capacity", 503, 5)
+        user = None
+        if key is not None:
+            user = self._user(key)
+            if user.active >= self.max_concurrent_per_user:
+                self._reject("user_concurrency", 429, 5)
+            if (wait := user.bucket.try_take()) > 0:
+                self._reject("user_rate", 429, wait)
+            if (wait := self._bucket.try_take()) > 0:
+                self._reject("rate", 429, wait)
+            user.active += 1
+
+        try:
+            if self.active >= self.max_concurrent:
+                await self._wait_for_slot()
+            else:
+                self.active += 1
+                metrics.ADMISSION_ACTIVE.inc(1, (self.route,))
+        except BaseException:
+            if user is not None:
+                user.active -= 1
+            raise
+        return Lease(self, key)
+
+    async def _wait_for_slot(self):
+        if self.queued >= self.max_queued:
+            self._reject("queue_full", 503, 1)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        metrics.ADMISSION_QUEUED.inc(1, (self.route,))
+        try:
+            # Resolved by _release, which passes its slot on without freeing it
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject("capacity", 503, 1)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the request went away, pass it on
+                self._release(None)
+            raise
+        finally:
+            self.queued -= 1
+            metrics.ADMISSION_QUEUED.dec(1, (self.route,))
+
+    def _release(self, key: Optional[str]):
+        if key is not None and (user := self._users.get(key)) is not None:
+            user.active -= 1
+        while len(self._waiters) > 0:
+            waiter = self._waiters.popleft()
+            # Waiters that timed out were cancelled, skip them
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+        metrics.ADMISSION_ACTIVE.dec(1, (self.route,))
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+from typing import BinaryIO, Optional
+
+from backend import metrics
+
+logger = logging.getLogger("archive")
+
+_WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+# Placeholder sizes until the file is closed, readers treat them as "until end of file"
+_WAV_UNKNOWN_SIZE = 0xFFFFFFFF
+
+def _wav_header(sample_rate: int, data_size: int) -> bytes:
+    riff_size = data_size + 36 if data_size != _WAV_UNKNOWN_SIZE else _WAV_UNKNOWN_SIZE
+    return _WAV_HEADER.pack(b"RIFF", riff_size, b"WAVE", b"fmt ", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16, b"data", data_size)
+
+class SessionArchive:
+    # Records one session for quality review: PCM16 WAV per direction plus a JSON lines transcript, in a
+    # directory of its own. The relay only appends to an in-memory buffer, a background task writes it out
+    # in chunks on a worker thread. Past max_buffered_bytes audio is dropped instead of growing memory
+    directory: str
+    sample_rate: int
+    max_buffered_bytes: int
+    flush_interval: float
+    dropped_bytes: int
+
+    def __init__(self, directory: str, sample_rate: int = 24000, max_buffered_bytes: int = 1 << 20, flush_interval: float = 1.0):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_buffered_bytes = max_buffered_bytes
+        self.flush_interval = flush_interval
+        self.dropped_bytes = 0
+        self._started_at = time.monotonic()
+        self._pending: list[tuple[str, bytes]] = []
+        self._pending_bytes = 0
+        self._files: dict[str, BinaryIO] = {}
+        self._audio_bytes: dict[str, int] = {}
+        self._flush_needed = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def start(self):
+        self._writer = asyncio.create_task(self._run())
+
+    def add_audio(self, direction: str, pcm: bytes):
+        if self._pending_bytes + len(pcm) > self.max_buffered_bytes:
+            # The disk can't keep up, losing a bit of the recording beats slowing down the call
+            self.dropped_bytes += len(pcm)
+            metrics.ARCHIVE_DROPPED.inc(len(pcm))
+            return
+        self._append(direction + ".wav", pcm)
+
+    def add_transcript(self, role: str, item_id: str, text: str):
+        line = json.dumps({ "offset": round(time.monotonic() - self._started_at, 3), "role": role, "item_id": item_id, "text": text })
+        # Transcripts are small and the point of the archive, they're kept even over the budget
+        self._append("transcript.jsonl", (line + "\n").encode("utf-8"))
+
+    def _append(self, name: str, data: bytes):
+        self._pending.append((name, data))
+        self._pending_bytes += len(data)
+        if self._pending_bytes >= self.max_buffered_bytes // 2:
+            self._flush_needed.set()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self._flush()
+
+    async def _flush(self):
+        self._flush_needed.clear()
+        if len(self._pending) == 0:
+            return
+        chunks, self._pending, self._pending_bytes = self._pending, [], 0
+        try:
+            await asyncio.to_thread(self._write, chunks)
+        except OSError as e:
+            logger.error("Writing to the session archive %s failed: %s", self.directory, e)
+
+    def _write(self, chunks: list[tuple[str, bytes]]):
+        # Runs on a worker thread, consecutive chunks of a file are joined into one write
+        by_file: dict[str, list[bytes]] = {}
+        for name, data in chunks:
+            by_file.setdefault(name, []).append(data)
+        for name, parts in by_file.items():
+            file = self._files.get(name)
+            if file is None:
+                os.makedirs(self.directory, exist_ok=True)
+                file = self._files[name] = open(os.path.join(self.directory, name), "wb")
+                if name.endswith(".wav"):
+                    file.write(_wav_header(self.sample_rate, _WAV_UNKNOWN_SIZE))
+                    self._audio_bytes[name] = 0
+            data = b"".join(parts)
+            file.write(data)
+            file.flush()
+            if name in self._audio_bytes:
+                self._audio_bytes[name] += len(data)
+
+    def _finish(self):
+        for name, file in self._files.items():
+            if name in self._audio_bytes:
+                file.seek(0)
+                file.write(_wav_header(self.sample_rate, self._audio_bytes[name]))
+            file.close()
+        self._files.clear()
+
+    async def close(self):
+        # Not cancelled, a write already handed to the worker thread has to finish before the files are closed
+        self._closing = True
+        self._flush_needed.set()
+        if self._writer is not None:
+            await self._writer
+            self._writer = None
+        await self._flush()
+        await asyncio.to_thread(self._finish)
+        if self.dropped_bytes > 0:
+            logger.warning("Session archive %s is missing %d bytes of audio", self.directory, self.dropped_bytes)
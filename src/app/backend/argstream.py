@@ -0,0 +1,172 @@
+import json
+import re
+from typing import Any, Optional
+
+# Characters that end a plain run of text inside a string, and outside of strings in a nested value
+_STRING_SPECIAL = re.compile(r'["\\]')
+_NESTED_SPECIAL = re.compile(r'["{}\[\]]')
+_WHITESPACE = " \t\r\n"
+
+# Parser states
+_START, _FIRST_KEY, _NEXT_KEY, _KEY, _COLON, _VALUE, _STRING, _SCALAR, _NESTED, _COMMA_OR_END, _DONE = range(11)
+
+class ArgumentStream:
+    # Incremental parser for function call arguments as they arrive in response.function_call_arguments.delta
+    # events. Only the top level object is followed: each value is reported as soon as it's complete, and the
+    # string value still being received can be read so far. Nested values are collected raw and decoded once
+    # closed. Malformed input raises ValueError, the full arguments are parsed again when the call is done
+    values: dict[str, Any]
+
+    def __init__(self):
+        self.values = {}
+        self._state = _START
+        # Key whose value is being read
+        self._key: Optional[str] = None
+        # Raw text of the key or value being read
+        self._raw: list[str] = []
+        self._escape = False
+        self._depth = 0
+        self._nested_string = False
+
+    @property
+    def done(self) -> bool:
+        return self._state == _DONE
+
+    def feed(self, delta: str) -> list[str]:
+        # Returns the keys whose values were completed by this delta
+        completed = []
+        i, n = 0, len(delta)
+        while i < n:
+            state = self._state
+            if state == _KEY or state == _STRING:
+                i, closed = self._scan_string(delta, i)
+                if closed:
+                    text = json.loads('"' + "".join(self._raw) + '"')
+                    self._raw = []
+                    if state == _KEY:
+                        self._key = text
+                        self._state = _COLON
+                    else:
+                        self._complete(text, completed)
+                continue
+            if state == _NESTED:
+                i = self._scan_nested(delta, i)
+                if self._depth == 0:
+                    self._complete(json.loads("".join(self._raw)), completed)
+                continue
+            char = delta[i]
+            if state == _SCALAR:
+                if char in ",}" or char in _WHITESPACE:
+                    # Left for _COMMA_OR_END to consume
+                    self._complete(json.loads("".join(self._raw)), completed)
+                else:
+                    self._raw.append(char)
+                    i += 1
+                continue
+            i += 1
+            if char in _WHITESPACE:
+                continue
+            if state == _START and char == "{":
+                self._state = _FIRST_KEY
+            elif (state == _FIRST_KEY or state == _NEXT_KEY) and char == '"':
+                self._state = _KEY
+            elif (state == _FIRST_KEY or state == _COMMA_OR_END) and char == "}":
+                self._state = _DONE
+            elif state == _COLON and char == ":":
+                self._state = _VALUE
+            elif state == _VALUE:
+                if char == '"':
+                    self._state = _STRING
+                elif char in "{[":
+                    self._state = _NESTED
+                    self._raw = [char]
+                    self._depth = 1
+                else:
+                    self._state = _SCALAR
+                    self._raw = [char]
+            elif state == _COMMA_OR_END and char == ",":
+                self._state = _NEXT_KEY
+            else:
+                raise ValueError(f"Unexpected {char!r} in function call arguments")
+        return completed
+
+    def snapshot(self) -> dict[str, Any]:
+        # Complete values plus the text so far of a string value that is still open
+        if self._state != _STRING:
+            return dict(self.values)
+        return { **self.values, self._key: self._partial_string() }
+
+    def _complete(self, value: Any, completed: list[str]):
+        self.values[self._key] = value
+        completed.append(self._key)
+        self._raw = []
+        self._state = _COMMA_OR_END
+
+    def _scan_string(self, text: str, i: int) -> tuple[int, bool]:
+        # Collects raw string content up to the closing quote, escapes are kept for json.loads to decode
+        while i < len(text):
+            if self._escape:
+                self._raw.append(text[i])
+                self._escape = False
+                i += 1
+                continue
+            match = _STRING_SPECIAL.search(text, i)
+            if match is None:
+                self._raw.append(text[i:])
+                return len(text), False
+            j = match.start()
+            self._raw.append(text[i:j])
+            if text[j] == '"':
+                return j + 1, True
+            self._raw.append("\\")
+            self._escape = True
+            i = j + 1
+        return i, False
+
+    def _scan_nested(self, text: str, i: int) -> int:
+        while i < len(text):
+            if self._nested_string:
+                if self._escape:
+                    self._raw.append(text[i])
+                    self._escape = False
+                    i += 1
+                    continue
+                match = _STRING_SPECIAL.search(text, i)
+            else:
+                match = _NESTED_SPECIAL.search(text, i)
+            if match is None:
+                self._raw.append(text[i:])
+                return len(text)
+            j = match.start()
+            self._raw.append(text[i:j + 1])
+            i = j + 1
+            char = text[j]
+            if self._nested_string:
+                if char == '"':
+                    self._nested_string = False
+                else:
+                    self._escape = True
+            elif char == '"':
+                self._nested_string = True
+            elif char in "{[":
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    return i
+        return i
+
+    def _partial_string(self) -> str:
+        raw = "".join(self._raw)
+        self._raw = [raw]
+        # The delta may have split an escape sequence, drop the unfinished tail
+        for cut in range(0, 7):
+            try:
+                text = json.loads('"' + raw[:len(raw) - cut] + '"')
+            except json.JSONDecodeError:
+                continue
+            # Or between the two halves of an escaped surrogate pair
+            if len(text) > 0 and "\ud800" <= text[-1] <= "\udbff":
+                text = text[:-1]
+            return text
+        return ""
@@ -0,0 +1,152 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from aiohttp import web
+
+try:
+    from opentelemetry import trace
+    _tracer = trace.get_tracer("on-the-road-copilot")
+except ImportError:
+    # Tracing is optional, spans become no-ops when the OpenTelemetry API isn't installed
+    _tracer = None
+
+# Latency buckets in seconds, from sub-millisecond relay hops up to slow tool calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    # Plain dicts keyed by label values, updating a metric is a dict lookup and an add on the frame path
+    kind: str = "untyped"
+    name: str
+    documentation: str
+    labelnames: tuple[str, ...]
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, labels: tuple[str, ...] = ()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in self._values.items()]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, labels: tuple[str, ...] = ()):
+        self.inc(-amount, labels)
+
+    def set(self, value: float, labels: tuple[str, ...] = ()):
+        self._values[labels] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+    buckets: tuple[float, ...]
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # Per label set: non-cumulative bucket counts (last slot is +Inf), sum
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, labels: tuple[str, ...] = ()):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    @contextmanager
+    def time(self, labels: tuple[str, ...] = ()) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def _samples(self) -> list[str]:
+        samples = []
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                samples.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            samples.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total[0]}")
+            samples.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return samples
+
+class MetricsRegistry:
+    metrics: dict[str, Metric]
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+SESSIONS_ACTIVE = REGISTRY.register(Gauge("realtime_sessions_active", "Realtime sessions currently relayed"))
+SESSIONS_TOTAL = REGISTRY.register(Counter("realtime_sessions_total", "Realtime sessions accepted"))
+FRAMES = REGISTRY.register(Counter("realtime_frames_total", "Frames relayed", ("direction",)))
+BYTES = REGISTRY.register(Counter("realtime_bytes_total", "Payload bytes relayed", ("direction",)))
+QUEUE_DEPTH = REGISTRY.register(Gauge("realtime_queue_depth", "Frames buffered for sending, summed over sessions", ("direction",)))
+FRAMES_DROPPED = REGISTRY.register(Counter("realtime_frames_dropped_total", "Audio frames dropped by the relay queues", ("direction", "reason")))
+AUDIO_SUPPRESSED = REGISTRY.register(Counter("realtime_audio_suppressed_bytes_total", "Inbound PCM bytes not sent upstream because they were silence"))
+ARCHIVE_DROPPED = REGISTRY.register(Counter("realtime_archive_dropped_bytes_total", "Audio bytes left out of session archives because writing fell behind"))
+ADMISSION_ACTIVE = REGISTRY.register(Gauge("admission_active", "Requests holding an admission slot", ("route",)))
+ADMISSION_QUEUED = REGISTRY.register(Gauge("admission_queued", "Requests waiting for an admission slot", ("route",)))
+ADMISSION_REJECTED = REGISTRY.register(Counter("admission_rejected_total", "Requests turned away by admission control", ("route", "reason")))
+RELAY_LATENCY = REGISTRY.register(Histogram("realtime_relay_latency_seconds", "Time from receiving a frame to handing it to the other socket", ("direction",)))
+TIME_TO_FIRST_AUDIO = REGISTRY.register(Histogram("realtime_time_to_first_audio_seconds", "Time from session start to the first audio delta"))
+RESPONSE_LATENCY = REGISTRY.register(Histogram("realtime_response_latency_seconds", "Time from end of user speech to the first audio delta of the answer"))
+UPSTREAM_CONNECT_LATENCY = REGISTRY.register(Histogram("realtime_upstream_connect_seconds", "Time to open the realtime API websocket", ("upstream",)))
+UPSTREAM_ERRORS = REGISTRY.register(Counter("realtime_upstream_errors_total", "Failed connects and dropped connections per deployment", ("upstream", "reason")))
+UPSTREAM_SESSIONS = REGISTRY.register(Gauge("realtime_upstream_sessions", "Sessions connected to each deployment", ("upstream",)))
+UPSTREAM_CIRCUIT_OPEN = REGISTRY.register(Gauge("realtime_upstream_circuit_open", "1 while a deployment is taken out of rotation", ("upstream",)))
+UPSTREAM_RECONNECTS = REGISTRY.register(Counter("realtime_upstream_reconnects_total", "Attempts to resume a session on a new upstream connection", ("outcome",)))
+TOOL_DURATION = REGISTRY.register(Histogram("realtime_tool_duration_seconds", "Tool call duration", ("tool", "outcome")))
+COSMOS_LATENCY = REGISTRY.register(Histogram("cosmos_request_duration_seconds", "Cosmos DB request latency", ("operation",)))
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[object]]:
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, attributes=attributes) as current:
+        yield current
+
+async def _metrics_handler(request: web.Request):
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+def attach_to_app(app: web.Application, path: str):
+    app.router.add_get(path, _metrics_handler)
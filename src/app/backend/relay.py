@@ -0,0 +1,82 @@
+import asyncio
+from collections import deque
+from typing import Optional
+
+from backend import metrics
+
+class RelayQueue:
+    # Bounded buffer between a socket reader and the writer for the opposite socket. Once the high-water
+    # mark is hit, frames marked as droppable (audio) are discarded oldest-first to make room. When there
+    # is no audio left to drop, other frames make the reader wait, which pushes back on its socket
+    direction: str
+    high_water: int
+    dropped: int
+
+    def __init__(self, direction: str, high_water: int):
+        self.direction = direction
+        self.high_water = high_water
+        self.dropped = 0
+        self._frames: deque[tuple[str | bytes, float, bool]] = deque()
+        self._changed = asyncio.Condition()
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    async def put(self, data: str | bytes, received: float, droppable: bool = False):
+        async with self._changed:
+            # Stale audio is worth less than fresh audio or control frames, make room by dropping the oldest
+            if len(self._frames) >= self.high_water and not self._drop_oldest_droppable():
+                if droppable:
+                    self._count_dropped(1, "overflow")
+                    return
+                await self._changed.wait_for(lambda: self._closed or len(self._frames) < self.high_water)
+            if self._closed:
+                return
+            self._frames.append((data, received, droppable))
+            metrics.QUEUE_DEPTH.inc(1, (self.direction,))
+            self._changed.notify_all()
+
+    async def get(self) -> Optional[tuple[str | bytes, float]]:
+        # Returns None once the queue is closed
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._closed or len(self._frames) > 0)
+            if self._closed:
+                return None
+            data, received, _ = self._frames.popleft()
+            metrics.QUEUE_DEPTH.dec(1, (self.direction,))
+            self._changed.notify_all()
+            return data, received
+
+    async def discard_droppable(self, reason: str) -> int:
+        # Used on barge-in, queued assistant audio is no longer wanted
+        async with self._changed:
+            kept = deque(frame for frame in self._frames if not frame[2])
+            discarded = len(self._frames) - len(kept)
+            self._frames = kept
+            if discarded > 0:
+                metrics.QUEUE_DEPTH.dec(discarded, (self.direction,))
+                self._count_dropped(discarded, reason)
+                self._changed.notify_all()
+            return discarded
+
+    async def close(self):
+        async with self._changed:
+            self._closed = True
+            if len(self._frames) > 0:
+                metrics.QUEUE_DEPTH.dec(len(self._frames), (self.direction,))
+                self._frames.clear()
+            self._changed.notify_all()
+
+    def _drop_oldest_droppable(self) -> bool:
+        for index, frame in enumerate(self._frames):
+            if frame[2]:
+                del self._frames[index]
+                metrics.QUEUE_DEPTH.dec(1, (self.direction,))
+                self._count_dropped(1, "overflow")
+                return True
+        return False
+
+    def _count_dropped(self, count: int, reason: str):
+        self.dropped += count
+        metrics.FRAMES_DROPPED.inc(count, (self.direction, reason))
@@ -1,11 +1,92 @@
 import aiohttp
 import asyncio
+import base64
 import json
+import logging
+import os
+import re
+import time
+import uuid
 from enum import Enum
-from typing import Any, Callable, Optional
+from typing import Any, Awaitable, Callable, Optional, TYPE_CHECKING
 from aiohttp import web
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from azure.core.credentials import AzureKeyCredential
+from azure.core.credentials import AccessToken, AzureKeyCredential
+
+from backend import metrics
+from backend.admission import AdmissionController, AdmissionRejected, client_key
+from backend.argstream import ArgumentStream
+from backend.relay import RelayQueue
+from backend.sessionconfig import SessionConfig
+from backend.sessionlog import SessionLog, item_text
+from backend.upstream import RETRYABLE_STATUSES, Upstream, UpstreamPool
+
+if TYPE_CHECKING:
+    # NumPy and azure.identity are only imported once a session or credential needs them, keeps cold start short
+    from azure.identity import DefaultAzureCredential
+    from backend.archive import SessionArchive
+    from backend.acsmedia import AcsMediaAdapter
+    from backend.vad import SilenceSuppressor
+
+logger = logging.getLogger("rtmt")
+
+_TOKEN_SCOPE = "https://cognitiveservices.azure.com/.default"
+# Refresh the bearer token this many seconds before it expires, and retry this often if a refresh fails
+_TOKEN_REFRESH_MARGIN = 300
+_TOKEN_RETRY_DELAY = 10
+
+# Frame types the middle tier needs to inspect or rewrite, everything else (audio deltas, transcripts,
+# input audio appends, ...) is relayed byte-for-byte without being parsed
+_CLIENT_INTERCEPT_TYPES = frozenset({
+    "session.created",
+    "response.output_item.added",
+    "conversation.item.created",
+    "response.function_call_arguments.delta",
+    "response.function_call_arguments.done",
+    "response.output_item.done",
+    "response.created",
+    "response.done",
+    "conversation.item.input_audio_transcription.completed",
+})
+_SERVER_INTERCEPT_TYPES = frozenset({
+    "session.update",
+})
+
+# Client request ids that are safe to use in a file name, anything else gets a fresh id for the archive
+_CLIENT_REQUEST_ID = re.compile(r"[A-Za-z0-9-]{1,64}")
+
+# Matches a top-level "type" member at the start of a frame, optionally preceded by "event_id"
+_FRAME_TYPE_PREFIX = re.compile(r'\s*\{\s*(?:"event_id"\s*:\s*"[^"\\]*"\s*,\s*)?"type"\s*:\s*"([^"\\]+)"')
+
+def _peek_type(data: str) -> Optional[str]:
+    # Only looks at the head of the frame, returns None when the type can't be determined cheaply
+    match = _FRAME_TYPE_PREFIX.match(data)
+    return match.group(1) if match is not None else None
+
+_AUDIO_DELTA_MARKER = '"delta":"'
+
+def _extract_audio_delta(data: str) -> Optional[bytes]:
+    # Returns the decoded PCM of a response.audio.delta frame, None for any other frame. Base64 never
+    # contains quotes or escapes, so the payload can be sliced out without parsing the JSON
+    if _peek_type(data) != "response.audio.delta":
+        return None
+    start = data.find(_AUDIO_DELTA_MARKER)
+    if start < 0:
+        return base64.b64decode(json.loads(data)["delta"])
+    start += len(_AUDIO_DELTA_MARKER)
+    return base64.b64decode(data[start:data.index('"', start)])
+
+_AUDIO_APPEND_MARKER = '"audio":"'
+
+def _extract_appended_audio(data: str) -> bytes:
+    # Same slicing as for audio deltas, for input_audio_buffer.append frames
+    start = data.find(_AUDIO_APPEND_MARKER)
+    if start < 0:
+        return base64.b64decode(json.loads(data)["audio"])
+    start += len(_AUDIO_APPEND_MARKER)
+    return base64.b64decode(data[start:data.index('"', start)])
+
+def _audio_append_message(pcm: bytes) -> str:
+    return '{"type":"input_audio_buffer.append","audio":"' + base64.b64encode(pcm).decode("ascii") + '"}'
 
 class ToolResultDirection(Enum):
     TO_SERVER = 1
@@ -14,10 +95,13 @@ class ToolResultDirection(Enum):
 class ToolResult:
     text: str
     destination: ToolResultDirection
+    # Tools to add or replace for the rest of the session, e.g. a schema that depends on an earlier answer
+    session_tools: Optional[dict[str, "Tool"]]
 
-    def __init__(self, text: str, destination: ToolResultDirection):
+    def __init__(self, text: str, destination: ToolResultDirection, session_tools: Optional[dict[str, "Tool"]] = None):
         self.text = text
         self.destination = destination
+        self.session_tools = session_tools
 
     def to_text(self) -> str:
         if self.text is None:
@@ -27,27 +111,177 @@ class ToolResult:
 class Tool:
     target: Callable[..., ToolResult]
     schema: Any
+    # Seconds before the call is abandoned, falls back to RTMiddleTier.tool_timeout when not set
+    timeout: Optional[float]
+    # Returns a list of problems with the arguments, invalid calls go back to the model without running the target
+    validator: Optional[Callable[[Any], list[str]]]
+    # Show the arguments to the client while the model is still producing them, as partial
+    # extension.middle_tier_tool_response messages
+    stream_arguments: bool
+    # Called with each argument as soon as it's complete, to start loading what the call will need
+    prefetch: Optional[Callable[[str, Any], Awaitable[None]]]
 
-    def __init__(self, target: Any, schema: Any):
+    def __init__(self, target: Any, schema: Any, timeout: Optional[float] = None, validator: Optional[Callable[[Any], list[str]]] = None,
+                 stream_arguments: bool = False, prefetch: Optional[Callable[[str, Any], Awaitable[None]]] = None):
         self.target = target
         self.schema = schema
+        self.timeout = timeout
+        self.validator = validator
+        self.stream_arguments = stream_arguments
+        self.prefetch = prefetch
 
 class RTToolCall:
     tool_call_id: str
     previous_id: str
+    name: Optional[str]
+    task: Optional[asyncio.Task]
+    # Parses the argument deltas when the tool streams or prefetches, None otherwise or once they turn out malformed
+    arguments: Optional[ArgumentStream]
+    streamed_at: float
 
-    def __init__(self, tool_call_id: str, previous_id: str):
+    def __init__(self, tool_call_id: str, previous_id: str, name: Optional[str] = None):
         self.tool_call_id = tool_call_id
         self.previous_id = previous_id
+        self.name = name
+        self.task = None
+        self.arguments = None
+        self.streamed_at = 0.0
+
+class RTSession:
+    # Per-connection state, one instance per /realtime socket so concurrent calls never share pending tool calls
+    client_ws: web.WebSocketResponse
+    server_ws: Optional[aiohttp.ClientWebSocketResponse]
+    # Deployment server_ws is connected to
+    upstream: Optional[Upstream]
+    client_request_id: Optional[str]
+    # Client opted into raw PCM16 binary frames for audio instead of base64 in JSON
+    binary_audio: bool
+    # Set when the client is an ACS media stream rather than a realtime API client
+    media_adapter: Optional["AcsMediaAdapter"]
+    # Set when silent input audio is kept from the upstream
+    vad: Optional["SilenceSuppressor"]
+    # Set when the session's audio and transcripts are recorded for review
+    archive: Optional["SessionArchive"]
+    tools_pending: dict[str, RTToolCall]
+    # Session specific tools installed by tool results, they take precedence over RTMiddleTier.tools
+    tools: dict[str, Tool]
+    # Server configuration including those tools, None while the session uses RTMiddleTier.session_config
+    config: Optional[SessionConfig]
+    # Frames waiting to be written to each socket, bounded so a slow peer can't grow memory without limit
+    client_queue: RelayQueue
+    server_queue: RelayQueue
+    # Tool calls and deferred response.create sends running in the background for this connection
+    tasks: set[asyncio.Task]
+    # What the upstream conversation holds, replayed onto a new upstream connection if the current one drops
+    log: SessionLog
+    reconnects: int
+    closed: bool
+
+    frames_to_server: int
+    frames_to_client: int
+    bytes_to_server: int
+    bytes_to_client: int
+    started_at: float
+    first_audio_at: Optional[float]
+    speech_stopped_at: Optional[float]
+
+    def __init__(self, client_ws: web.WebSocketResponse, client_request_id: Optional[str] = None, binary_audio: bool = False,
+                 media_adapter: Optional["AcsMediaAdapter"] = None, client_high_water: int = 256, server_high_water: int = 256,
+                 max_log_items: int = 200, vad: Optional["SilenceSuppressor"] = None,
+                 archive: Optional["SessionArchive"] = None):
+        self.client_ws = client_ws
+        self.server_ws = None
+        self.upstream = None
+        self.client_request_id = client_request_id
+        self.binary_audio = binary_audio
+        self.media_adapter = media_adapter
+        self.vad = vad
+        self.archive = archive
+        self.tools_pending = {}
+        self.tools = {}
+        self.config = None
+        self.client_queue = RelayQueue("to_client", client_high_water)
+        self.server_queue = RelayQueue("to_server", server_high_water)
+        self.tasks = set()
+        self.log = SessionLog(max_log_items)
+        self.reconnects = 0
+        self.closed = False
+        self.frames_to_server = 0
+        self.frames_to_client = 0
+        self.bytes_to_server = 0
+        self.bytes_to_client = 0
+        self.started_at = time.perf_counter()
+        self.first_audio_at = None
+        self.speech_stopped_at = None
+
+    @property
+    def transport(self) -> str:
+        if self.media_adapter is not None:
+            return "acs"
+        return "binary" if self.binary_audio else "json"
+
+    async def send_to_server(self, data: str, received: float):
+        self.frames_to_server += 1
+        self.bytes_to_server += len(data)
+        await self.server_ws.send_str(data)
+        metrics.FRAMES.inc(1, ("to_server",))
+        metrics.BYTES.inc(len(data), ("to_server",))
+        metrics.RELAY_LATENCY.observe(time.perf_counter() - received, ("to_server",))
+
+    async def send_to_client(self, data: str | bytes, received: float):
+        self.frames_to_client += 1
+        self.bytes_to_client += len(data)
+        if isinstance(data, bytes):
+            await self.client_ws.send_bytes(data)
+        else:
+            await self.client_ws.send_str(data)
+        metrics.FRAMES.inc(1, ("to_client",))
+        metrics.BYTES.inc(len(data), ("to_client",))
+        metrics.RELAY_LATENCY.observe(time.perf_counter() - received, ("to_client",))
+
+    def on_audio_delta(self, received: float):
+        if self.first_audio_at is None:
+            self.first_audio_at = received
+            metrics.TIME_TO_FIRST_AUDIO.observe(received - self.started_at)
+        if self.speech_stopped_at is not None:
+            metrics.RESPONSE_LATENCY.observe(received - self.speech_stopped_at)
+            self.speech_stopped_at = None
+
+    def create_task(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def cancel_tasks(self):
+        for task in list(self.tasks):
+            task.cancel()
+
+    async def close(self):
+        # Ends the call, unblock the writers and close both sockets. An upstream drop only gets here
+        # once resuming it has failed
+        if self.closed:
+            return
+        self.closed = True
+        await self.client_queue.close()
+        await self.server_queue.close()
+        if self.server_ws is not None and not self.server_ws.closed:
+            await self.server_ws.close()
+        if not self.client_ws.closed:
+            await self.client_ws.close()
 
 class RTMiddleTier:
     endpoint: str
     deployment: str
     key: Optional[str] = None
+    # Deployments new sessions are spread over, starts out with endpoint/deployment
+    upstreams: UpstreamPool
+    # Time allowed for opening the upstream websocket before failing over to another deployment
+    upstream_connect_timeout: float = 10
 
     # Tools are server-side only for now, though the case could be made for client-side tools
     # in addition to server-side tools that are invisible to the client
-    tools: dict[str, Tool] = {}
+    tools: dict[str, Tool]
 
     # Server-enforced configuration, if set, these will override the client's configuration
     # Typically at least the model name and system message will be set by the server
@@ -57,31 +291,303 @@ class RTMiddleTier:
     max_tokens: Optional[int] = None
     disable_audio: Optional[bool] = None
 
-    _tools_pending = {}
-    _token_provider = None
+    # Relay frames that need no rewriting without a full JSON parse/re-serialize
+    fast_relay: bool = True
+
+    # Per-session send buffer sizes in frames, past these queued audio is dropped oldest-first
+    client_queue_high_water: int = 256
+    server_queue_high_water: int = 256
+
+    # On shutdown, new sessions are refused and in-flight calls get this long to finish before being closed
+    drain_timeout: float = 90
+
+    # Tool calls run in the background so audio keeps flowing, bounded across all sessions of the worker
+    tool_timeout: float = 30
+    max_concurrent_tools: int = 16
+    # Minimum time between partial argument updates to the client, a completed argument is always sent
+    tool_stream_interval: float = 0.1
+
+    # Resume a session on a new upstream connection when the current one drops, the conversation is rebuilt
+    # from the session log (at most max_resume_items items). Needs input audio transcription, which is
+    # turned on for sessions that don't configure it themselves
+    resumable: bool = True
+    reconnect_attempts: int = 3
+    reconnect_backoff: float = 0.5
+    max_resume_items: int = 200
+
+    # Don't stream input audio upstream while nobody speaks, saves bandwidth and audio tokens. Sessions can
+    # override it with ?suppress_silence=1 or 0
+    suppress_silence: bool = False
+    silence_threshold_dbfs: float = -50
+    silence_preroll_ms: int = 300
+    silence_hangover_ms: int = 800
+
+    # Record every session's audio (both directions) and transcripts to a directory of its own under
+    # archive_dir, at most archive_max_buffered_bytes of it held in memory per session
+    archive_dir: Optional[str] = None
+    archive_max_buffered_bytes: int = 1 << 20
 
-    def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | DefaultAzureCredential):
+    # Limits on new sessions, see AdmissionController. Not limited when None
+    admission: Optional[AdmissionController] = None
+    # Resolves the token of an ACS media socket (?transport=acs&token=...) to the media settings of the call
+    # it was issued for, None for unknown tokens. Those sockets skip the per-user limits, the call was
+    # admitted on /call already. ACS sockets are refused when not set
+    acs_media_lookup: Optional[Callable[[str], Awaitable[Optional[dict[str, Any]]]]] = None
+
+    # Upstream connection pool, shared by all calls for the lifetime of the app
+    upstream_connection_limit: int = 1000
+    upstream_dns_cache_ttl: int = 300
+    upstream_keepalive_timeout: float = 30
+
+    _credentials = None
+    _token: Optional[AccessToken] = None
+    _token_refresher: Optional[asyncio.Task] = None
+    _client_session: Optional[aiohttp.ClientSession] = None
+    _tool_semaphore: Optional[asyncio.Semaphore] = None
+    _sessions: set[RTSession]
+    _draining: bool = False
+    _session_config: Optional[SessionConfig] = None
+    _session_config_key: Optional[tuple] = None
+
+    def __init__(self, endpoint: str, deployment: str, credentials: "AzureKeyCredential | DefaultAzureCredential"):
         self.endpoint = endpoint
         self.deployment = deployment
+        self.upstreams = UpstreamPool([Upstream(endpoint, deployment)])
+        self.tools = {}
+        self._sessions = set()
         if isinstance(credentials, AzureKeyCredential):
             self.key = credentials.key
         else:
-            self._token_provider = get_bearer_token_provider(credentials, "https://cognitiveservices.azure.com/.default")
-            self._token_provider() # Warm up during startup so we have a token cached when the first request arrives
+            # The token is fetched on app startup and kept fresh in the background, see attach_to_app
+            self._credentials = credentials
+
+    async def _refresh_token(self):
+        # Credential implementations do blocking network I/O, keep it off the event loop
+        self._token = await asyncio.to_thread(self._credentials.get_token, _TOKEN_SCOPE)
+
+    async def _token_refresh_loop(self):
+        while True:
+            try:
+                await self._refresh_token()
+            except Exception as e:
+                logger.warning("Refreshing the bearer token failed, retrying: %s", e)
+            delay = self._token.expires_on - time.time() - _TOKEN_REFRESH_MARGIN if self._token is not None else 0
+            await asyncio.sleep(max(delay, _TOKEN_RETRY_DELAY))
+
+    @property
+    def ready(self) -> bool:
+        # Whether new sessions can be served right away, for the readiness probe
+        return not self._draining and (self.key is not None or self._token is not None)
+
+    async def _get_auth_headers(self, upstream: Optional[Upstream] = None) -> dict[str, str]:
+        if upstream is not None and upstream.key is not None:
+            return { "api-key": upstream.key }
+        if self.key is not None:
+            return { "api-key": self.key }
+        if self._token is None or self._token.expires_on <= time.time():
+            # Only hit when the background refresher isn't running or is behind
+            await self._refresh_token()
+        return { "Authorization": f"Bearer {self._token.token}" }
+
+    def _get_client_session(self) -> aiohttp.ClientSession:
+        if self._client_session is None or self._client_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.upstream_connection_limit,
+                ttl_dns_cache=self.upstream_dns_cache_ttl,
+                keepalive_timeout=self.upstream_keepalive_timeout)
+            self._client_session = aiohttp.ClientSession(connector=connector)
+        return self._client_session
+
+    async def _on_startup(self, app: web.Application):
+        self._get_client_session()
+        # Built now rather than by the first call, rebuilt on its own if tools or prompts change later
+        self.session_config
+        if self._credentials is not None:
+            # Fetched in the background so the app starts accepting sockets straight away, the readiness
+            # probe holds traffic back until the first token is in
+            self._token_refresher = asyncio.create_task(self._token_refresh_loop())
+
+    async def _on_shutdown(self, app: web.Application):
+        self._draining = True
+        deadline = time.monotonic() + self.drain_timeout
+        if len(self._sessions) > 0:
+            logger.info("Draining %d realtime sessions", len(self._sessions))
+        while len(self._sessions) > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        for rt_session in list(self._sessions):
+            await rt_session.client_ws.close(code=aiohttp.WSCloseCode.GOING_AWAY, message=b"Server shutting down")
 
-    async def _process_message_to_client(self, msg: str, client_ws: web.WebSocketResponse, server_ws: web.WebSocketResponse) -> Optional[str]:
+    async def _on_cleanup(self, app: web.Application):
+        if self._token_refresher is not None:
+            self._token_refresher.cancel()
+            self._token_refresher = None
+        if self._client_session is not None:
+            await self._client_session.close()
+            self._client_session = None
+
+    async def _invoke_tool(self, tool: Tool, args: Any) -> ToolResult:
+        if asyncio.iscoroutinefunction(tool.target):
+            return await tool.target(args)
+        # Sync implementations would block the relay, run them on the default thread pool
+        result = await asyncio.to_thread(tool.target, args)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    def _session_tools(self, rt_session: RTSession) -> dict[str, Tool]:
+        return { **self.tools, **rt_session.tools } if len(rt_session.tools) > 0 else self.tools
+
+    @property
+    def session_config(self) -> SessionConfig:
+        # Tools and prompts may be swapped at any time, replace Tool objects rather than editing their schema
+        key = (self.system_message, self.temperature, self.max_tokens, self.disable_audio, self.resumable, tuple(self.tools.values()))
+        if self._session_config is None or key != self._session_config_key:
+            version = self._session_config.version + 1 if self._session_config is not None else 1
+            self._session_config = self._build_session_config(version)
+            self._session_config_key = key
+            logger.info("Session configuration version %d", version)
+        return self._session_config
+
+    def _build_session_config(self, version: int) -> SessionConfig:
+        overrides = {}
+        if self.system_message is not None:
+            overrides["instructions"] = self.system_message
+        if self.temperature is not None:
+            overrides["temperature"] = self.temperature
+        if self.max_tokens is not None:
+            overrides["max_response_output_tokens"] = self.max_tokens
+        if self.disable_audio is not None:
+            overrides["disable_audio"] = self.disable_audio
+        overrides["tool_choice"] = "auto" if len(self.tools) > 0 else "none"
+        overrides["tools"] = [tool.schema for tool in self.tools.values()]
+        # User audio can only be replayed as its transcript
+        defaults = { "input_audio_transcription": { "model": "whisper-1" } } if self.resumable else {}
+        return SessionConfig(version, overrides, defaults)
+
+    def _config_for(self, rt_session: RTSession) -> SessionConfig:
+        return rt_session.config if rt_session.config is not None else self.session_config
+
+    async def _send_tool_output(self, call_id: str, output: str, rt_session: RTSession):
+        await rt_session.server_queue.put(json.dumps({
+            "type": "conversation.item.create",
+            "item": {
+                "type": "function_call_output",
+                "call_id": call_id,
+                "output": output
+            }
+        }), time.perf_counter())
+
+    async def _run_tool(self, name: str, item: Any, tool_call: RTToolCall, rt_session: RTSession):
+        tool = self._session_tools(rt_session).get(name)
+        if tool is None:
+            # Every call needs an output, the response that follows the tool calls would wait for it forever
+            logger.warning("Model called unknown tool %s", name)
+            await self._send_tool_output(item["call_id"], json.dumps({ "error": f"Unknown tool '{name}'" }), rt_session)
+            return
+        try:
+            args = json.loads(item["arguments"])
+            errors = tool.validator(args) if tool.validator is not None else []
+        except json.JSONDecodeError as e:
+            args, errors = None, [f"Arguments are not valid JSON: {e}"]
+        if len(errors) > 0:
+            # Let the model correct itself straight away instead of running the tool with bad input
+            metrics.TOOL_DURATION.observe(0, (name, "invalid"))
+            await self._send_tool_output(item["call_id"], json.dumps({ "error": "Invalid arguments", "details": errors }), rt_session)
+            return
+
+        if self._tool_semaphore is None:
+            self._tool_semaphore = asyncio.Semaphore(self.max_concurrent_tools)
+        async with self._tool_semaphore:
+            outcome = "ok"
+            start = time.perf_counter()
+            with metrics.span("realtime.tool", tool=name, call_id=item["call_id"]):
+                try:
+                    result = await asyncio.wait_for(
+                        self._invoke_tool(tool, args),
+                        tool.timeout if tool.timeout is not None else self.tool_timeout)
+                except asyncio.TimeoutError:
+                    logger.warning("Tool %s timed out", name)
+                    outcome = "timeout"
+                    result = ToolResult({ "error": f"Tool '{name}' timed out" }, ToolResultDirection.TO_SERVER)
+                except Exception as e:
+                    logger.exception("Tool %s failed", name)
+                    outcome = "error"
+                    result = ToolResult({ "error": f"Tool '{name}' failed: {e}" }, ToolResultDirection.TO_SERVER)
+            metrics.TOOL_DURATION.observe(time.perf_counter() - start, (name, outcome))
+
+        if result.session_tools:
+            # Goes out before the tool output, so the response that follows already sees the new tools
+            rt_session.tools.update(result.session_tools)
+            rt_session.config = self.session_config.with_tools([tool.schema for tool in self._session_tools(rt_session).values()])
+            await rt_session.server_queue.put(rt_session.config.tools_update, time.perf_counter())
+
+        await self._send_tool_output(item["call_id"], result.to_text() if result.destination == ToolResultDirection.TO_SERVER else "", rt_session)
+        if result.destination == ToolResultDirection.TO_CLIENT and rt_session.media_adapter is None:
+            # TODO: this will break clients that don't know about this extra message, rewrite
+            # this to be a regular text message with a special marker of some sort
+            await rt_session.client_queue.put(json.dumps({
+                "type": "extension.middle_tier_tool_response",
+                "previous_item_id": tool_call.previous_id,
+                "tool_name": name,
+                "tool_result": result.to_text()
+            }), time.perf_counter())
+
+    async def _create_response_after_tools(self, tool_calls: list[RTToolCall], rt_session: RTSession):
+        # The model only gets to continue once every tool call of the response has reported its output
+        await asyncio.gather(*(tool_call.task for tool_call in tool_calls if tool_call.task is not None), return_exceptions=True)
+        await rt_session.server_queue.put(json.dumps({
+            "type": "response.create"
+        }), time.perf_counter())
+
+    async def _on_arguments_delta(self, tool_call: RTToolCall, delta: str, rt_session: RTSession):
+        try:
+            completed = tool_call.arguments.feed(delta)
+        except ValueError:
+            # Left to the full parse once the call is done, which reports the problem to the model
+            tool_call.arguments = None
+            return
+        tool = self._session_tools(rt_session).get(tool_call.name)
+        if tool is None:
+            return
+        if tool.prefetch is not None:
+            for name in completed:
+                rt_session.create_task(self._prefetch(tool, name, tool_call.arguments.values[name]))
+        if tool.stream_arguments and rt_session.media_adapter is None:
+            now = time.perf_counter()
+            if len(completed) > 0 or now - tool_call.streamed_at >= self.tool_stream_interval:
+                snapshot = tool_call.arguments.snapshot()
+                if len(snapshot) == 0:
+                    return
+                tool_call.streamed_at = now
+                await rt_session.client_queue.put(json.dumps({
+                    "type": "extension.middle_tier_tool_response",
+                    "previous_item_id": tool_call.previous_id,
+                    "tool_name": tool_call.name,
+                    "tool_result": json.dumps(snapshot),
+                    "partial": True
+                }), now)
+
+    async def _prefetch(self, tool: Tool, name: str, value: Any):
+        try:
+            await tool.prefetch(name, value)
+        except Exception:
+            # Only a head start, the tool loads whatever is missing itself
+            logger.exception("Prefetch for argument %s failed", name)
+
+    async def _process_message_to_client(self, msg: str, rt_session: RTSession) -> Optional[str]:
+        if self.fast_relay:
+            message_type = _peek_type(msg.data)
+            if message_type is not None and message_type not in _CLIENT_INTERCEPT_TYPES:
+                return msg.data
         message = json.loads(msg.data)
         updated_message = msg.data
         if message is not None:
             match message["type"]:
                 case "session.created":
-                    session = message["session"]
-                    # Hide the instructions, tools and max tokens from clients, if we ever allow client-side
-                    # tools, this will need updating
-                    session["instructions"] = ""
-                    session["tools"] = []
-                    session["tool_choice"] = "none"
-                    session["max_response_output_tokens"] = None
+                    if rt_session.reconnects > 0:
+                        # The client is still on the session it was told about first
+                        return None
+                    SessionConfig.redact(message["session"])
                     updated_message = json.dumps(message)
 
                 case "response.output_item.added":
@@ -89,125 +595,387 @@ class RTMiddleTier:
                         updated_message = None
 
                 case "conversation.item.created":
-                    if "item" in message and message["item"]["type"] == "function_call":
+                    if "item" in message and rt_session.log.is_replay_echo(message["item"]["id"]):
+                        # The client already has this item, it's only being put back after a reconnect
+                        rt_session.log.on_item_created(message["item"])
+                        updated_message = None
+                    elif "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
-                        if item["call_id"] not in self._tools_pending:
-                            self._tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"])
+                        rt_session.log.on_item_created(item)
+                        if item["call_id"] not in rt_session.tools_pending:
+                            tool_call = rt_session.tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"], item["name"])
+                            tool = self._session_tools(rt_session).get(item["name"])
+                            if tool is not None and (tool.stream_arguments or tool.prefetch is not None):
+                                tool_call.arguments = ArgumentStream()
                         updated_message = None
                     elif "item" in message and message["item"]["type"] == "function_call_output":
+                        rt_session.log.on_item_created(message["item"])
                         updated_message = None
+                    elif "item" in message:
+                        rt_session.log.on_item_created(message["item"])
+
+                case "conversation.item.input_audio_transcription.completed":
+                    rt_session.log.on_transcript(message["item_id"], message["transcript"])
+                    if rt_session.archive is not None:
+                        rt_session.archive.add_transcript("user", message["item_id"], message["transcript"])
 
                 case "response.function_call_arguments.delta":
+                    tool_call = rt_session.tools_pending.get(message.get("call_id"))
+                    if tool_call is not None and tool_call.arguments is not None:
+                        await self._on_arguments_delta(tool_call, message["delta"], rt_session)
                     updated_message = None
 
                 case "response.function_call_arguments.done":
                     updated_message = None
 
                 case "response.output_item.done":
+                    if "item" in message:
+                        rt_session.log.on_item_done(message["item"])
+                    if "item" in message and message["item"]["type"] == "message" and rt_session.archive is not None:
+                        rt_session.archive.add_transcript(message["item"]["role"], message["item"]["id"], item_text(message["item"]))
                     if "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
-                        tool_call = self._tools_pending[message["item"]["call_id"]]
-                        tool = self.tools[item["name"]]
-                        args = item["arguments"]
-                        result = await tool.target(json.loads(args))
-                        await server_ws.send_json({
-                            "type": "conversation.item.create",
-                            "item": {
-                                "type": "function_call_output",
-                                "call_id": item["call_id"],
-                                "output": result.to_text() if result.destination == ToolResultDirection.TO_SERVER else ""
-                            }
-                        })
-                        if result.destination == ToolResultDirection.TO_CLIENT:
-                            # TODO: this will break clients that don't know about this extra message, rewrite
-                            # this to be a regular text message with a special marker of some sort
-                            await client_ws.send_json({
-                                "type": "extension.middle_tier_tool_response",
-                                "previous_item_id": tool_call.previous_id,
-                                "tool_name": item["name"],
-                                "tool_result": result.to_text()
-                            })
+                        tool_call = rt_session.tools_pending[message["item"]["call_id"]]
+                        tool_call.task = rt_session.create_task(self._run_tool(item["name"], item, tool_call, rt_session))
                         updated_message = None
 
+                case "response.created":
+                    rt_session.log.response_in_progress = True
+
                 case "response.done":
-                    if len(self._tools_pending) > 0:
-                        self._tools_pending.clear() # Any chance tool calls could be interleaved across different outstanding responses?
-                        await server_ws.send_json({
-                            "type": "response.create"
-                        })
+                    rt_session.log.response_in_progress = False
+                    if len(rt_session.tools_pending) > 0:
+                        # All tool calls of this response have been dispatched by now, hand them off and clear
+                        # so calls of a later response are tracked separately
+                        tool_calls = list(rt_session.tools_pending.values())
+                        rt_session.tools_pending.clear()
+                        rt_session.create_task(self._create_response_after_tools(tool_calls, rt_session))
                     if "response" in message:
-                        replace = False
-                        for i, output in enumerate(reversed(message["response"]["output"])):
-                            if output["type"] == "function_call":
-                                message["response"]["output"].pop(i)
-                                replace = True
-                        if replace:
+                        # Tool calls are the middle tier's business, the client never saw them
+                        output = message["response"]["output"]
+                        kept = [item for item in output if item["type"] != "function_call"]
+                        if len(kept) < len(output):
+                            message["response"]["output"] = kept
                             updated_message = json.dumps(message)
 
         return updated_message
 
-    async def _process_message_to_server(self, msg: str, ws: web.WebSocketResponse) -> Optional[str]:
+    def _suppress_silence(self, data: str, rt_session: RTSession) -> Optional[str]:
+        pcm = _extract_appended_audio(data)
+        kept = rt_session.vad.process(pcm)
+        if kept is None:
+            return None
+        # Only re-encoded when buffered preroll goes out with this chunk
+        return data if kept is pcm else _audio_append_message(kept)
+
+    async def _process_message_to_server(self, msg: str, rt_session: RTSession) -> Optional[str]:
+        if self.fast_relay:
+            message_type = _peek_type(msg.data)
+            if message_type == "input_audio_buffer.append" and rt_session.vad is not None:
+                return self._suppress_silence(msg.data, rt_session)
+            if message_type is not None and message_type not in _SERVER_INTERCEPT_TYPES:
+                return msg.data
         message = json.loads(msg.data)
         updated_message = msg.data
         if message is not None:
             match message["type"]:
                 case "session.update":
-                    session = message["session"]
-                    if self.system_message is not None:
-                        session["instructions"] = self.system_message
-                    if self.temperature is not None:
-                        session["temperature"] = self.temperature
-                    if self.max_tokens is not None:
-                        session["max_response_output_tokens"] = self.max_tokens
-                    if self.disable_audio is not None:
-                        session["disable_audio"] = self.disable_audio
-                    session["tool_choice"] = "auto" if len(self.tools) > 0 else "none"
-                    session["tools"] = [tool.schema for tool in self.tools.values()]
-                    message["session"] = session
-                    updated_message = json.dumps(message)
+                    session = message.get("session") or {}
+                    if "turn_detection" in session and session["turn_detection"] is None:
+                        # The client commits the input buffer itself, every bit of audio it sent has to be there
+                        rt_session.vad = None
+                    updated_message = self._config_for(rt_session).merge(message)
+                    rt_session.log.record_session_update(updated_message)
+
+                case "input_audio_buffer.append":
+                    if rt_session.vad is not None:
+                        updated_message = self._suppress_silence(msg.data, rt_session)
 
         return updated_message
 
-    async def _forward_messages(self, ws: web.WebSocketResponse):
-        async with aiohttp.ClientSession(base_url=self.endpoint) as session:
-            params = { "api-version": "2024-10-01-preview", "deployment": self.deployment }
-            headers = {}
-            if "x-ms-client-request-id" in ws.headers:
-                headers["x-ms-client-request-id"] = ws.headers["x-ms-client-request-id"]
-            if self.key is not None:
-                headers = { "api-key": self.key }
-            else:
-                headers = { "Authorization": f"Bearer {self._token_provider()}" } # NOTE: no async version of token provider, maybe refresh token on a timer?
-            async with session.ws_connect("/openai/realtime", headers=headers, params=params) as target_ws:
-                async def from_client_to_server():
+    async def _connect_upstream(self, rt_session: RTSession) -> aiohttp.ClientWebSocketResponse:
+        # Tries the healthiest deployment first and fails over to the next one on throttling, server errors
+        # or a slow connect
+        tried: set[Upstream] = set()
+        error: Optional[Exception] = None
+        while (upstream := self.upstreams.select(tried)) is not None:
+            tried.add(upstream)
+            params = { "api-version": "2024-10-01-preview", "deployment": upstream.deployment }
+            # Every way out of an attempt settles the upstream, a trial connect left half open would keep
+            # it out of rotation for good
+            try:
+                headers = await self._get_auth_headers(upstream)
+                if rt_session.client_request_id is not None:
+                    headers["x-ms-client-request-id"] = rt_session.client_request_id
+                start = time.perf_counter()
+                server_ws = await asyncio.wait_for(
+                    self._get_client_session().ws_connect(upstream.url, headers=headers, params=params),
+                    self.upstream_connect_timeout)
+            except aiohttp.WSServerHandshakeError as e:
+                self.upstreams.failed(upstream, str(e.status))
+                if e.status not in RETRYABLE_STATUSES:
+                    # Bad credentials or deployment name, another attempt won't help
+                    raise
+                error = e
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.upstreams.failed(upstream, "timeout" if isinstance(e, asyncio.TimeoutError) else "connect")
+                error = e
+                continue
+            except BaseException:
+                # Cancelled, or no token to connect with, which says nothing about the deployment
+                self.upstreams.abandoned(upstream)
+                raise
+            self.upstreams.connected(upstream, time.perf_counter() - start)
+            rt_session.upstream = upstream
+            if len(tried) > 1:
+                logger.info("Connected to %s after failing over", upstream.name)
+            return server_ws
+        raise error if error is not None else aiohttp.ClientError("No realtime upstream available")
+
+    def _release_upstream(self, rt_session: RTSession):
+        if rt_session.upstream is not None:
+            self.upstreams.released(rt_session.upstream, dropped=not rt_session.closed)
+            rt_session.upstream = None
+
+    async def _replay_session(self, rt_session: RTSession):
+        # Sent ahead of anything the client queued while the upstream was away
+        for frame in rt_session.log.replay_frames():
+            await rt_session.send_to_server(frame, time.perf_counter())
+        if rt_session.config is not None:
+            await rt_session.send_to_server(rt_session.config.tools_update, time.perf_counter())
+        # The interrupted response is lost, continue from its completed tool calls or start it over
+        tool_calls = [tool_call for tool_call in rt_session.tools_pending.values() if tool_call.task is not None]
+        rt_session.tools_pending.clear()
+        if len(tool_calls) > 0:
+            rt_session.create_task(self._create_response_after_tools(tool_calls, rt_session))
+        elif rt_session.log.response_in_progress:
+            await rt_session.send_to_server(json.dumps({ "type": "response.create" }), time.perf_counter())
+        rt_session.log.response_in_progress = False
+
+    async def _reconnect_upstream(self, rt_session: RTSession) -> bool:
+        for attempt in range(self.reconnect_attempts):
+            await asyncio.sleep(self.reconnect_backoff * 2 ** attempt)
+            if rt_session.closed or self._draining:
+                return False
+            try:
+                rt_session.server_ws = await self._connect_upstream(rt_session)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Reconnecting to the realtime API failed (attempt %d): %s", attempt + 1, e)
+                continue
+            rt_session.reconnects += 1
+            await self._replay_session(rt_session)
+            metrics.UPSTREAM_RECONNECTS.inc(1, ("ok",))
+            logger.info("Resumed realtime session on a new upstream connection")
+            return True
+        metrics.UPSTREAM_RECONNECTS.inc(1, ("failed",))
+        return False
+
+    async def _forward_messages(self, rt_session: RTSession):
+        ws = rt_session.client_ws
+        with metrics.span("realtime.session", deployment=self.deployment, transport=rt_session.transport) as session_span:
+            rt_session.server_ws = await self._connect_upstream(rt_session)
+            if session_span is not None:
+                # Failover may have picked another deployment than the primary one
+                session_span.set_attribute("deployment", rt_session.upstream.deployment)
+                session_span.set_attribute("upstream", rt_session.upstream.name)
+
+            if rt_session.media_adapter is not None:
+                # ACS never configures the session, apply the server-side configuration on its behalf
+                session_update = aiohttp.WSMessage(aiohttp.WSMsgType.TEXT, json.dumps({
+                    "type": "session.update",
+                    "session": { "turn_detection": { "type": "server_vad" } }
+                }), None)
+                await rt_session.server_queue.put(await self._process_message_to_server(session_update, rt_session), time.perf_counter())
+
+            async def from_client_to_server():
+                try:
                     async for msg in ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_server(msg, ws)
-                            if new_msg is not None:
-                                await target_ws.send_str(new_msg)
+                        received = time.perf_counter()
+                        droppable = True
+                        if msg.type == aiohttp.WSMsgType.TEXT and rt_session.media_adapter is not None:
+                            new_msg = rt_session.media_adapter.to_realtime(msg.data)
+                            if new_msg is not None and rt_session.archive is not None:
+                                rt_session.archive.add_audio("inbound", _extract_appended_audio(new_msg))
+                            if new_msg is not None and rt_session.vad is not None:
+                                new_msg = self._suppress_silence(new_msg, rt_session)
+                        elif msg.type == aiohttp.WSMsgType.TEXT:
+                            droppable = _peek_type(msg.data) == "input_audio_buffer.append"
+                            if droppable and rt_session.archive is not None:
+                                rt_session.archive.add_audio("inbound", _extract_appended_audio(msg.data))
+                            new_msg = await self._process_message_to_server(msg, rt_session)
+                        elif msg.type == aiohttp.WSMsgType.BINARY and rt_session.binary_audio:
+                            if rt_session.archive is not None:
+                                rt_session.archive.add_audio("inbound", msg.data)
+                            pcm = rt_session.vad.process(msg.data) if rt_session.vad is not None else msg.data
+                            new_msg = _audio_append_message(pcm) if pcm is not None else None
                         else:
                             print("Error: unexpected message type:", msg.type)
+                            continue
+                        if new_msg is not None:
+                            await rt_session.server_queue.put(new_msg, received, droppable)
+                finally:
+                    await rt_session.close()
+
+            async def from_server_to_client(target_ws: aiohttp.ClientWebSocketResponse):
+                async for msg in target_ws:
+                    received = time.perf_counter()
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        print("Error: unexpected message type:", msg.type)
+                        continue
+                    message_type = _peek_type(msg.data)
+                    if message_type == "response.audio.delta":
+                        rt_session.on_audio_delta(received)
+                        if rt_session.archive is not None:
+                            rt_session.archive.add_audio("outbound", _extract_audio_delta(msg.data))
+                    elif message_type == "input_audio_buffer.speech_stopped":
+                        rt_session.speech_stopped_at = received
+                    elif message_type == "input_audio_buffer.speech_started":
+                        # Barge-in, assistant audio still queued for the client is stale now
+                        await rt_session.client_queue.discard_droppable("barge_in")
 
-                async def from_server_to_client():
-                    async for msg in target_ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_client(msg, ws, target_ws)
-                            if new_msg is not None:
-                                await ws.send_str(new_msg)
+                    if rt_session.media_adapter is not None:
+                        audio = _extract_audio_delta(msg.data)
+                        if audio is not None:
+                            new_msg = rt_session.media_adapter.from_realtime_audio(audio)
+                        elif message_type == "input_audio_buffer.speech_started":
+                            new_msg = rt_session.media_adapter.stop_audio()
                         else:
-                            print("Error: unexpected message type:", msg.type)
+                            # Still run tool handling, but ACS only understands audio so nothing else is forwarded
+                            await self._process_message_to_client(msg, rt_session)
+                            continue
+                    elif rt_session.binary_audio and (audio := _extract_audio_delta(msg.data)) is not None:
+                        new_msg = audio
+                    else:
+                        new_msg = await self._process_message_to_client(msg, rt_session)
+                    if new_msg is not None:
+                        await rt_session.client_queue.put(new_msg, received, message_type == "response.audio.delta")
+
+            async def to_server_writer(target_ws: aiohttp.ClientWebSocketResponse):
+                try:
+                    while (frame := await rt_session.server_queue.get()) is not None:
+                        await rt_session.send_to_server(*frame)
+                finally:
+                    # A failed send ends the reader as well, it's handled the same as the upstream dropping
+                    await target_ws.close()
+
+            async def upstream():
+                # One pass per upstream connection, the client side and the queues outlive reconnects
+                try:
+                    while True:
+                        target_ws = rt_session.server_ws
+                        writer = asyncio.create_task(to_server_writer(target_ws))
+                        try:
+                            await from_server_to_client(target_ws)
+                        except (aiohttp.ClientError, ConnectionResetError) as e:
+                            logger.warning("Realtime upstream connection failed: %s", e)
+                        finally:
+                            writer.cancel()
+                            await asyncio.gather(writer, return_exceptions=True)
+                            self._release_upstream(rt_session)
+                        if rt_session.closed or not self.resumable or self._draining:
+                            return
+                        logger.warning("Realtime upstream closed the connection (code %s), reconnecting", target_ws.close_code)
+                        if not await self._reconnect_upstream(rt_session):
+                            return
+                finally:
+                    await rt_session.close()
 
+            async def to_client_writer():
                 try:
-                    await asyncio.gather(from_client_to_server(), from_server_to_client())
-                except ConnectionResetError:
-                    # Ignore the errors resulting from the client disconnecting the socket
-                    pass
+                    while (frame := await rt_session.client_queue.get()) is not None:
+                        await rt_session.send_to_client(*frame)
+                finally:
+                    await rt_session.close()
+
+            try:
+                await asyncio.gather(from_client_to_server(), upstream(), to_client_writer())
+            except ConnectionResetError:
+                # Ignore the errors resulting from the client disconnecting the socket
+                pass
+            finally:
+                # Don't leave tools running (or writing to closed sockets) once the call is over
+                rt_session.cancel_tasks()
+                await rt_session.close()
+                self._release_upstream(rt_session)
+
+    def _create_vad(self, request: web.Request) -> Optional["SilenceSuppressor"]:
+        enabled = request.query.get("suppress_silence")
+        if not (enabled in ("1", "true") if enabled is not None else self.suppress_silence):
+            return None
+        from backend.vad import SilenceSuppressor
+        return SilenceSuppressor(
+            threshold_dbfs=self.silence_threshold_dbfs,
+            preroll_ms=self.silence_preroll_ms,
+            hangover_ms=self.silence_hangover_ms)
+
+    def _create_archive(self, request: web.Request) -> Optional["SessionArchive"]:
+        if self.archive_dir is None:
+            return None
+        from backend.archive import SessionArchive
+        session_id = request.headers.get("x-ms-client-request-id", "")
+        if not _CLIENT_REQUEST_ID.fullmatch(session_id):
+            session_id = str(uuid.uuid4())
+        directory = os.path.join(self.archive_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{session_id}")
+        return SessionArchive(directory, max_buffered_bytes=self.archive_max_buffered_bytes)
 
     async def _websocket_handler(self, request: web.Request):
+        if self._draining:
+            # Let the load balancer retry on a replica that isn't going away
+            return web.Response(status=503, text="Server is shutting down")
+        acs_media = None
+        if request.query.get("transport") == "acs":
+            token = request.query.get("token")
+            if token and self.acs_media_lookup is not None:
+                acs_media = await self.acs_media_lookup(token)
+            if acs_media is None:
+                return web.Response(status=403, text="Unknown media session")
+        lease = None
+        if self.admission is not None:
+            try:
+                lease = await self.admission.acquire(None if acs_media is not None else client_key(request))
+            except AdmissionRejected as e:
+                # Rejected before the upgrade, so clients see the status code and Retry-After
+                return e.response()
+        try:
+            return await self._serve_session(request, acs_media)
+        finally:
+            if lease is not None:
+                lease.release()
+
+    async def _serve_session(self, request: web.Request, acs_media: Optional[dict[str, Any]]) -> web.WebSocketResponse:
         ws = web.WebSocketResponse()
         await ws.prepare(request)
-        await self._forward_messages(ws)
+        media_adapter = None
+        if acs_media is not None:
+            from backend.acsmedia import AcsMediaAdapter
+            media_adapter = AcsMediaAdapter(acs_media["sample_rate"])
+        rt_session = RTSession(
+            ws,
+            request.headers.get("x-ms-client-request-id"),
+            binary_audio=request.query.get("audio") == "binary",
+            media_adapter=media_adapter,
+            client_high_water=self.client_queue_high_water,
+            server_high_water=self.server_queue_high_water,
+            max_log_items=self.max_resume_items,
+            vad=self._create_vad(request),
+            archive=self._create_archive(request))
+        metrics.SESSIONS_TOTAL.inc()
+        metrics.SESSIONS_ACTIVE.inc()
+        self._sessions.add(rt_session)
+        if rt_session.archive is not None:
+            rt_session.archive.start()
+        try:
+            await self._forward_messages(rt_session)
+        finally:
+            self._sessions.discard(rt_session)
+            metrics.SESSIONS_ACTIVE.dec()
+            if rt_session.archive is not None:
+                await rt_session.archive.close()
         return ws
 
     def attach_to_app(self, app, path):
         app.router.add_get(path, self._websocket_handler)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        app.on_cleanup.append(self._on_cleanup)
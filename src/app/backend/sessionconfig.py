@@ -0,0 +1,64 @@
+import json
+from types import MappingProxyType
+from typing import Any, Mapping
+
+# What clients get to see of the session in session.created, the server-side configuration stays hidden.
+# If we ever allow client-side tools, this will need updating
+_REDACTED = MappingProxyType({
+    "instructions": "",
+    "tools": [],
+    "tool_choice": "none",
+    "max_response_output_tokens": None,
+})
+
+class SessionConfig:
+    # The server side of session.update, serialized once per configuration instead of once per call. Never
+    # changed after construction: when the prompt, parameters or tools change, a new version replaces it
+    version: int
+    # Always win over what the client asks for
+    overrides: Mapping[str, Any]
+    # Only applied when the client leaves them out
+    defaults: Mapping[str, Any]
+    # Ready to send session.update carrying just the tools, for tools installed mid-session
+    tools_update: str
+
+    def __init__(self, version: int, overrides: dict[str, Any], defaults: dict[str, Any]):
+        self.version = version
+        self.overrides = MappingProxyType(overrides)
+        self.defaults = MappingProxyType(defaults)
+        self.tools_update = json.dumps({
+            "type": "session.update",
+            "session": { "tool_choice": overrides["tool_choice"], "tools": overrides["tools"] }
+        })
+        # Members of the serialized objects without the braces, spliced into the client's session
+        self._overrides_json = json.dumps(overrides)[1:-1]
+        self._overrides_and_defaults_json = json.dumps({ **overrides, **defaults })[1:-1]
+
+    def with_tools(self, tools: list[Any]) -> "SessionConfig":
+        overrides = { **self.overrides, "tool_choice": "auto" if len(tools) > 0 else "none", "tools": tools }
+        return SessionConfig(self.version, overrides, dict(self.defaults))
+
+    def merge(self, message: dict[str, Any]) -> str:
+        # Serializes a client session.update with the server configuration applied. Only the client's own
+        # fields are encoded here, the prompt and tool schemas are copied in already serialized
+        session = message.pop("session", None) or {}
+        for key in self.overrides:
+            session.pop(key, None)
+        missing = [key for key in self.defaults if key not in session]
+        if len(missing) == len(self.defaults):
+            server_json = self._overrides_and_defaults_json
+        elif len(missing) == 0:
+            server_json = self._overrides_json
+        else:
+            server_json = json.dumps({ **self.overrides, **{ key: self.defaults[key] for key in missing } })[1:-1]
+        client_json = json.dumps(session)
+        if len(server_json) > 0:
+            session_json = "{" + server_json + "}" if client_json == "{}" else client_json[:-1] + ", " + server_json + "}"
+        else:
+            session_json = client_json
+        head = json.dumps(message)[:-1] + ", " if len(message) > 0 else "{"
+        return head + '"session": ' + session_json + "}"
+
+    @staticmethod
+    def redact(session: dict[str, Any]):
+        session.update(_REDACTED)
@@ -0,0 +1,99 @@
+import json
+from collections import OrderedDict
+from typing import Any, Optional
+
+def item_text(item: Any) -> str:
+    # Text of a message item, audio content counts by its transcript
+    parts = []
+    for content in item.get("content") or []:
+        text = content.get("text") or content.get("transcript")
+        if text:
+            parts.append(text)
+    return " ".join(parts)
+
+class SessionLog:
+    # Compact record of what the upstream conversation contains, enough to rebuild it on a new upstream
+    # connection: the last session.update sent and the completed conversation items as text
+    max_items: int
+    session_update: Optional[str]
+    response_in_progress: bool
+    # Ids of replayed items whose conversation.item.created echo hasn't arrived yet
+    replayed: set[str]
+
+    def __init__(self, max_items: int = 200):
+        self.max_items = max_items
+        self.session_update = None
+        self.response_in_progress = False
+        self.replayed = set()
+        # item_id -> replayable item, None values are items without usable content yet
+        self._items: OrderedDict[str, Optional[dict[str, Any]]] = OrderedDict()
+
+    def record_session_update(self, data: str):
+        self.session_update = data
+
+    def on_item_created(self, item: Any):
+        match item.get("type"):
+            case "message":
+                text = item_text(item)
+                self._put(item["id"], self._message(item["id"], item["role"], text) if text else None)
+            case "function_call" if item.get("arguments"):
+                # Created with its arguments, e.g. the echo of a replayed call, no output_item.done follows
+                self._put(item["id"], self._function_call(item))
+            case "function_call":
+                # Arguments are still streaming, the call is only replayable once on_item_done has it
+                self._put(item["id"], None)
+            case "function_call_output":
+                self._put(item["id"], { "id": item["id"], "type": "function_call_output", "call_id": item["call_id"], "output": item.get("output", "") })
+
+    def on_transcript(self, item_id: str, transcript: str):
+        # User audio only becomes replayable once it has been transcribed
+        if item_id in self._items and transcript:
+            self._items[item_id] = self._message(item_id, "user", transcript)
+
+    def on_item_done(self, item: Any):
+        if item.get("id") not in self._items:
+            return
+        match item.get("type"):
+            case "message":
+                text = item_text(item)
+                if text:
+                    self._items[item["id"]] = self._message(item["id"], item["role"], text)
+            case "function_call":
+                self._items[item["id"]] = self._function_call(item)
+
+    def replay_frames(self) -> list[str]:
+        # The log is emptied, the new connection echoes the replayed items back (same ids) and rebuilds it
+        frames = [self.session_update] if self.session_update is not None else []
+        call_ids = set()
+        for item in self._items.values():
+            if item is None:
+                continue
+            if item["type"] == "function_call":
+                call_ids.add(item["call_id"])
+            elif item["type"] == "function_call_output" and item["call_id"] not in call_ids:
+                # The call itself was trimmed or never completed, an orphan output would be rejected
+                continue
+            frames.append(json.dumps({ "type": "conversation.item.create", "item": item }))
+            self.replayed.add(item["id"])
+        self._items.clear()
+        return frames
+
+    def is_replay_echo(self, item_id: str) -> bool:
+        if item_id in self.replayed:
+            self.replayed.discard(item_id)
+            return True
+        return False
+
+    def _put(self, item_id: str, item: Optional[dict[str, Any]]):
+        self._items[item_id] = item
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    @staticmethod
+    def _function_call(item: Any) -> dict[str, Any]:
+        return { "id": item["id"], "type": "function_call", "call_id": item["call_id"], "name": item["name"], "arguments": item["arguments"] }
+
+    @staticmethod
+    def _message(item_id: str, role: str, text: str) -> dict[str, Any]:
+        content_type = "text" if role == "assistant" else "input_text"
+        return { "id": item_id, "type": "message", "role": role, "content": [{ "type": content_type, "text": text }] }
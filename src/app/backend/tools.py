@@ -1,10 +1,9 @@
+import hashlib
+import json
 import re
-from typing import Any
+from typing import Any, Callable
 
-from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential
-
-from backend.rtmt import RTMiddleTier, Tool, ToolResult, ToolResultDirection
+from backend.rtmt import Tool, ToolResult, ToolResultDirection
 
 async def _generate_report_tool(args: Any) -> ToolResult:
     report = {
@@ -63,3 +62,74 @@ _get_report_fields_tool_schema = {
         "additionalProperties": False
     }
 }
+
+# Template field types mapped to the JSON schema type the model sees and a check for the argument value
+_DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+_FIELD_TYPES: dict[str, tuple[dict[str, Any], Callable[[Any], bool], str]] = {
+    "string": ({ "type": "string" }, lambda value: isinstance(value, str), "a string"),
+    "date": ({ "type": "string" }, lambda value: isinstance(value, str) and _DATE_PATTERN.match(value) is not None, "a date formatted as YYYY-MM-DD"),
+    "number": ({ "type": "number" }, lambda value: isinstance(value, (int, float)) and not isinstance(value, bool), "a number"),
+    "integer": ({ "type": "integer" }, lambda value: isinstance(value, int) and not isinstance(value, bool), "an integer"),
+    "boolean": ({ "type": "boolean" }, lambda value: isinstance(value, bool), "true or false"),
+}
+
+class CompiledReportSchema:
+    # generate_report schema for one department template, with the argument checks built up front
+    schema: Any
+    _checks: list[tuple[str, Callable[[Any], bool], str]]
+
+    def __init__(self, schema: Any, checks: list[tuple[str, Callable[[Any], bool], str]]):
+        self.schema = schema
+        self._checks = checks
+
+    def validate(self, args: Any) -> list[str]:
+        if not isinstance(args, dict):
+            return ["Arguments must be a JSON object"]
+        errors = [f"'{name}' must be {expected}" for name, check, expected in self._checks
+                  if name not in args or not check(args[name])]
+        allowed = self.schema["parameters"]["properties"]
+        errors.extend(f"Unknown field '{name}'" for name in args if name not in allowed)
+        return errors
+
+def compile_report_tool_schema(template: Any) -> CompiledReportSchema:
+    properties = {}
+    checks = []
+    for field in template["fields"]:
+        json_type, check, expected = _FIELD_TYPES.get(field["type"], _FIELD_TYPES["string"])
+        description = field.get("description", field["name"])
+        if field["type"] == "date":
+            description += " (YYYY-MM-DD)"
+        properties[field["name"]] = { **json_type, "description": description }
+        checks.append((field["name"], check, expected))
+    schema = {
+        **_generate_report_tool_schema,
+        "description": f"Generates a JSON report for the {template['department']} department from the answers given in the conversation.",
+        "parameters": {
+            "type": "object",
+            "properties": properties,
+            "required": list(properties),
+            "additionalProperties": False
+        }
+    }
+    return CompiledReportSchema(schema, checks)
+
+class ReportSchemaRegistry:
+    # Compiled schemas are shared by all sessions of the worker and only rebuilt when a template changes
+    _compiled: dict[str, tuple[Any, str, CompiledReportSchema]]
+
+    def __init__(self):
+        self._compiled = {}
+
+    def get(self, template: Any) -> CompiledReportSchema:
+        # Keyed on the template document id. The schema cache hands out the same template object until it
+        # reloads it, so the fingerprint is only taken for a template not seen before
+        cached = self._compiled.get(template["id"])
+        if cached is not None and cached[0] is template:
+            return cached[2]
+        fingerprint = hashlib.sha1(json.dumps([template["department"], template["fields"]], sort_keys=True).encode("utf-8")).hexdigest()
+        if cached is not None and cached[1] == fingerprint:
+            compiled = cached[2]
+        else:
+            compiled = compile_report_tool_schema(template)
+        self._compiled[template["id"]] = (template, fingerprint, compiled)
+        return compiled
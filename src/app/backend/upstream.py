@@ -0,0 +1,148 @@
+import logging
+import random
+import time
+from collections import deque
+from typing import Optional
+from yarl import URL
+
+from backend import metrics
+
+logger = logging.getLogger("upstream")
+
+# Statuses that say "try another deployment", anything else (401, 404, ...) is a configuration problem
+RETRYABLE_STATUSES = frozenset({ 408, 429, 500, 502, 503, 504 })
+
+class Upstream:
+    # One Azure OpenAI realtime deployment and what we've recently seen of it
+    endpoint: str
+    deployment: str
+    # API key of this resource, falls back to the middle tier's credentials when not set
+    key: Optional[str]
+    url: str
+    name: str
+
+    active_sessions: int
+    # Exponentially weighted connect latency in seconds
+    connect_latency: float
+    consecutive_failures: int
+    open_until: float
+    open_for: float
+    half_open: bool
+
+    def __init__(self, endpoint: str, deployment: str, key: Optional[str] = None):
+        if not endpoint:
+            raise ValueError(f"No endpoint configured for realtime deployment {deployment!r}")
+        self.endpoint = endpoint
+        self.deployment = deployment
+        self.key = key
+        self.url = str(URL(endpoint).with_path("/openai/realtime"))
+        self.name = f"{deployment}@{URL(endpoint).host}"
+        self.active_sessions = 0
+        self.connect_latency = 0.0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.open_for = 0.0
+        self.half_open = False
+        # (monotonic time, ok) of recent connects and session outcomes
+        self._outcomes: deque[tuple[float, bool]] = deque()
+
+    def error_rate(self, window: float) -> float:
+        cutoff = time.monotonic() - window
+        while len(self._outcomes) > 0 and self._outcomes[0][0] < cutoff:
+            self._outcomes.popleft()
+        if len(self._outcomes) == 0:
+            return 0.0
+        return sum(1 for _, ok in self._outcomes if not ok) / len(self._outcomes)
+
+    def record(self, ok: bool):
+        self._outcomes.append((time.monotonic(), ok))
+
+class UpstreamPool:
+    # Picks a deployment per new session from live health: connect latency, recent 429/5xx/connect failure
+    # rate and sessions in flight. A deployment that keeps failing is taken out (circuit open) for a while,
+    # then gets a single trial connect (half open) before it's trusted again
+    upstreams: list[Upstream]
+    # Consecutive failures, or error rate within error_window, that open the circuit
+    failure_threshold: int = 3
+    error_window: float = 60
+    error_rate_threshold: float = 0.5
+    min_samples: int = 10
+    # Circuit open time, doubles on every failed trial up to max_open_time
+    open_time: float = 15
+    max_open_time: float = 300
+    latency_smoothing: float = 0.2
+
+    def __init__(self, upstreams: list[Upstream]):
+        self.upstreams = upstreams
+
+    def add(self, upstream: Upstream):
+        self.upstreams.append(upstream)
+
+    def _available(self, upstream: Upstream, now: float) -> bool:
+        if upstream.half_open:
+            # A trial connect is already under way
+            return False
+        return upstream.open_until <= now
+
+    def _score(self, upstream: Upstream) -> float:
+        # Lower is better. Unmeasured deployments start at a nominal 100 ms so they get tried
+        latency = upstream.connect_latency or 0.1
+        return latency * (1 + upstream.active_sessions) * (1 + 4 * upstream.error_rate(self.error_window))
+
+    def select(self, exclude: set[Upstream]) -> Optional[Upstream]:
+        now = time.monotonic()
+        candidates = [upstream for upstream in self.upstreams if upstream not in exclude and self._available(upstream, now)]
+        if len(candidates) == 0:
+            # Everything is open or already tried, rather attempt the least recently failed than give up
+            candidates = [upstream for upstream in self.upstreams if upstream not in exclude and not upstream.half_open]
+            if len(candidates) == 0:
+                return None
+            return min(candidates, key=lambda upstream: upstream.open_until)
+        # Best of two random picks, avoids sending every arrival of a burst to the same deployment
+        sample = random.sample(candidates, min(2, len(candidates)))
+        upstream = min(sample, key=self._score)
+        if upstream.open_until > 0:
+            upstream.half_open = True
+        return upstream
+
+    def connected(self, upstream: Upstream, latency: float):
+        upstream.connect_latency = latency if upstream.connect_latency == 0 else \
+            (1 - self.latency_smoothing) * upstream.connect_latency + self.latency_smoothing * latency
+        upstream.consecutive_failures = 0
+        if upstream.half_open or upstream.open_until > 0:
+            logger.info("Upstream %s recovered, closing the circuit", upstream.name)
+        upstream.half_open = False
+        upstream.open_until = 0.0
+        upstream.open_for = 0.0
+        upstream.record(True)
+        upstream.active_sessions += 1
+        metrics.UPSTREAM_CONNECT_LATENCY.observe(latency, (upstream.name,))
+        metrics.UPSTREAM_SESSIONS.inc(1, (upstream.name,))
+        metrics.UPSTREAM_CIRCUIT_OPEN.set(0, (upstream.name,))
+
+    def failed(self, upstream: Upstream, reason: str):
+        upstream.consecutive_failures += 1
+        upstream.record(False)
+        metrics.UPSTREAM_ERRORS.inc(1, (upstream.name, reason))
+        if upstream.open_until > time.monotonic() and not upstream.half_open:
+            # Connects started before the circuit opened, it's already out of rotation
+            return
+        tripped = upstream.half_open or upstream.consecutive_failures >= self.failure_threshold or (
+            len(upstream._outcomes) >= self.min_samples and upstream.error_rate(self.error_window) >= self.error_rate_threshold)
+        upstream.half_open = False
+        if tripped:
+            upstream.open_for = min(self.max_open_time, upstream.open_for * 2 if upstream.open_for > 0 else self.open_time)
+            upstream.open_until = time.monotonic() + upstream.open_for
+            metrics.UPSTREAM_CIRCUIT_OPEN.set(1, (upstream.name,))
+            logger.warning("Upstream %s failing (%s), circuit open for %.0fs", upstream.name, reason, upstream.open_for)
+
+    def abandoned(self, upstream: Upstream):
+        # A connect that was given up for reasons of our own, a trial slot goes back without a verdict
+        upstream.half_open = False
+
+    def released(self, upstream: Upstream, dropped: bool):
+        # A session left the deployment, dropped when the upstream closed on us rather than the client leaving
+        upstream.active_sessions -= 1
+        metrics.UPSTREAM_SESSIONS.dec(1, (upstream.name,))
+        if dropped:
+            self.failed(upstream, "dropped")
@@ -0,0 +1,103 @@
+from collections import deque
+from typing import Optional
+
+import numpy as np
+
+from backend import metrics
+
+# Analysis window, every chunk is judged by its loudest 10 ms
+_WINDOW_MS = 10
+
+class SilenceSuppressor:
+    # Energy/zero-crossing voice activity detection on inbound PCM16, so stretches where nobody speaks
+    # aren't streamed upstream. Audio just before speech (preroll) and after it (hangover) is still sent,
+    # the upstream turn detection needs both to find the start and end of a turn
+    sample_rate: int
+    # A window counts as speech when it's this loud, or snr_db above the tracked noise floor if that's louder
+    threshold_dbfs: float
+    snr_db: float
+    # The noise floor is the noise_percentile of the window energies over the last noise_window_ms, speech
+    # or not. Even continuous speech has pauses that fall into the quietest windows
+    noise_window_ms: int
+    noise_percentile: float
+    # Quieter windows can still be speech (fricatives), if they cross zero often enough. They must still be
+    # half of snr_db above the noise floor, hiss crosses zero as often as a fricative
+    fricative_margin_db: float
+    fricative_zcr: float
+    preroll_ms: int
+    hangover_ms: int
+
+    bytes_in: int
+    bytes_suppressed: int
+
+    def __init__(self, sample_rate: int = 24000, threshold_dbfs: float = -50, snr_db: float = 10, noise_window_ms: int = 5000,
+                 noise_percentile: float = 10, fricative_margin_db: float = 10, fricative_zcr: float = 0.25, preroll_ms: int = 300,
+                 hangover_ms: int = 800):
+        self.sample_rate = sample_rate
+        self.threshold_dbfs = threshold_dbfs
+        self.snr_db = snr_db
+        self.noise_window_ms = noise_window_ms
+        self.noise_percentile = noise_percentile
+        self.fricative_margin_db = fricative_margin_db
+        self.fricative_zcr = fricative_zcr
+        self.preroll_ms = preroll_ms
+        self.hangover_ms = hangover_ms
+        self.bytes_in = 0
+        self.bytes_suppressed = 0
+        self._window = sample_rate * _WINDOW_MS // 1000
+        self._energies: deque[float] = deque(maxlen=max(1, noise_window_ms // _WINDOW_MS))
+        self._preroll: deque[bytes] = deque()
+        self._preroll_bytes = 0
+        # Bytes of audio still to send after the last speech was heard
+        self._hangover_left = 0
+
+    def _bytes_for(self, ms: int) -> int:
+        return self.sample_rate * ms // 1000 * 2
+
+    def is_speech(self, pcm: bytes) -> bool:
+        samples = np.frombuffer(pcm, dtype="<i2")
+        usable = len(samples) - len(samples) % self._window
+        if usable == 0:
+            windows = samples.astype(np.float32).reshape(1, -1)
+        else:
+            windows = samples[:usable].astype(np.float32).reshape(-1, self._window)
+        rms = np.sqrt(np.mean(windows * windows, axis=1)) + 1e-9
+        energy_db = 20 * np.log10(rms / 32768)
+        signs = np.signbit(windows)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1) if windows.shape[1] > 1 else np.zeros(len(windows))
+        # Judged against the windows before this chunk, the very first chunk has only the absolute threshold
+        if len(self._energies) > 0:
+            noise_floor_db = float(np.percentile(np.fromiter(self._energies, np.float64, len(self._energies)), self.noise_percentile))
+            threshold = max(self.threshold_dbfs, noise_floor_db + self.snr_db)
+            fricative_threshold = max(threshold - self.fricative_margin_db, noise_floor_db + self.snr_db / 2)
+        else:
+            threshold = self.threshold_dbfs
+            fricative_threshold = threshold - self.fricative_margin_db
+        self._energies.extend(energy_db.tolist())
+        speech = (energy_db > threshold) | ((energy_db > fricative_threshold) & (zcr > self.fricative_zcr))
+        return bool(speech.any())
+
+    def process(self, pcm: bytes) -> Optional[bytes]:
+        # Returns the audio to send for this chunk, None when it's suppressed
+        self.bytes_in += len(pcm)
+        if self.is_speech(pcm):
+            self._hangover_left = self._bytes_for(self.hangover_ms)
+            if self._preroll_bytes > 0:
+                self._preroll.append(pcm)
+                pcm = b"".join(self._preroll)
+                self._preroll.clear()
+                self._preroll_bytes = 0
+            return pcm
+        if self._hangover_left > 0:
+            self._hangover_left -= len(pcm)
+            return pcm
+        # Silence, keep the most recent bit in case speech starts with the next chunk
+        self._preroll.append(pcm)
+        self._preroll_bytes += len(pcm)
+        limit = self._bytes_for(self.preroll_ms)
+        while self._preroll_bytes - len(self._preroll[0]) >= limit:
+            dropped = self._preroll.popleft()
+            self._preroll_bytes -= len(dropped)
+            self.bytes_suppressed += len(dropped)
+            metrics.AUDIO_SUPPRESSED.inc(len(dropped))
+        return None
@@ -0,0 +1,38 @@
+import math
+import os
+from typing import Optional
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+def _available_cpus() -> int:
+    # multiprocessing.cpu_count() reports the host's cores, a container is limited by its cgroup CPU quota
+    # and the CPUs it may be scheduled on
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    # cgroup v2 has "<quota> <period>" in one file, v1 splits them
+    limit = _read("/sys/fs/cgroup/cpu.max")
+    if limit is not None:
+        quota, _, period = limit.partition(" ")
+    else:
+        quota, period = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"), _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and quota not in ("max", "-1"):
+        cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    return cpus
+
+# Production serving settings, see Dockerfile. Each worker runs its own event loop, so size to the cores
+# available to the container. ACS call state is per worker unless it lives in the shared call store
+# (CALL_STORE_REDIS_URL), without one a callback landing on another worker wouldn't find its call
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", _available_cpus() if os.environ.get("CALL_STORE_REDIS_URL") else 1))
+worker_class = "aiohttp.GunicornWebWorker"
+
+# Realtime calls are long lived, on SIGTERM give them time to finish (RTMiddleTier.drain_timeout) before
+# the workers are killed
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 120))
+timeout = 120
+
+accesslog = "-"
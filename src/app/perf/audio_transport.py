@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+import base64
+import json
+import sys
+from typing import Optional
+import numpy as np
+
+from perf.loadgen import LatencyProbe, LoadGenerator, _client_frames, start_standin, start_worker
+from perf.recording import TO_CLIENT, TO_SERVER, Frame, load_recording
+
+# Bandwidth and worker CPU of the two client audio transports, base64 audio in JSON frames and raw PCM16
+# binary frames (/realtime?audio=binary), on the same recording and session count. Without a recording a
+# synthetic conversation is used: the user talks for half of it, the assistant answers for the other half
+
+_SAMPLE_RATE = 24000
+_CHUNK_SECONDS = 0.1
+
+def _synthetic_session(seconds: float) -> tuple[list[Frame], list[Frame]]:
+    rng = np.random.default_rng(1)
+    samples = int(_SAMPLE_RATE * _CHUNK_SECONDS)
+
+    def audio() -> str:
+        pcm = (rng.standard_normal(samples) * 3000).astype("<i2")
+        return base64.b64encode(pcm.tobytes()).decode("ascii")
+
+    to_server = [Frame(0.0, TO_SERVER, json.dumps({ "type": "session.update", "session": { "voice": "alloy" } }))]
+    to_client = [Frame(0.0, TO_CLIENT, json.dumps({ "type": "session.created", "session": {} }))]
+    chunks = int(seconds / 2 / _CHUNK_SECONDS)
+    for i in range(chunks):
+        to_server.append(Frame(i * _CHUNK_SECONDS, TO_SERVER, json.dumps({ "type": "input_audio_buffer.append", "audio": audio() })))
+    for i in range(chunks):
+        to_client.append(Frame(seconds / 2 + i * _CHUNK_SECONDS, TO_CLIENT, json.dumps({
+            "event_id": f"event_{i}", "type": "response.audio.delta", "response_id": "resp_1", "item_id": "item_1",
+            "output_index": 0, "content_index": 0, "delta": audio() })))
+    return to_server, to_client
+
+async def measure(to_server: list[Frame], to_client: list[Frame], sessions: int, speed: float, binary_audio: bool) -> dict:
+    client_frames = _client_frames(to_server)
+    duration = max(frame.offset for frame in to_server + to_client) + 1.0
+    probe = LatencyProbe()
+    runner, upstream = await start_standin(to_client, speed, probe)
+    try:
+        worker, port = await start_worker(upstream, to_client)
+        try:
+            generator = LoadGenerator(client_frames, duration, speed, probe, binary_audio)
+            report = await generator.run_level(f"http://127.0.0.1:{port}/realtime", sessions, worker.pid, 1.0)
+        finally:
+            worker.terminate()
+            worker.wait()
+    finally:
+        await runner.cleanup()
+    report["audio"] = "binary" if binary_audio else "json"
+    return report
+
+def _ratio(binary: Optional[float], json_value: Optional[float]) -> Optional[float]:
+    return round(binary / json_value, 3) if binary is not None and json_value else None
+
+async def main(args) -> int:
+    if args.recording is not None:
+        to_server, to_client = load_recording(args.recording)
+    else:
+        to_server, to_client = _synthetic_session(args.seconds)
+    reports = {}
+    for binary_audio in (False, True):
+        report = await measure(to_server, to_client, args.sessions, args.speed, binary_audio)
+        reports[report["audio"]] = report
+        print(json.dumps(report))
+    json_report, binary_report = reports["json"], reports["binary"]
+    print(json.dumps({
+        "binary_vs_json": {
+            "kib_sent_per_session": _ratio(binary_report["kib_sent_per_session"], json_report["kib_sent_per_session"]),
+            "kib_received_per_session": _ratio(binary_report["kib_received_per_session"], json_report["kib_received_per_session"]),
+            "cpu_seconds_per_session": _ratio(binary_report["cpu_seconds_per_session"], json_report["cpu_seconds_per_session"]),
+        }
+    }))
+    return 1 if json_report["errors"] > 0 or binary_report["errors"] > 0 else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare bandwidth and worker CPU of JSON and binary client audio")
+    parser.add_argument("--recording", default=None, help="Session recording, a synthetic session when not given")
+    parser.add_argument("--seconds", type=float, default=20, help="Length of the synthetic session")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--speed", type=float, default=4.0, help="Replay speed factor")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+
+from perf.fakecosmos import FakeDatabase
+from perf.loadgen import _percentile
+from reportstore.cosmosdb import CosmosDBStore
+
+# Request units and latency of looking up a department template, against the in-memory Cosmos fake with
+# simulated round trip time: the cross-partition query the store used to run, the same query scoped to the
+# department's partition, and the point reads the store does now for seeded departments
+
+_QUERY = "SELECT * FROM c WHERE c.department = @department"
+
+def _template(index: int, department: str, fields: int) -> dict:
+    return {
+        "id": str(100000 + index),
+        "department": department,
+        "fields": [{ "name": f"field_{i}", "type": "string", "description": f"Question {i} for {department}" } for i in range(fields)]
+    }
+
+async def _cross_partition_query(store: CosmosDBStore, department: str) -> list:
+    parameters = [{ "name": "@department", "value": department }]
+    return [item async for item in store.container.query_items(query=_QUERY, parameters=parameters, enable_cross_partition_query=True)]
+
+async def _partition_query(store: CosmosDBStore, department: str) -> list:
+    parameters = [{ "name": "@department", "value": department }]
+    return [item async for item in store.container.query_items(query=_QUERY, parameters=parameters, partition_key=department)]
+
+async def _point_read(store: CosmosDBStore, department: str) -> list:
+    return await store.get_schema_from_database(department)
+
+async def measure(name: str, lookup, args) -> dict:
+    store = CosmosDBStore("https://localhost", "benchmark", "templates")
+    store.db = FakeDatabase(args.round_trip_ms / 1000, args.physical_partitions)
+    store.container = await store.db.create_container_if_not_exists("templates", { "paths": ["/department"] })
+    departments = [f"department {i}" for i in range(args.departments)]
+    await store.insert_departments([_template(i, department, args.fields) for i, department in enumerate(departments)])
+    store.container.request_charge.clear()
+    store.container.calls.clear()
+
+    random.seed(1)
+    latencies = []
+    for _ in range(args.lookups):
+        department = random.choice(departments)
+        started = time.perf_counter()
+        fields = await lookup(store, department)
+        latencies.append(time.perf_counter() - started)
+        assert len(fields) == 1 and fields[0]["department"] == department
+    charge = sum(store.container.request_charge.values())
+    return {
+        "path": name,
+        "ru_per_lookup": round(charge / args.lookups, 2),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 2),
+        "calls": store.container.calls,
+    }
+
+async def main(args):
+    for name, lookup in (("cross_partition_query", _cross_partition_query), ("partition_query", _partition_query), ("point_read", _point_read)):
+        print(json.dumps(await measure(name, lookup, args)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare RU and latency of department template lookups against a Cosmos DB fake")
+    parser.add_argument("--departments", type=int, default=50)
+    parser.add_argument("--fields", type=int, default=10, help="Fields per template, sets the document size")
+    parser.add_argument("--lookups", type=int, default=500)
+    parser.add_argument("--physical-partitions", type=int, default=4, help="Partitions a cross-partition query fans out over")
+    parser.add_argument("--round-trip-ms", type=float, default=5, help="Simulated latency of one request to one partition")
+    args = parser.parse_args()
+    logging.getLogger("cosmosdb").setLevel(logging.WARNING)
+    asyncio.run(main(args))
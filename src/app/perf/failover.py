@@ -0,0 +1,114 @@
+import aiohttp
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from aiohttp import web
+from azure.core.credentials import AzureKeyCredential
+
+from backend.rtmt import RTMiddleTier
+from backend.upstream import Upstream
+from perf.loadgen import _free_port, _percentile
+from perf.recording import TO_CLIENT, Frame
+from perf.standin import StandInRealtimeServer
+
+# Routing across several realtime deployments: stand-in servers for a healthy, a slow and a failing
+# deployment behind one middle tier. Sessions should land on the healthy one, none should fail while
+# at least one deployment works, and the failing one's circuit should open
+
+_SESSION_CREATED = json.dumps({ "event_id": "event_1", "type": "session.created", "session": { "id": "sess_1" } })
+_SESSION_UPDATE = json.dumps({ "type": "session.update", "session": { "voice": "alloy" } })
+
+async def _start(app: web.Application) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = _free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, f"http://127.0.0.1:{port}"
+
+async def _session(http: aiohttp.ClientSession, url: str, hold: float) -> float:
+    # Time until session.created reaches the client
+    started = time.perf_counter()
+    async with http.ws_connect(url) as ws:
+        await ws.send_str(_SESSION_UPDATE)
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT and json.loads(msg.data).get("type") == "session.created":
+                elapsed = time.perf_counter() - started
+                await asyncio.sleep(hold)
+                return elapsed
+        raise aiohttp.ClientError("Closed before session.created")
+
+async def main(args) -> int:
+    frames = [Frame(0.0, TO_CLIENT, _SESSION_CREATED)]
+    standins = {
+        "healthy": StandInRealtimeServer(frames, connect_delay=args.healthy_delay),
+        "slow": StandInRealtimeServer(frames, connect_delay=args.slow_delay),
+        "failing": StandInRealtimeServer(frames, failure_rate=args.failure_rate, failure_status=args.failure_status),
+    }
+    runners = []
+    rtmt = None
+    for name, standin in standins.items():
+        app = web.Application()
+        standin.attach_to_app(app)
+        runner, url = await _start(app)
+        runners.append(runner)
+        if rtmt is None:
+            rtmt = RTMiddleTier(url, name, AzureKeyCredential("stand-in"))
+            rtmt.system_message = "You are a helpful assistant."
+        else:
+            rtmt.upstreams.add(Upstream(url, name))
+    app = web.Application()
+    rtmt.attach_to_app(app, "/realtime")
+    runner, url = await _start(app)
+    runners.append(runner)
+
+    latencies: list[float] = []
+    errors = 0
+    limit = asyncio.Semaphore(args.concurrency)
+    try:
+        async with aiohttp.ClientSession() as http:
+            async def client():
+                nonlocal errors
+                async with limit:
+                    try:
+                        latencies.append(await _session(http, f"{url}/realtime", args.hold))
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        errors += 1
+            await asyncio.gather(*(client() for _ in range(args.sessions)))
+    finally:
+        for runner in reversed(runners):
+            await runner.cleanup()
+
+    now = time.monotonic()
+    report = {
+        "sessions": args.sessions,
+        "errors": errors,
+        "p50_setup_ms": (_percentile(latencies, 50) or 0) * 1000,
+        "p99_setup_ms": (_percentile(latencies, 99) or 0) * 1000,
+        "upstreams": {
+            upstream.deployment: {
+                "accepted": standins[upstream.deployment].accepted,
+                "refused": standins[upstream.deployment].refused,
+                "connect_ms": upstream.connect_latency * 1000,
+                "circuit_open": upstream.open_until > now,
+            } for upstream in rtmt.upstreams.upstreams
+        },
+    }
+    print(json.dumps(report, indent=2))
+    return 1 if errors > args.max_errors else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check failover between realtime deployments against stand-in servers")
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--hold", type=float, default=0.2, help="Seconds each session stays open after session.created")
+    parser.add_argument("--healthy-delay", type=float, default=0.02)
+    parser.add_argument("--slow-delay", type=float, default=0.3)
+    parser.add_argument("--failure-rate", type=float, default=1.0)
+    parser.add_argument("--failure-status", type=int, default=503)
+    parser.add_argument("--max-errors", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(main(args)))
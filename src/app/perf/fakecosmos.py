@@ -0,0 +1,128 @@
+import asyncio
+import copy
+import json
+import re
+from typing import Any, AsyncIterator, Optional
+import azure.cosmos.exceptions as exceptions
+
+# In-memory stand-in for the parts of the azure.cosmos.aio database and container API the report store uses.
+# Items are kept per partition, so partition-scoped reads and queries behave like they do against Cosmos DB
+
+_CONDITION = re.compile(r"c\.(\w+)\s*=\s*(@\w+)")
+
+# Request charges follow the documented Cosmos DB costs closely enough to compare access paths: a point
+# read is 1 RU per started KB, a query pays a fixed overhead in every partition it visits plus a share
+# per KB returned, writes cost about 5x a read
+_READ_RU_PER_KB = 1.0
+_WRITE_RU_PER_KB = 5.5
+_QUERY_RU_PER_PARTITION = 2.3
+_QUERY_RU_PER_KB = 0.5
+
+def _kilobytes(item: dict[str, Any]) -> int:
+    return len(json.dumps(item).encode("utf-8")) // 1024 + 1
+
+class FakeContainer:
+    id: str
+    partition_key_path: str
+    # Failures to inject, each call pops one status code from the front (None for a normal call)
+    failures: list[Optional[int]]
+    # Calls made per operation and the highest number of calls in flight at once
+    calls: dict[str, int]
+    max_in_flight: int
+    # Modelled RU consumed per operation
+    request_charge: dict[str, float]
+    # Physical partitions a cross-partition query fans out over, small containers only have one
+    physical_partitions: int
+
+    def __init__(self, id: str, partition_key_path: str, latency: float = 0, physical_partitions: int = 1):
+        self.id = id
+        self.partition_key_path = partition_key_path
+        self.latency = latency
+        self.physical_partitions = physical_partitions
+        self.failures = []
+        self.calls = {}
+        self.max_in_flight = 0
+        self.request_charge = {}
+        self._in_flight = 0
+        self._partitions: dict[Any, dict[str, Any]] = {}
+
+    def _partition_key(self, body: dict[str, Any]) -> Any:
+        return body[self.partition_key_path.lstrip("/")]
+
+    async def _call(self, operation: str, round_trips: int = 1):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        self._in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        try:
+            # A cross-partition query visits the partitions one after the other
+            await asyncio.sleep(self.latency * round_trips)
+        finally:
+            self._in_flight -= 1
+        if len(self.failures) > 0 and (status := self.failures.pop(0)) is not None:
+            error = exceptions.CosmosHttpResponseError(status_code=status, message=f"Injected {status}")
+            error.headers = { "x-ms-retry-after-ms": "1" } if status == 429 else {}
+            raise error
+
+    def _charge(self, operation: str, units: float):
+        self.request_charge[operation] = self.request_charge.get(operation, 0.0) + units
+
+    async def upsert_item(self, body: dict[str, Any]) -> dict[str, Any]:
+        await self._call("upsert_item")
+        self._charge("upsert_item", _WRITE_RU_PER_KB * _kilobytes(body))
+        self._partitions.setdefault(self._partition_key(body), {})[body["id"]] = copy.deepcopy(body)
+        return copy.deepcopy(body)
+
+    async def read_item(self, item: str, partition_key: Any) -> dict[str, Any]:
+        await self._call("read_item")
+        found = self._partitions.get(partition_key, {}).get(item)
+        if found is None:
+            self._charge("read_item", _READ_RU_PER_KB)
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message=f"Item {item} not found")
+        self._charge("read_item", _READ_RU_PER_KB * _kilobytes(found))
+        return copy.deepcopy(found)
+
+    def query_items(self, query: str, parameters: Optional[list[dict[str, Any]]] = None, partition_key: Any = None,
+                    enable_cross_partition_query: bool = False) -> AsyncIterator[dict[str, Any]]:
+        # Only equality conditions joined by AND, which is all the store sends
+        values = { parameter["name"]: parameter["value"] for parameter in parameters or [] }
+        conditions = [(field, values[name]) for field, name in _CONDITION.findall(query)]
+        if partition_key is None and not enable_cross_partition_query:
+            raise exceptions.CosmosHttpResponseError(status_code=400, message="Cross partition query is required but disabled")
+
+        async def results():
+            partitions = [self._partitions.get(partition_key, {})] if partition_key is not None else list(self._partitions.values())
+            visited = 1 if partition_key is not None else self.physical_partitions
+            await self._call("query_items", visited)
+            matches = [item for partition in partitions for item in list(partition.values())
+                       if all(item.get(field) == value for field, value in conditions)]
+            self._charge("query_items", _QUERY_RU_PER_PARTITION * visited +
+                         _QUERY_RU_PER_KB * sum(_kilobytes(item) for item in matches))
+            for item in matches:
+                yield copy.deepcopy(item)
+        return results()
+
+    def items(self) -> list[dict[str, Any]]:
+        return [copy.deepcopy(item) for partition in self._partitions.values() for item in partition.values()]
+
+class FakeDatabase:
+    containers: dict[str, FakeContainer]
+    # Failures to inject into container creation, like FakeContainer.failures
+    failures: list[Optional[int]]
+
+    def __init__(self, latency: float = 0, physical_partitions: int = 1):
+        self.latency = latency
+        self.physical_partitions = physical_partitions
+        self.containers = {}
+        self.failures = []
+
+    async def create_container_if_not_exists(self, id: str, partition_key: Any) -> FakeContainer:
+        if len(self.failures) > 0 and (status := self.failures.pop(0)) is not None:
+            raise exceptions.CosmosHttpResponseError(status_code=status, message=f"Injected {status}")
+        if id not in self.containers:
+            self.containers[id] = FakeContainer(id, partition_key["paths"][0], self.latency, self.physical_partitions)
+        return self.containers[id]
+
+    def get_container_client(self, id: str) -> FakeContainer:
+        if id not in self.containers:
+            self.containers[id] = FakeContainer(id, "/id", self.latency, self.physical_partitions)
+        return self.containers[id]
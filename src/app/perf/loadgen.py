@@ -0,0 +1,313 @@
+import aiohttp
+import argparse
+import asyncio
+import base64
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Optional
+from aiohttp import web
+
+from perf.recording import TO_CLIENT, TO_SERVER, Frame, frame_event_id, load_recording
+from perf.standin import StandInRealtimeServer
+
+# Client frame types the load generator replays. Tool outputs and the response.create that follows them
+# are produced by the middle tier itself, sending the recorded ones as well would double them up
+_CLIENT_FRAME_PREFIXES = ("session.update", "input_audio_buffer.")
+
+class LatencyProbe:
+    # Matches each frame leaving the load generator or stand-in server with its arrival on the other side
+    latencies: dict[int, list[float]]
+    # Frames that arrived on a session that never sent them, or twice, i.e. crossed over between sessions
+    unmatched: dict[int, int]
+
+    def __init__(self):
+        self.latencies = { TO_SERVER: [], TO_CLIENT: [] }
+        self.unmatched = { TO_SERVER: 0, TO_CLIENT: 0 }
+        self._sent: dict[tuple[int, str, str], float] = {}
+
+    def sent(self, direction: int, session_id: str, event_id: str, at: float):
+        self._sent[(direction, session_id, event_id)] = at
+
+    def received(self, direction: int, session_id: str, event_id: str, at: float):
+        sent = self._sent.pop((direction, session_id, event_id), None)
+        if sent is not None:
+            self.latencies[direction].append(at - sent)
+        else:
+            self.unmatched[direction] += 1
+
+    def reset(self):
+        self.latencies = { TO_SERVER: [], TO_CLIENT: [] }
+        self.unmatched = { TO_SERVER: 0, TO_CLIENT: 0 }
+        self._sent.clear()
+
+def _percentile(values: list[float], percentile: float) -> Optional[float]:
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+def _cpu_seconds(pid: int) -> Optional[float]:
+    # utime + stime of the worker, Linux only
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _client_frames(to_server: list[Frame]) -> list[Frame]:
+    frames = []
+    for frame in to_server:
+        if isinstance(frame.data, str) and json.loads(frame.data).get("type", "").startswith(_CLIENT_FRAME_PREFIXES):
+            frames.append(frame)
+    return frames
+
+def _tool_names(to_client: list[Frame]) -> list[str]:
+    names = set()
+    for frame in to_client:
+        if isinstance(frame.data, str) and '"function_call"' in frame.data:
+            message = json.loads(frame.data)
+            if message.get("type") == "response.output_item.done" and message["item"]["type"] == "function_call":
+                names.add(message["item"]["name"])
+    return sorted(names)
+
+class LoadGenerator:
+    # Drives concurrent synthetic clients through a middle tier worker that talks to the stand-in server,
+    # stepping up the session count until relay latency or CPU leave the budget
+    client_frames: list[Frame]
+    duration: float
+    speed: float
+    probe: LatencyProbe
+    # Send and receive audio as raw PCM16 binary frames (/realtime?audio=binary) instead of base64 JSON
+    binary_audio: bool
+    # Simulates a client on a poor connection by reading at most this many bytes per second, None reads
+    # as fast as frames arrive
+    read_bytes_per_second: Optional[float]
+    # Bytes the clients sent and received in the current level
+    bytes_sent: int
+    bytes_received: int
+    # Seconds from each client's ws_connect until its session.created arrived, in the current level
+    setup_latencies: list[float]
+
+    def __init__(self, client_frames: list[Frame], duration: float, speed: float, probe: LatencyProbe, binary_audio: bool = False,
+                 read_bytes_per_second: Optional[float] = None):
+        self.client_frames = client_frames
+        self.duration = duration
+        self.speed = speed
+        self.probe = probe
+        self.binary_audio = binary_audio
+        self.read_bytes_per_second = read_bytes_per_second
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.setup_latencies = []
+        # Audio is decoded up front, so both modes spend the same client CPU per frame
+        self._payloads: list[str | bytes] = []
+        for index, frame in enumerate(client_frames):
+            message = json.loads(frame.data)
+            if binary_audio and message.get("type") == "input_audio_buffer.append":
+                self._payloads.append(base64.b64decode(message["audio"]))
+            else:
+                # Tag the frame so the stand-in server can tell when it came through
+                self._payloads.append('{"event_id":"loadgen-' + str(index) + '",' + frame.data.lstrip()[1:])
+
+    async def _client(self, http: aiohttp.ClientSession, url: str, session_id: str):
+        connecting = time.perf_counter()
+        async with http.ws_connect(url, headers={ "x-ms-client-request-id": session_id }) as ws:
+            if self.read_bytes_per_second is not None and (sock := ws.get_extra_info("socket")) is not None:
+                # A small receive window, or the kernel would soak up megabytes on loopback before the
+                # middle tier ever noticed the client falling behind
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+            async def receive():
+                set_up = False
+                async for msg in ws:
+                    if msg.type == aiohttp.WSMsgType.BINARY:
+                        self.bytes_received += len(msg.data)
+                    elif msg.type == aiohttp.WSMsgType.TEXT:
+                        self.bytes_received += len(msg.data)
+                        if not set_up and '"session.created"' in msg.data and json.loads(msg.data).get("type") == "session.created":
+                            # Includes the middle tier's upstream connect and auth, plus the recorded offset of
+                            # session.created, which is close to 0
+                            set_up = True
+                            self.setup_latencies.append(time.perf_counter() - connecting)
+                        if (event_id := frame_event_id(msg.data)) is not None:
+                            self.probe.received(TO_CLIENT, session_id, event_id, time.perf_counter())
+                    if self.read_bytes_per_second is not None and msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                        # Not reading lets aiohttp pause the socket, the middle tier sees a slow TCP peer
+                        await asyncio.sleep(len(msg.data) / self.read_bytes_per_second)
+            receiver = asyncio.create_task(receive())
+            started = time.perf_counter()
+            for index, (frame, payload) in enumerate(zip(self.client_frames, self._payloads)):
+                delay = frame.offset / self.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.bytes_sent += len(payload)
+                if isinstance(payload, bytes):
+                    await ws.send_bytes(payload)
+                else:
+                    self.probe.sent(TO_SERVER, session_id, f"loadgen-{index}", time.perf_counter())
+                    await ws.send_str(payload)
+            remaining = self.duration / self.speed - (time.perf_counter() - started)
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            if self.read_bytes_per_second is not None:
+                # Whatever a slow client hasn't read yet is abandoned, like a phone losing signal
+                receiver.cancel()
+            await ws.close()
+            await asyncio.gather(receiver, return_exceptions=True)
+
+    async def run_level(self, url: str, sessions: int, pid: int, ramp: float) -> dict[str, Any]:
+        self.probe.reset()
+        self.bytes_sent = self.bytes_received = 0
+        self.setup_latencies = []
+        if self.binary_audio:
+            url += "?audio=binary"
+        cpu_before = _cpu_seconds(pid)
+        started = time.perf_counter()
+        async with aiohttp.ClientSession() as http:
+            async def start_client(index: int):
+                # Spread the arrivals over the ramp so the worker isn't measured on a thundering herd
+                await asyncio.sleep(ramp * index / sessions)
+                await self._client(http, url, f"{sessions}-{index}")
+            results = await asyncio.gather(*(start_client(index) for index in range(sessions)), return_exceptions=True)
+        wall = time.perf_counter() - started
+        cpu_after = _cpu_seconds(pid)
+        cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+        report: dict[str, Any] = {
+            "sessions": sessions,
+            "errors": sum(1 for result in results if isinstance(result, BaseException)),
+            "cpu_seconds_per_session": cpu / sessions if cpu is not None else None,
+            "cpu_utilization": cpu / wall if cpu is not None else None,
+            # Client side payload, websocket framing not included
+            "kib_sent_per_session": self.bytes_sent / sessions / 1024,
+            "kib_received_per_session": self.bytes_received / sessions / 1024,
+        }
+        report["session_setup"] = { "sessions": len(self.setup_latencies) }
+        for percentile in (50, 95, 99):
+            value = _percentile(self.setup_latencies, percentile)
+            report["session_setup"][f"p{percentile}_ms"] = value * 1000 if value is not None else None
+        for direction, name in ((TO_SERVER, "to_server"), (TO_CLIENT, "to_client")):
+            latencies = self.probe.latencies[direction]
+            report[name] = { "frames": len(latencies), "unmatched": self.probe.unmatched[direction] }
+            for percentile in (50, 95, 99):
+                value = _percentile(latencies, percentile)
+                report[name][f"p{percentile}_ms"] = value * 1000 if value is not None else None
+        return report
+
+def _passes(report: dict[str, Any], slo_p99_ms: float, max_cpu: float) -> bool:
+    if report["errors"] > 0:
+        return False
+    for name in ("to_server", "to_client"):
+        if report[name]["unmatched"] > 0:
+            return False
+        p99 = report[name]["p99_ms"]
+        if p99 is not None and p99 > slo_p99_ms:
+            return False
+    return report["cpu_utilization"] is None or report["cpu_utilization"] <= max_cpu
+
+async def _wait_until_up(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as http:
+        while True:
+            try:
+                async with http.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                if time.monotonic() > deadline:
+                    raise
+            await asyncio.sleep(0.2)
+
+async def start_standin(to_client: list[Frame], speed: float, probe: LatencyProbe) -> tuple[web.AppRunner, str]:
+    standin = StandInRealtimeServer(to_client, speed, probe)
+    standin_app = web.Application()
+    standin.attach_to_app(standin_app)
+    runner = web.AppRunner(standin_app)
+    await runner.setup()
+    standin_port = _free_port()
+    await web.TCPSite(runner, "127.0.0.1", standin_port).start()
+    return runner, f"http://127.0.0.1:{standin_port}"
+
+async def start_worker(upstream: str, to_client: list[Frame], fast_relay: bool = True, token_delay: float = 0) -> tuple[subprocess.Popen, int]:
+    port = _free_port()
+    command = [sys.executable, "-m", "perf.serve", "--upstream", upstream, "--port", str(port),
+               "--tools", ",".join(_tool_names(to_client)), "--token-delay", str(token_delay)]
+    if not fast_relay:
+        command.append("--no-fast-relay")
+    worker = subprocess.Popen(command, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    try:
+        await _wait_until_up(f"http://127.0.0.1:{port}/metrics")
+    except BaseException:
+        worker.terminate()
+        worker.wait()
+        raise
+    return worker, port
+
+async def main(args) -> int:
+    to_server, to_client = load_recording(args.recording)
+    client_frames = _client_frames(to_server)
+    duration = max(frame.offset for frame in to_server + to_client) + 1.0
+    probe = LatencyProbe()
+
+    runner, upstream = await start_standin(to_client, args.speed, probe)
+    reports = []
+    try:
+        worker, port = await start_worker(upstream, to_client, not args.no_fast_relay, args.token_delay_ms / 1000)
+    except BaseException:
+        await runner.cleanup()
+        raise
+    try:
+        read_rate = args.slow_client_kbps * 1000 / 8 if args.slow_client_kbps is not None else None
+        generator = LoadGenerator(client_frames, duration, args.speed, probe, args.audio == "binary", read_rate)
+        for sessions in (int(level) for level in args.sessions.split(",")):
+            report = await generator.run_level(f"http://127.0.0.1:{port}/realtime", sessions, worker.pid, args.ramp)
+            report["passed"] = _passes(report, args.slo_p99_ms, args.max_cpu)
+            reports.append(report)
+            print(json.dumps(report))
+            if not report["passed"]:
+                break
+    finally:
+        worker.terminate()
+        worker.wait()
+        await runner.cleanup()
+
+    passing = [report["sessions"] for report in reports if report["passed"]]
+    summary = {
+        "recording": args.recording,
+        "fast_relay": not args.no_fast_relay,
+        "audio": args.audio,
+        "max_sustainable_sessions": max(passing) if len(passing) > 0 else 0,
+        "levels": reports,
+    }
+    print(f"Max sustainable sessions per worker: {summary['max_sustainable_sessions']}")
+    if args.out is not None:
+        with open(args.out, "w") as file:
+            json.dump(summary, file, indent=2)
+    if args.min_sessions is not None and summary["max_sustainable_sessions"] < args.min_sessions:
+        print(f"Regression: fewer than {args.min_sessions} sustainable sessions")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the middle tier by replaying a recorded session")
+    parser.add_argument("recording")
+    parser.add_argument("--sessions", default="10,25,50,100,200", help="Comma separated concurrency levels, in increasing order")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed factor")
+    parser.add_argument("--ramp", type=float, default=2.0, help="Seconds over which the sessions of a level start")
+    parser.add_argument("--slo-p99-ms", type=float, default=50.0, help="Relay latency budget per frame")
+    parser.add_argument("--max-cpu", type=float, default=0.8, help="Worker CPU utilization budget, in cores")
+    parser.add_argument("--min-sessions", type=int, default=None, help="Exit with an error below this many sustainable sessions")
+    parser.add_argument("--no-fast-relay", action="store_true")
+    parser.add_argument("--audio", choices=("json", "binary"), default="json", help="Client audio transport")
+    parser.add_argument("--token-delay-ms", type=float, default=0, help="Have the worker authenticate with a token credential this slow")
+    parser.add_argument("--slow-client-kbps", type=float, default=None, help="Limit how fast clients read, in kbit/s")
+    parser.add_argument("--out", default=None, help="Write the full report as JSON")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,76 @@
+import aiohttp
+import argparse
+import asyncio
+import logging
+import os
+import time
+from aiohttp import web
+
+from perf.recording import TO_CLIENT, TO_SERVER, RecordingWriter
+
+logger = logging.getLogger("perf.record")
+
+# Headers the middle tier sends upstream that the real endpoint needs to see
+_FORWARDED_HEADERS = ("api-key", "Authorization", "x-ms-client-request-id")
+
+class RecordingProxy:
+    # Sits between the middle tier and the realtime API (point AZURE_OPENAI_ENDPOINT at it) and writes
+    # every upstream session to its own recording, for the stand-in server and load generator to replay
+    target: str
+    out_dir: str
+
+    def __init__(self, target: str, out_dir: str):
+        self.target = target
+        self.out_dir = out_dir
+        self._client_session = None
+        self._count = 0
+
+    async def _relay(self, source, destination, direction: int, recording: RecordingWriter, started: float):
+        async for msg in source:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                recording.write(time.perf_counter() - started, direction, msg.data)
+                await destination.send_str(msg.data)
+            elif msg.type == aiohttp.WSMsgType.BINARY:
+                recording.write(time.perf_counter() - started, direction, msg.data)
+                await destination.send_bytes(msg.data)
+        await destination.close()
+
+    async def _websocket_handler(self, request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        if self._client_session is None:
+            self._client_session = aiohttp.ClientSession(base_url=self.target)
+        headers = { name: request.headers[name] for name in _FORWARDED_HEADERS if name in request.headers }
+        self._count += 1
+        path = os.path.join(self.out_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{self._count}.rtrec")
+        recording = RecordingWriter(path)
+        started = time.perf_counter()
+        try:
+            async with self._client_session.ws_connect("/openai/realtime", headers=headers, params=request.query) as target_ws:
+                await asyncio.gather(
+                    self._relay(ws, target_ws, TO_SERVER, recording, started),
+                    self._relay(target_ws, ws, TO_CLIENT, recording, started))
+        finally:
+            recording.close()
+            logger.info("Recorded %d frames to %s", recording.frames, path)
+        return ws
+
+    async def _on_cleanup(self, app: web.Application):
+        if self._client_session is not None:
+            await self._client_session.close()
+
+    def attach_to_app(self, app: web.Application):
+        app.router.add_get("/openai/realtime", self._websocket_handler)
+        app.on_cleanup.append(self._on_cleanup)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record realtime API sessions passing through the middle tier")
+    parser.add_argument("--target", default=os.environ.get("AZURE_OPENAI_ENDPOINT"), help="Real Azure OpenAI endpoint")
+    parser.add_argument("--out", default="recordings", help="Directory for the recordings")
+    parser.add_argument("--port", type=int, default=8770)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    os.makedirs(args.out, exist_ok=True)
+    app = web.Application()
+    RecordingProxy(args.target, args.out).attach_to_app(app)
+    web.run_app(app, host="localhost", port=args.port)
@@ -0,0 +1,70 @@
+import re
+import struct
+from typing import BinaryIO, Iterator, NamedTuple, Optional
+
+# A recording is one realtime session: a magic header followed by length-prefixed frames, each stamped
+# with the seconds since the session started. Audio stays base64 in its JSON frame, the format doesn't
+# try to be smarter than the frames themselves
+MAGIC = b"RTREC1\n"
+_FRAME_HEADER = struct.Struct("<dBI")
+
+TO_SERVER = 0
+TO_CLIENT = 1
+_DIRECTION_MASK = 0x01
+_BINARY_FLAG = 0x02
+
+class Frame(NamedTuple):
+    offset: float
+    direction: int
+    data: str | bytes
+
+class RecordingWriter:
+    file: BinaryIO
+    frames: int
+
+    def __init__(self, path: str):
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.frames = 0
+
+    def write(self, offset: float, direction: int, data: str | bytes):
+        flags = direction
+        if isinstance(data, bytes):
+            flags |= _BINARY_FLAG
+        else:
+            data = data.encode("utf-8")
+        self.file.write(_FRAME_HEADER.pack(offset, flags, len(data)))
+        self.file.write(data)
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+def read_recording(path: str) -> Iterator[Frame]:
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a session recording")
+        while header := file.read(_FRAME_HEADER.size):
+            if len(header) < _FRAME_HEADER.size:
+                raise ValueError(f"{path} is truncated")
+            offset, flags, length = _FRAME_HEADER.unpack(header)
+            data = file.read(length)
+            if len(data) < length:
+                raise ValueError(f"{path} is truncated")
+            yield Frame(offset, flags & _DIRECTION_MASK, data if flags & _BINARY_FLAG else data.decode("utf-8"))
+
+def load_recording(path: str) -> tuple[list[Frame], list[Frame]]:
+    # Splits a recording into what the client sent and what the realtime API answered
+    to_server, to_client = [], []
+    for frame in read_recording(path):
+        (to_client if frame.direction == TO_CLIENT else to_server).append(frame)
+    return to_server, to_client
+
+_EVENT_ID = re.compile(r'"event_id"\s*:\s*"([^"\\]+)"')
+
+def frame_event_id(data: str | bytes) -> Optional[str]:
+    # Only the head of the frame is searched, event ids come first or right after the type
+    if not isinstance(data, str):
+        return None
+    match = _EVENT_ID.search(data, 0, 200)
+    return match.group(1) if match is not None else None
@@ -0,0 +1,50 @@
+import argparse
+import logging
+import time
+from aiohttp import web
+from azure.core.credentials import AccessToken, AzureKeyCredential
+
+from backend import metrics
+from backend.rtmt import RTMiddleTier, Tool, ToolResult, ToolResultDirection
+
+# The middle tier under load, on its own process so its CPU time can be measured apart from the load
+# generator. Tools named in the recording are answered straight away, only the relay is being measured
+
+def _stub_tool(name: str) -> Tool:
+    async def target(args) -> ToolResult:
+        return ToolResult({ "ok": True }, ToolResultDirection.TO_SERVER)
+    return Tool(target=target, schema={ "type": "function", "name": name, "parameters": { "type": "object", "properties": {} } })
+
+class _SlowCredential:
+    # A token credential whose every get_token blocks like a refresh going out to the identity endpoint.
+    # Tokens are issued inside the refresh margin, so a refresh is always due
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    def get_token(self, *scopes, **kwargs) -> AccessToken:
+        time.sleep(self.delay)
+        return AccessToken("stand-in", int(time.time()) + 240)
+
+def create_app(upstream: str, tools: list[str], fast_relay: bool, token_delay: float = 0) -> web.Application:
+    app = web.Application()
+    credentials = _SlowCredential(token_delay) if token_delay > 0 else AzureKeyCredential("stand-in")
+    rtmt = RTMiddleTier(upstream, "stand-in", credentials)
+    rtmt.system_message = "You are a helpful assistant."
+    rtmt.fast_relay = fast_relay
+    for name in tools:
+        rtmt.tools[name] = _stub_tool(name)
+    rtmt.attach_to_app(app, "/realtime")
+    metrics.attach_to_app(app, "/metrics")
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the middle tier against a stand-in realtime server")
+    parser.add_argument("--upstream", required=True, help="Stand-in server base URL")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tools", default="", help="Comma separated tool names to stub")
+    parser.add_argument("--no-fast-relay", action="store_true")
+    parser.add_argument("--token-delay", type=float, default=0, help="Authenticate with a token credential that takes this many seconds per token")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    tools = [name for name in args.tools.split(",") if name]
+    web.run_app(create_app(args.upstream, tools, not args.no_fast_relay, args.token_delay), host="127.0.0.1", port=args.port, print=None)
@@ -0,0 +1,76 @@
+import aiohttp
+import argparse
+import asyncio
+import json
+import time
+from azure.core.credentials import AzureKeyCredential
+
+from backend.rtmt import RTMiddleTier, RTSession, Tool
+from backend.tools import _generate_report_tool, _generate_report_tool_schema, _get_report_fields_tool_schema
+
+# Cost of setting up a session in the middle tier: the client's session.update going up and session.created
+# coming back, with a production sized prompt and tools. Run with --baseline to compare against rebuilding
+# and re-serializing the whole server configuration for every call, as the middle tier used to
+
+_SYSTEM_MESSAGE = (
+    "You are a helpful assistant that maintains a conversation with the user, while asking questions according to a specific set of fields.\n"
+    "The user is an employee who is driving from a customer meeting and talking to you hands-free in the car.\n"
+) * 8
+
+_CLIENT_SESSION_UPDATE = json.dumps({
+    "type": "session.update",
+    "session": { "turn_detection": { "type": "server_vad" }, "voice": "alloy" }
+})
+
+_SESSION_CREATED = json.dumps({
+    "event_id": "event_1",
+    "type": "session.created",
+    "session": {
+        "id": "sess_1", "object": "realtime.session", "model": "gpt-4o-realtime-preview", "modalities": ["text", "audio"],
+        "instructions": _SYSTEM_MESSAGE, "voice": "alloy", "input_audio_format": "pcm16", "output_audio_format": "pcm16",
+        "turn_detection": { "type": "server_vad", "threshold": 0.5, "prefix_padding_ms": 300, "silence_duration_ms": 500 },
+        "tools": [_generate_report_tool_schema, _get_report_fields_tool_schema], "tool_choice": "auto",
+        "temperature": 0.8, "max_response_output_tokens": "inf"
+    }
+})
+
+def _baseline_session_update(rtmt: RTMiddleTier, data: str) -> str:
+    message = json.loads(data)
+    session = message["session"]
+    session["instructions"] = rtmt.system_message
+    session["tool_choice"] = "auto"
+    session["tools"] = [tool.schema for tool in rtmt.tools.values()]
+    session["input_audio_transcription"] = { "model": "whisper-1" }
+    return json.dumps(message)
+
+def _message(data: str) -> aiohttp.WSMessage:
+    return aiohttp.WSMessage(aiohttp.WSMsgType.TEXT, data, None)
+
+async def main(args):
+    rtmt = RTMiddleTier("http://localhost", "benchmark", AzureKeyCredential("benchmark"))
+    rtmt.system_message = _SYSTEM_MESSAGE
+    rtmt.tools["generate_report"] = Tool(target=_generate_report_tool, schema=_generate_report_tool_schema)
+    rtmt.tools["get_report_fields"] = Tool(target=_generate_report_tool, schema=_get_report_fields_tool_schema)
+    session_update, session_created = _message(_CLIENT_SESSION_UPDATE), _message(_SESSION_CREATED)
+
+    started = time.perf_counter()
+    for _ in range(args.sessions):
+        rt_session = RTSession(None)
+        if args.baseline:
+            _baseline_session_update(rtmt, session_update.data)
+        else:
+            await rtmt._process_message_to_server(session_update, rt_session)
+        await rtmt._process_message_to_client(session_created, rt_session)
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        "mode": "baseline" if args.baseline else "precomputed",
+        "sessions": args.sessions,
+        "us_per_session": elapsed / args.sessions * 1e6,
+        "sessions_per_second": args.sessions / elapsed,
+    }))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark session setup in the middle tier")
+    parser.add_argument("--sessions", type=int, default=20000)
+    parser.add_argument("--baseline", action="store_true", help="Rebuild the configuration per call instead")
+    asyncio.run(main(parser.parse_args()))
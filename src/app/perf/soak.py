@@ -0,0 +1,123 @@
+import aiohttp
+import argparse
+import asyncio
+import json
+import re
+import sys
+import time
+from typing import Optional
+
+from perf.audio_transport import _synthetic_session
+from perf.loadgen import LatencyProbe, LoadGenerator, _client_frames, start_standin, start_worker
+from perf.recording import load_recording
+
+# Runs waves of slow clients against a middle tier worker and watches its resident memory. The relay queues
+# are bounded and drop stale audio for peers that can't keep up, so memory rises while the first wave fills
+# them up to the high-water mark and then stays flat, instead of growing with the audio clients haven't read
+
+_SAMPLE = re.compile(r'^(realtime_queue_depth|realtime_frames_dropped_total)\{direction="(\w+)"(?:,reason="(\w+)")?\} (\S+)$', re.MULTILINE)
+
+def _rss_mib(pid: int) -> Optional[float]:
+    # Linux only
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+async def _relay_metrics(http: aiohttp.ClientSession, url: str) -> dict[str, float]:
+    async with http.get(url) as response:
+        text = await response.text()
+    totals: dict[str, float] = {}
+    for name, direction, reason, value in _SAMPLE.findall(text):
+        key = f"{name}:{direction}" + (f":{reason}" if reason else "")
+        totals[key] = float(value)
+    return totals
+
+async def main(args) -> int:
+    if args.recording is not None:
+        to_server, to_client = load_recording(args.recording)
+    else:
+        # The assistant talks most of the session, that's the audio a slow client falls behind on
+        to_server, to_client = _synthetic_session(args.seconds)
+    client_frames = _client_frames(to_server)
+    duration = max(frame.offset for frame in to_server + to_client) + 1.0
+    probe = LatencyProbe()
+
+    runner, upstream = await start_standin(to_client, args.speed, probe)
+    try:
+        worker, port = await start_worker(upstream, to_client)
+    except BaseException:
+        await runner.cleanup()
+        raise
+    samples: list[float] = []
+    waves: list[float] = []
+    max_depth = { "to_client": 0.0, "to_server": 0.0 }
+    errors = 0
+    try:
+        generator = LoadGenerator(client_frames, duration, args.speed, probe, read_bytes_per_second=args.client_kbps * 1000 / 8)
+        started = time.perf_counter()
+
+        async def sample():
+            async with aiohttp.ClientSession() as http:
+                while True:
+                    rss = _rss_mib(worker.pid)
+                    if rss is not None:
+                        samples.append(rss)
+                    for key, value in (await _relay_metrics(http, f"http://127.0.0.1:{port}/metrics")).items():
+                        name, _, direction = key.partition(":")
+                        if name == "realtime_queue_depth":
+                            max_depth[direction] = max(max_depth[direction], value)
+                    await asyncio.sleep(1.0)
+        sampler = asyncio.create_task(sample())
+        try:
+            for wave in range(args.waves):
+                first_sample = len(samples)
+                report = await generator.run_level(f"http://127.0.0.1:{port}/realtime", args.sessions, worker.pid, args.ramp)
+                errors += report["errors"]
+                waves.append(max(samples[first_sample:], default=0.0))
+                print(json.dumps({ "wave": wave + 1, "elapsed_s": round(time.perf_counter() - started), "rss_peak_mib": waves[-1], "errors": report["errors"] }))
+        finally:
+            sampler.cancel()
+            await asyncio.gather(sampler, return_exceptions=True)
+        async with aiohttp.ClientSession() as http:
+            relay = await _relay_metrics(http, f"http://127.0.0.1:{port}/metrics")
+    finally:
+        worker.terminate()
+        worker.wait()
+        await runner.cleanup()
+
+    # The first wave fills the queues and allocator pools, later waves must not need more
+    growth = max(waves[1:]) - waves[0] if len(waves) > 1 else None
+    report = {
+        "sessions": args.sessions,
+        "client_kbps": args.client_kbps,
+        "errors": errors,
+        "rss_idle_mib": samples[0] if samples else None,
+        "rss_peak_per_wave_mib": waves,
+        "rss_growth_after_first_wave_mib": growth,
+        # Summed over sessions, bounded by sessions x high-water mark
+        "max_queue_depth": max_depth,
+        "frames_dropped": { key.partition(":")[2]: value for key, value in relay.items() if key.startswith("realtime_frames_dropped_total") },
+    }
+    print(json.dumps(report, indent=2))
+    if growth is None or growth > args.max_growth_mib:
+        print(f"Regression: memory grew by {growth} MiB after the first wave, budget {args.max_growth_mib}")
+        return 1
+    return 1 if errors > 0 else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Soak test the middle tier with slow clients and watch its memory")
+    parser.add_argument("--recording", default=None, help="Session recording, a synthetic session when not given")
+    # Long enough that a slow client falls behind by more than the kernel socket buffers hold
+    parser.add_argument("--seconds", type=float, default=300, help="Length of the synthetic session")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--client-kbps", type=float, default=64, help="How fast the slow clients read, in kbit/s")
+    parser.add_argument("--speed", type=float, default=4.0, help="Replay speed factor")
+    parser.add_argument("--ramp", type=float, default=2.0)
+    parser.add_argument("--waves", type=int, default=3, help="Rounds of sessions, one after the other")
+    parser.add_argument("--max-growth-mib", type=float, default=10)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,97 @@
+import aiohttp
+import argparse
+import asyncio
+import logging
+import random
+import time
+from typing import Optional
+from aiohttp import web
+
+from perf.recording import TO_CLIENT, TO_SERVER, Frame, frame_event_id, load_recording
+
+logger = logging.getLogger("perf.standin")
+
+class StandInRealtimeServer:
+    # Plays the realtime API side of a recording to every session on the recorded schedule, whatever the
+    # client sends. Deterministic, so runs against different builds of the middle tier are comparable
+    frames: list[Frame]
+    # Divides the recorded offsets, 2.0 replays twice as fast
+    speed: float
+    # Optional object with sent/received(direction, session_id, event_id, at), used to measure relay latency
+    probe: Optional[object]
+    # Fault injection: delay before answering the handshake, and the share of handshakes refused with
+    # failure_status, to exercise failover between deployments
+    connect_delay: float
+    failure_rate: float
+    failure_status: int
+    sessions: int
+    accepted: int
+    refused: int
+
+    def __init__(self, frames: list[Frame], speed: float = 1.0, probe: Optional[object] = None,
+                 connect_delay: float = 0, failure_rate: float = 0, failure_status: int = 429):
+        self.frames = frames
+        self.speed = speed
+        self.probe = probe
+        self.connect_delay = connect_delay
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.sessions = 0
+        self.accepted = 0
+        self.refused = 0
+
+    async def _replay(self, ws: web.WebSocketResponse, session_id: str):
+        started = time.perf_counter()
+        for frame in self.frames:
+            delay = frame.offset / self.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.probe is not None and (event_id := frame_event_id(frame.data)) is not None:
+                self.probe.sent(TO_CLIENT, session_id, event_id, time.perf_counter())
+            if isinstance(frame.data, bytes):
+                await ws.send_bytes(frame.data)
+            else:
+                await ws.send_str(frame.data)
+
+    async def _websocket_handler(self, request: web.Request):
+        if self.connect_delay > 0:
+            await asyncio.sleep(self.connect_delay)
+        if random.random() < self.failure_rate:
+            self.refused += 1
+            return web.json_response({ "error": { "code": str(self.failure_status) } }, status=self.failure_status)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        session_id = request.headers.get("x-ms-client-request-id", "")
+        self.sessions += 1
+        self.accepted += 1
+        replay = asyncio.create_task(self._replay(ws, session_id))
+        try:
+            # Stays open after the replay until the middle tier hangs up, closing first would look like an outage
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT and self.probe is not None:
+                    event_id = frame_event_id(msg.data)
+                    if event_id is not None:
+                        self.probe.received(TO_SERVER, session_id, event_id, time.perf_counter())
+        finally:
+            replay.cancel()
+            await asyncio.gather(replay, return_exceptions=True)
+            self.sessions -= 1
+        return ws
+
+    def attach_to_app(self, app: web.Application):
+        app.router.add_get("/openai/realtime", self._websocket_handler)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the realtime API side of a recording")
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--port", type=int, default=8771)
+    parser.add_argument("--connect-delay", type=float, default=0)
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--failure-status", type=int, default=429)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    _, to_client = load_recording(args.recording)
+    app = web.Application()
+    StandInRealtimeServer(to_client, args.speed, None, args.connect_delay, args.failure_rate, args.failure_status).attach_to_app(app)
+    web.run_app(app, host="localhost", port=args.port)
@@ -0,0 +1,97 @@
+import aiohttp
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from perf.loadgen import _free_port
+
+# Cold start of the app: import time of the app module (python -X importtime), and time from spawning the
+# process to the first accepted /realtime socket and to /ready. Thresholds make it usable as a regression gate
+
+_APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+def measure_imports(top: int) -> dict:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=_APP_DIR, capture_output=True, text=True, check=True)
+    packages: dict[str, int] = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, module = int(match.group(1)), int(match.group(2)), match.group(3), match.group(4)
+        if module == "app" and indent == "":
+            total = cumulative_us
+        top_level = module.split(".")[0]
+        packages[top_level] = packages.get(top_level, 0) + self_us
+    heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return { "import_ms": total / 1000, "heaviest_ms": { name: us / 1000 for name, us in heaviest } }
+
+async def measure_first_socket(timeout: float) -> dict:
+    port = _free_port()
+    env = { **os.environ, "PORT": str(port), "HOST": "127.0.0.1", "RUNNING_IN_PRODUCTION": "1" }
+    env.setdefault("AZURE_OPENAI_ENDPOINT", "http://127.0.0.1:9")
+    env.setdefault("AZURE_OPENAI_COMPLETION_DEPLOYMENT_NAME", "startup")
+    env.setdefault("AZURE_OPENAI_API_KEY", "startup")
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "app.py"], cwd=_APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    result = { "first_socket_ms": None, "ready_ms": None }
+    try:
+        async with aiohttp.ClientSession() as http:
+            deadline = started + timeout
+            while result["first_socket_ms"] is None and time.perf_counter() < deadline:
+                try:
+                    async with http.ws_connect(f"http://127.0.0.1:{port}/realtime"):
+                        result["first_socket_ms"] = (time.perf_counter() - started) * 1000
+                except aiohttp.ClientError:
+                    await asyncio.sleep(0.01)
+            while result["ready_ms"] is None and time.perf_counter() < deadline:
+                try:
+                    async with http.get(f"http://127.0.0.1:{port}/ready") as response:
+                        if response.status == 200:
+                            result["ready_ms"] = (time.perf_counter() - started) * 1000
+                            break
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.05)
+    finally:
+        process.terminate()
+        process.wait()
+    return result
+
+async def main(args) -> int:
+    imports = [measure_imports(args.top) for _ in range(args.runs)]
+    sockets = [await measure_first_socket(args.timeout) for _ in range(args.runs)]
+
+    def median(values):
+        values = [value for value in values if value is not None]
+        return statistics.median(values) if len(values) > 0 else None
+
+    report = {
+        "import_ms": median(run["import_ms"] for run in imports),
+        "first_socket_ms": median(run["first_socket_ms"] for run in sockets),
+        "ready_ms": median(run["ready_ms"] for run in sockets),
+        "heaviest_imports_ms": imports[-1]["heaviest_ms"],
+    }
+    print(json.dumps(report, indent=2))
+    failed = False
+    for name, limit in (("import_ms", args.max_import_ms), ("first_socket_ms", args.max_first_socket_ms)):
+        if limit is not None and (report[name] is None or report[name] > limit):
+            print(f"Regression: {name} {report[name]} exceeds {limit}")
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure app cold start")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="Number of heaviest top-level packages to list")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--max-import-ms", type=float, default=None)
+    parser.add_argument("--max-first-socket-ms", type=float, default=None)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,111 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+class AsyncTTLCache:
+    # Size-bounded LRU cache with a per-entry TTL, concurrent misses for the same key share a single load
+    max_size: int
+    ttl: float
+
+    hits: int
+    misses: int
+    coalesced: int
+    evictions: int
+    loads: int
+    load_seconds_total: float
+    load_seconds_max: float
+
+    def __init__(self, max_size: int = 256, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        # Bumped by invalidate(), a load that started before an invalidation doesn't store its result
+        self._generation = 0
+        self._key_generations: dict[Hashable, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.loads = 0
+        self.load_seconds_total = 0.0
+        self.load_seconds_max = 0.0
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+
+        self.misses += 1
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            # Shield so one cancelled waiter doesn't cancel the load for everyone else
+            return await asyncio.shield(inflight)
+
+        future = asyncio.ensure_future(self._load(key, loader, self._generation_of(key)))
+        self._inflight[key] = future
+        future.add_done_callback(lambda done: self._forget_load(key, done))
+        return await asyncio.shield(future)
+
+    def _generation_of(self, key: Hashable) -> tuple[int, int]:
+        return self._generation, self._key_generations.get(key, 0)
+
+    def _forget_load(self, key: Hashable, future: asyncio.Future):
+        # An invalidation may already have replaced it with a newer load
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], generation: tuple[int, int]) -> Any:
+        start = time.perf_counter()
+        try:
+            value = await loader()
+        finally:
+            elapsed = time.perf_counter() - start
+            self.loads += 1
+            self.load_seconds_total += elapsed
+            self.load_seconds_max = max(self.load_seconds_max, elapsed)
+        # Failed lookups come back as None, don't pin them for a whole TTL. Neither results read before an
+        # invalidation, they may be the very data that was invalidated
+        if value is not None and generation == self._generation_of(key):
+            self._put(key, value)
+        return value
+
+    def _put(self, key: Hashable, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        # Callers arriving after this start a fresh load rather than joining one that may return stale data
+        if key is None:
+            self._generation += 1
+            self._key_generations.clear()
+            self._entries.clear()
+            self._inflight.clear()
+        else:
+            self._key_generations[key] = self._key_generations.get(key, 0) + 1
+            self._entries.pop(key, None)
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "loads": self.loads,
+            "load_seconds_total": self.load_seconds_total,
+            "load_seconds_max": self.load_seconds_max,
+        }
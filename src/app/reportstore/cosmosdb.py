@@ -1,80 +1,225 @@
 import os
+import asyncio
+import hmac
 import logging
 import json
+import time
+import uuid
 from logging import INFO
 from typing import Any
-from azure.cosmos import CosmosClient, PartitionKey
-from azure.identity import DefaultAzureCredential
+from aiohttp import web
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient, ContainerProxy, DatabaseProxy
+from azure.identity.aio import DefaultAzureCredential
 import azure.cosmos.exceptions as exceptions
 from typing import List, Optional, Union, TYPE_CHECKING
+from backend import metrics
 from backend.rtmt import RTMiddleTier, Tool, ToolResult, ToolResultDirection
+from backend.tools import ReportSchemaRegistry
+from reportstore.cache import AsyncTTLCache
+from reportstore.reportwriter import ReportWriter
+
+# The document itself was refused (malformed, too large), seeding it again won't help
+_REJECTED_DOCUMENT_STATUSES = frozenset({ 400, 409, 413 })
 
 class CosmosDBStore:
     db_host: str
     db_name: str
     container_name: str
-    cosmos_client: CosmosClient
+    cosmos_client: Optional[CosmosClient] = None
+    db: Optional[DatabaseProxy] = None
+    container: Optional[ContainerProxy] = None
+    # Generated reports live in their own container, partitioned by report id since they're written
+    # once and read back individually
+    reports_container_name: str
+    reports_container: Optional[ContainerProxy] = None
+    report_writer: ReportWriter
+    # Department templates compiled into generate_report schemas, shared by all sessions
+    schema_registry: ReportSchemaRegistry
+    # Upper bound of concurrent upserts when seeding the department templates
+    seed_concurrency: int = 8
+    # Department templates rarely change, keep them in memory instead of querying on every tool call
+    schema_cache: AsyncTTLCache
+    schema_cache_size: int = 128
+    schema_cache_ttl: float = 600
+    # Bearer token for the /admin/schema-cache endpoints, they aren't served without one
+    admin_token: Optional[str] = None
+    # Department -> document ids, lets lookups use point reads within the department partition
+    department_index: dict[str, list[str]]
+    # Initialization runs in the background after startup, tool calls wait this long for it to finish
+    ready_timeout: float = 20
+    init_retry_delay: float = 5
+    _credential: Optional[DefaultAzureCredential] = None
+    _init_task: Optional[asyncio.Task] = None
     logging.basicConfig(level=logging.INFO)
 
     def load_from_file(self, file_path: str):
         with open(file_path, "r") as file:
             return json.load(file)
 
-    def insert_departments(self, container_name: str, departments: List[any]):
+    async def insert_departments(self, departments: List[any]) -> int:
+        # Returns how many departments failed for reasons that may go away (throttling, RBAC still
+        # propagating, service errors), those are worth seeding again
         self.logger.info("Inserting departments into database")
-        try:
-            container = self.db.get_container_client(container_name)
-            for department in departments:
-                container.create_item( department )
-        except exceptions.CosmosResourceExistsError as e:
-            print("Item already exists.")
-            logging.debug(e)
-        except exceptions.CosmosHttpResponseError as e:
-            print("Request to the Azure Cosmos database service failed.")
-            logging.error(e)
+        semaphore = asyncio.Semaphore(self.seed_concurrency)
+        transient = 0
 
-    def create_container(self, container_name: str):
+        async def upsert(department):
+            nonlocal transient
+            async with semaphore:
+                try:
+                    with metrics.COSMOS_LATENCY.time(("upsert_item",)):
+                        await self.container.upsert_item(department)
+                    self._index_department(department)
+                except exceptions.CosmosHttpResponseError as e:
+                    # Keep seeding the remaining departments, one bad document shouldn't block startup
+                    self.logger.error("Upserting department %s failed: %s", department.get("department"), e)
+                    if e.status_code not in _REJECTED_DOCUMENT_STATUSES:
+                        transient += 1
+
+        await asyncio.gather(*(upsert(department) for department in departments))
+        return transient
+
+    async def create_container(self, container_name: str):
         self.logger.info("Creating container in database")
         templates_path = os.path.join(os.path.dirname(__file__), 'templates.json')
         templates = self.load_from_file(templates_path)
-        try:
-            container = self.db.get_container_client(container_name)
-            self.db.create_container(id=container_name, partition_key=PartitionKey(path="/department"))
-            print(f"Container created or returned: {container.id}")
-            self.insert_departments(container_name, templates)
-        except exceptions.CosmosResourceExistsError as e:
-            print("Container already exists.")
-            logging.debug(e)
-            self.insert_departments(container_name, templates)
-        except exceptions.CosmosHttpResponseError as e:
-            print("Request to the Azure Cosmos database service failed.")
-            logging.error(e)
+        # Failures propagate, _initialize retries until the templates are in place
+        self.container = await self.db.create_container_if_not_exists(id=container_name, partition_key=PartitionKey(path="/department"))
+        self.logger.info(f"Container created or returned: {self.container.id}")
+        failed = await self.insert_departments(templates)
+        # Seeding may have changed the templates, drop anything looked up before
+        self.schema_cache.invalidate()
+        if failed > 0:
+            raise RuntimeError(f"Seeding {failed} of {len(templates)} templates failed")
 
-    def __init__(self, db_host: str, db_name:str, container_name: str):
+    def __init__(self, db_host: str, db_name:str, container_name: str, reports_container_name: str = "reports",
+                 spill_path: str = "reports-spill.jsonl"):
         self.logger = logging.getLogger("cosmosdb")
         self.logger.info("Initializing CosmosDBStore")
         self.db_host = db_host
         self.db_name = db_name
         self.container_name = container_name
-        self.cosmos_client = CosmosClient(db_host, DefaultAzureCredential())
-        self.db = self.cosmos_client.get_database_client(db_name)
-        self.create_container(container_name)
+        self.schema_cache = AsyncTTLCache(self.schema_cache_size, self.schema_cache_ttl)
+        self.department_index = {}
+        self.reports_container_name = reports_container_name
+        self.report_writer = ReportWriter(spill_path)
+        self.schema_registry = ReportSchemaRegistry()
+        self._ready = asyncio.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    async def wait_ready(self):
+        try:
+            await asyncio.wait_for(self._ready.wait(), self.ready_timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError("The report store is still starting up") from None
+
+    async def _initialize(self):
+        # One client for the lifetime of the app, its connection pool is shared by all tool calls
+        self._credential = DefaultAzureCredential()
+        self.cosmos_client = CosmosClient(self.db_host, self._credential)
+        self.db = self.cosmos_client.get_database_client(self.db_name)
+        self.container = self.db.get_container_client(self.container_name)
+        await self._seed_templates()
+        self._ready.set()
+        self.logger.info("Cosmos DB store ready")
+        await self._start_report_writer()
+
+    async def _seed_templates(self):
+        while True:
+            try:
+                await self.create_container(self.container_name)
+                return
+            except Exception as e:
+                # Network or credential trouble, keep trying rather than serving without templates
+                self.logger.warning("Initializing Cosmos DB failed, retrying: %s", e)
+                await asyncio.sleep(self.init_retry_delay)
+
+    async def _start_report_writer(self):
+        # Templates are served meanwhile, reports queue up and spill to disk once the queue is full. The
+        # writer replays the spill file when it starts
+        while True:
+            try:
+                self.reports_container = await self.db.create_container_if_not_exists(id=self.reports_container_name, partition_key=PartitionKey(path="/id"))
+                break
+            except Exception as e:
+                self.logger.warning("Creating the reports container failed, retrying: %s", e)
+                await asyncio.sleep(self.init_retry_delay)
+        await self.report_writer.start(self.reports_container)
 
-    
-    async def get_schema_from_database(self, department: str): 
+    async def _on_startup(self, app: web.Application):
+        # Container creation and seeding take seconds, don't hold back accepting sockets for them
+        self._init_task = asyncio.create_task(self._initialize())
+
+    async def _on_cleanup(self, app: web.Application):
+        if self._init_task is not None:
+            self._init_task.cancel()
+            await asyncio.gather(self._init_task, return_exceptions=True)
+        await self.report_writer.close()
+        if self.cosmos_client is not None:
+            await self.cosmos_client.close()
+            await self._credential.close()
+            self.cosmos_client = None
+
+    def _authorized(self, request: web.Request) -> bool:
+        return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {self.admin_token}")
+
+    async def _schema_cache_handler(self, request: web.Request):
+        if not self._authorized(request):
+            raise web.HTTPUnauthorized()
+        return web.json_response(self.schema_cache.stats())
+
+    async def _schema_cache_invalidate_handler(self, request: web.Request):
+        if not self._authorized(request):
+            raise web.HTTPUnauthorized()
+        department = request.query.get("department")
+        self.schema_cache.invalidate(self._normalize_department(department) if department else None)
+        return web.json_response({ "invalidated": department or "all" })
+
+    def attach_to_app(self, app: web.Application):
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        if self.admin_token:
+            app.router.add_get("/admin/schema-cache", self._schema_cache_handler)
+            app.router.add_post("/admin/schema-cache/invalidate", self._schema_cache_invalidate_handler)
+
+    @staticmethod
+    def _normalize_department(department: str) -> str:
+        return department.strip().lower()
+
+    def _index_department(self, item: Any):
+        ids = self.department_index.setdefault(self._normalize_department(item["department"]), [])
+        if item["id"] not in ids:
+            ids.append(item["id"])
+
+    async def get_schema_from_database(self, department: str):
         self.logger.info("Getting schema from database")
         try:
-            container = self.db.get_container_client(self.container_name)
-        
+            ids = self.department_index.get(department)
+            if ids:
+                try:
+                    with metrics.COSMOS_LATENCY.time(("read_item",)):
+                        return list(await asyncio.gather(
+                            *(self.container.read_item(item=id, partition_key=department) for id in ids)))
+                except exceptions.CosmosResourceNotFoundError:
+                    # Template was removed behind our back, rebuild the entry from the partition
+                    self.department_index.pop(department, None)
+
+            # Not seeded by us, scope the query to the department's partition instead of fanning out
             query = "SELECT * FROM c WHERE c.department = @department"
             parameters = [{"name": "@department", "value": department}]
-            response = container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True)
-            
+            response = self.container.query_items(query=query, parameters=parameters, partition_key=department)
+
             fields = []
 
-            for item in response:
-                print(json.dumps(item, indent=True))
-                fields.append(item)
+            with metrics.COSMOS_LATENCY.time(("query_items",)):
+                async for item in response:
+                    self.logger.debug(json.dumps(item, indent=True))
+                    self._index_department(item)
+                    fields.append(item)
 
             return fields
         except exceptions.CosmosHttpResponseError as e:
@@ -83,21 +228,42 @@ class CosmosDBStore:
 
 
     async def write_report(self, args: Any) -> ToolResult:
-        report = {
-            "customer_name": args["customer_name"],
-            "demo_product": args["demo_product"],
-            "demo_date": args["demo_date"],
-            "meeting_feedback": args["meeting_feedback"]
-        }
+        # Fields depend on the department template, the arguments were validated against it already
+        report = dict(args)
+        # Persisted in the background, the conversation doesn't wait for the database
+        self.report_writer.submit({ "id": str(uuid.uuid4()), "created_at": time.time(), **report })
         # Return the result to the client
         return ToolResult(report, ToolResultDirection.TO_CLIENT)
 
+    async def _load_report_fields(self, department: str):
+        department = self._normalize_department(department)
+        await self.wait_ready()
+        return await self.schema_cache.get(department, lambda: self.get_schema_from_database(department))
+
+    async def prefetch_report_fields(self, name: str, value: Any):
+        # Starts the schema lookup as soon as the model has spelled out the department, get_report_fields
+        # then joins the load in flight or finds it cached
+        if name == "department" and isinstance(value, str):
+            fields = await self._load_report_fields(value)
+            if fields:
+                self.schema_registry.get(fields[0])
+
     async def get_report_fields(self, args: Any) -> ToolResult:
-        department = args["department"].lower()
-        
-        fields = await self.get_schema_from_database(department)
+        fields = await self._load_report_fields(args["department"])
 
         print(fields)
 
-        return ToolResult(fields, ToolResultDirection.TO_SERVER)
-            
+        session_tools = None
+        if fields:
+            # Swap the generic generate_report for one that asks for exactly this department's fields
+            compiled = self.schema_registry.get(fields[0])
+            session_tools = {
+                "generate_report": Tool(
+                    target=self.write_report,
+                    schema=compiled.schema,
+                    validator=compiled.validate,
+                    stream_arguments=True)
+            }
+
+        return ToolResult(fields, ToolResultDirection.TO_SERVER, session_tools)
+
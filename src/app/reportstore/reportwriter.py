@@ -0,0 +1,131 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Optional
+from azure.cosmos.aio import ContainerProxy
+import azure.cosmos.exceptions as exceptions
+
+from backend import metrics
+
+class ReportWriter:
+    # Write-behind pipeline for reports: tool calls enqueue and return, a background task upserts in
+    # batches and spills to an append-only JSON lines file whenever Cosmos can't take the write
+    spill_path: str
+    batch_size: int
+    batch_interval: float
+    max_retries: int
+
+    def __init__(self, spill_path: str, queue_size: int = 1000, batch_size: int = 25, batch_interval: float = 0.5, max_retries: int = 5):
+        self.logger = logging.getLogger("reportwriter")
+        self.spill_path = spill_path
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_retries = max_retries
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._container: Optional[ContainerProxy] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._spill_lock = asyncio.Lock()
+        self._spill_tasks: set[asyncio.Task] = set()
+
+    def submit(self, report: dict[str, Any]):
+        try:
+            self._queue.put_nowait(report)
+        except asyncio.QueueFull:
+            # Never make the conversation wait, overflow goes straight to disk
+            task = asyncio.create_task(self._spill([report]))
+            self._spill_tasks.add(task)
+            task.add_done_callback(self._spill_tasks.discard)
+
+    async def start(self, container: ContainerProxy):
+        self._container = container
+        await self._replay_spill()
+        self._worker = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+        await asyncio.gather(*self._spill_tasks, return_exceptions=True)
+        # Whatever is still queued survives the restart on disk
+        pending = []
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        if pending:
+            await self._spill(pending)
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # Give concurrent calls a moment to add to the batch
+            deadline = asyncio.get_running_loop().time() + self.batch_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._write_batch(batch)
+            except asyncio.CancelledError:
+                await self._spill(batch)
+                raise
+
+    async def _write_batch(self, batch: list[dict[str, Any]]):
+        failed = []
+        for start in range(0, len(batch), self.batch_size):
+            chunk = batch[start:start + self.batch_size]
+            results = await asyncio.gather(*(self._upsert(report) for report in chunk), return_exceptions=True)
+            failed.extend(report for report, result in zip(chunk, results) if result is not None)
+        if failed:
+            await self._spill(failed)
+
+    async def _upsert(self, report: dict[str, Any]) -> Optional[Exception]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.COSMOS_LATENCY.time(("upsert_report",)):
+                    await self._container.upsert_item(report)
+                return None
+            except exceptions.CosmosHttpResponseError as e:
+                if e.status_code != 429 or attempt == self.max_retries:
+                    self.logger.error("Persisting report %s failed: %s", report.get("id"), e)
+                    return e
+                # Throttled, wait as long as Cosmos asks us to
+                retry_after_ms = (e.headers or {}).get("x-ms-retry-after-ms")
+                await asyncio.sleep(float(retry_after_ms) / 1000 if retry_after_ms else 2 ** attempt * 0.1)
+        return None
+
+    async def _spill(self, reports: list[dict[str, Any]]):
+        lines = "".join(json.dumps(report) + "\n" for report in reports)
+        async with self._spill_lock:
+            await asyncio.to_thread(self._append, lines)
+        self.logger.warning("Spilled %d reports to %s", len(reports), self.spill_path)
+
+    def _append(self, lines: str):
+        with open(self.spill_path, "a", encoding="utf-8") as file:
+            file.write(lines)
+            file.flush()
+            os.fsync(file.fileno())
+
+    async def _replay_spill(self):
+        # Reports spilled by an earlier run get another chance once the store is reachable again
+        replay_path = self.spill_path + ".replay"
+        async with self._spill_lock:
+            # A leftover replay file means the last replay didn't finish, do that one first
+            if os.path.exists(self.spill_path) and not os.path.exists(replay_path):
+                os.replace(self.spill_path, replay_path)
+        try:
+            with open(replay_path, "r", encoding="utf-8") as file:
+                reports = [json.loads(line) for line in file if line.strip()]
+        except FileNotFoundError:
+            return
+        self.logger.info("Replaying %d spilled reports", len(reports))
+        # Upserts are idempotent, so another worker replaying the same file at the same time is harmless
+        await self._write_batch(reports)
+        try:
+            os.remove(replay_path)
+        except FileNotFoundError:
+            pass
@@ -14,6 +14,9 @@ let audioQueueTime = 0;
 let speaking = false;
 const VAD_THRESHOLD = 0.01; // Adjust this threshold as needed
 
+// Opt into raw PCM16 binary frames for audio (append ?audio=binary to the page URL)
+const BINARY_AUDIO = new URLSearchParams(window.location.search).get('audio') === 'binary';
+
 async function startRecording() {
     isRecording = true;
     toggleButton.textContent = 'Stop Conversation';
@@ -26,12 +29,14 @@ async function startRecording() {
     }
 
     // Open WebSocket connection
+    const realtimePath = BINARY_AUDIO ? '/realtime?audio=binary' : '/realtime';
     if (window.location.protocol != "https:") {
-        websocket = new WebSocket(`ws://${window.location.host}/realtime`);
+        websocket = new WebSocket(`ws://${window.location.host}${realtimePath}`);
     }else
     {
-        websocket = new WebSocket(`wss://${window.location.host}/realtime`);
-    }    
+        websocket = new WebSocket(`wss://${window.location.host}${realtimePath}`);
+    }
+    websocket.binaryType = 'arraybuffer';
 
     websocket.onopen = () => {
         console.log('WebSocket connection opened');
@@ -57,6 +62,11 @@ async function startRecording() {
     };
 
     websocket.onmessage = (event) => {
+        if (event.data instanceof ArrayBuffer) {
+            // Binary frames are always assistant audio
+            playPcm16(new Int16Array(event.data));
+            return;
+        }
         const message = JSON.parse(event.data);
         console.log('Received message:', message);
         handleWebSocketMessage(message);
@@ -85,14 +95,19 @@ async function startRecording() {
         const inputData = e.inputBuffer.getChannelData(0);
         // Convert Float32Array to Int16Array
         const int16Data = float32ToInt16(inputData);
-        // Convert to Base64
-        const base64Audio = int16ToBase64(int16Data);
-        // Send audio data to server
-        const audioCommand = {
-            type: 'input_audio_buffer.append',
-            audio: base64Audio
-        };
-        websocket.send(JSON.stringify(audioCommand));
+        if (BINARY_AUDIO) {
+            // Send the raw samples, the middle tier wraps them for the realtime API
+            websocket.send(int16Data.buffer);
+        } else {
+            // Convert to Base64
+            const base64Audio = int16ToBase64(int16Data);
+            // Send audio data to server
+            const audioCommand = {
+                type: 'input_audio_buffer.append',
+                audio: base64Audio
+            };
+            websocket.send(JSON.stringify(audioCommand));
+        }
 
         // Optional: Client-side VAD for immediate interruption handling
         const isUserSpeaking = detectSpeech(inputData);
@@ -208,8 +223,10 @@ function playAudio(base64Audio) {
     for (let i = 0; i < len; i++) {
         bytes[i] = binary.charCodeAt(i);
     }
-    const int16Array = new Int16Array(bytes.buffer);
+    playPcm16(new Int16Array(bytes.buffer));
+}
 
+function playPcm16(int16Array) {
     // Convert Int16Array to Float32Array
     const float32Array = int16ToFloat32(int16Array);
 
@@ -0,0 +1,69 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from azure.core.credentials import AzureKeyCredential
+
+from backend.rtmt import RTMiddleTier
+
+# Shared by the tests that run a middle tier against a realtime API stand-in
+
+Respond = Callable[[dict, int], list[dict]]
+
+class ScriptedUpstream:
+    # Realtime API stand-in: every message received is recorded per connection and passed to respond, along
+    # with the connection's index, which returns the frames to answer with
+    received: list[list[dict]]
+
+    def __init__(self, respond: Respond):
+        self.respond = respond
+        self.received = []
+
+    async def handler(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        connection = len(self.received)
+        received = []
+        self.received.append(received)
+        await ws.send_json({ "type": "session.created", "session": { "id": f"sess_{connection}" } })
+        async for msg in ws:
+            message = json.loads(msg.data)
+            received.append(message)
+            for frame in self.respond(message, connection):
+                await ws.send_json(frame)
+        return ws
+
+def function_call_response(response_id: str, calls: list[dict]) -> list[dict]:
+    # Frames of a response that calls the given tools, each call a dict of id, call_id, name and arguments
+    frames = [{ "type": "response.created", "response": { "id": response_id } }]
+    items = [{ "type": "function_call", **call } for call in calls]
+    for item in items:
+        frames.append({ "type": "conversation.item.created", "previous_item_id": None, "item": { **item, "arguments": "" } })
+        frames.append({ "type": "response.function_call_arguments.delta", "call_id": item["call_id"], "delta": item["arguments"] })
+        frames.append({ "type": "response.output_item.done", "item": item })
+    frames.append({ "type": "response.done", "response": { "id": response_id, "output": items } })
+    return frames
+
+@asynccontextmanager
+async def middle_tier(upstream: ScriptedUpstream) -> AsyncIterator[tuple[RTMiddleTier, TestClient]]:
+    # Yields the middle tier, to add tools and settings to before connecting, and a client for its /realtime
+    upstream_app = web.Application()
+    upstream_app.router.add_get("/openai/realtime", upstream.handler)
+    async with TestServer(upstream_app) as upstream_server:
+        rtmt = RTMiddleTier(str(upstream_server.make_url("/")), "stand-in", AzureKeyCredential("stand-in"))
+        app = web.Application()
+        rtmt.attach_to_app(app, "/realtime")
+        async with TestClient(TestServer(app)) as client:
+            yield rtmt, client
+
+def of_type(messages: list[dict], message_type: str) -> list[dict]:
+    return [message for message in messages if message["type"] == message_type]
+
+async def wait_until(condition: Callable[[], bool], timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("Timed out waiting for the stand-in")
+        await asyncio.sleep(0.005)
@@ -0,0 +1,53 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from acs.caller import OutboundCall
+
+# Callback batches of a dozen calls as ACS posts them to /acs: connect, participants and media streaming
+# updates, and a hangup for most of them
+_BURST = json.loads((Path(__file__).parent / "data" / "acs_callback_burst.json").read_text())
+
+class _SlowCallConnection:
+    async def get_call_properties(self):
+        await asyncio.sleep(0.2)
+
+class _SlowClient:
+    def get_call_connection(self, call_connection_id: str):
+        return _SlowCallConnection()
+
+    async def close(self):
+        pass
+
+def test_recorded_callback_burst_is_acknowledged_before_handlers_finish():
+    async def run():
+        caller = OutboundCall("endpoint=https://localhost/;accesskey=a2V5", "+15550100", "localhost")
+        caller.call_automation_client = _SlowClient()
+        for call in _BURST["calls"]:
+            await caller.call_store.set(call, { "target_number": "+15550101", "state": "created" })
+        app = web.Application()
+        caller.attach_to_app(app, "/acs")
+        latencies = []
+        async with TestClient(TestServer(app)) as client:
+            async def post(events):
+                started = time.perf_counter()
+                response = await client.post("/acs", json=events)
+                latencies.append(time.perf_counter() - started)
+                assert response.status == 200
+            # Back to back in recorded order, far denser than ACS sends them
+            for batch in _BURST["batches"]:
+                await post(batch["events"])
+            await asyncio.gather(*caller.events._tasks)
+            states = { call: await caller.call_store.get(call) for call in _BURST["calls"] }
+        return sorted(latencies), states
+    latencies, states = asyncio.run(run())
+    assert len(latencies) == len(_BURST["batches"])
+    # Acknowledgements must not wait for the handlers, a get_call_properties round trip takes 200 ms here
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    assert p99 < 0.2, f"p99 acknowledgement latency {p99 * 1000:.1f} ms"
+    ended = _BURST["calls"][:8]
+    assert all(states[call] is None for call in ended)
+    assert all(states[call]["state"] == "streaming" for call in _BURST["calls"][8:])
@@ -0,0 +1,34 @@
+import base64
+import json
+import numpy as np
+import pytest
+
+from backend.acsmedia import AcsMediaAdapter, Resampler
+
+def _sine(rate: int, seconds: float = 1.0) -> np.ndarray:
+    t = np.arange(int(rate * seconds)) / rate
+    return (np.sin(2 * np.pi * 300 * t) * 8000).astype("<i2")
+
+@pytest.mark.parametrize("src_rate, dst_rate", [(24000, 16000), (16000, 24000), (8000, 24000), (24000, 8000)])
+def test_chunked_resampling_matches_resampling_at_once(src_rate, dst_rate):
+    signal = _sine(src_rate)
+    whole = np.frombuffer(Resampler(src_rate, dst_rate).process(signal.tobytes()), dtype="<i2")
+    resampler = Resampler(src_rate, dst_rate)
+    chunk = src_rate // 50
+    chunked = np.frombuffer(b"".join(resampler.process(signal[i:i + chunk].tobytes())
+                                     for i in range(0, len(signal), chunk)), dtype="<i2")
+    assert abs(len(whole) - len(chunked)) <= 1
+    length = min(len(whole), len(chunked))
+    assert np.abs(whole[:length].astype(int) - chunked[:length].astype(int)).max() <= 1
+
+def test_adapter_keeps_resampler_state_between_messages():
+    adapter = AcsMediaAdapter(16000)
+    signal = _sine(16000, 0.2)
+    chunk = 320
+    out = []
+    for i in range(0, len(signal), chunk):
+        message = json.dumps({ "kind": "AudioData", "audioData": { "data": base64.b64encode(signal[i:i + chunk].tobytes()).decode("ascii") } })
+        out.append(base64.b64decode(json.loads(adapter.to_realtime(message))["audio"]))
+    resampled = np.frombuffer(b"".join(out), dtype="<i2").astype(int)
+    # A 300 Hz sine at 24 kHz changes by at most ~630 per sample, boundary clicks would show as larger jumps
+    assert np.abs(np.diff(resampled)).max() < 700
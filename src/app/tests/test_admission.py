@@ -0,0 +1,50 @@
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from azure.core.credentials import AzureKeyCredential
+
+from backend.admission import AdmissionController, client_key
+from backend.rtmt import RTMiddleTier
+
+def _controller(**limits) -> AdmissionController:
+    return AdmissionController("test", **{ "max_concurrent": 10, "max_concurrent_per_user": 1, "rate": 1000, "burst": 1000,
+                                           "rate_per_user": 1000, "burst_per_user": 1, **limits })
+
+def test_new_user_survives_eviction_of_idle_users():
+    async def run():
+        controller = _controller()
+        controller.max_tracked_users = 2
+        for key in ["a", "b"]:
+            (await controller.acquire(key)).release()
+        await asyncio.sleep(0.01)
+        # Every tracked user is idle with a full bucket, including the one just added
+        lease = await controller.acquire("c")
+        lease.release()
+        return list(controller._users)
+    assert asyncio.run(run()) == ["c"]
+
+def test_client_key_uses_the_address_the_ingress_appended():
+    request = make_mocked_request("GET", "/realtime", headers={ "X-Forwarded-For": "198.51.100.7, 203.0.113.9" })
+    assert client_key(request) == "203.0.113.9"
+
+def _rtmt(tokens: dict) -> RTMiddleTier:
+    rtmt = RTMiddleTier("https://localhost", "stand-in", AzureKeyCredential("stand-in"))
+    rtmt.admission = _controller(max_concurrent_per_user=0)
+    async def lookup(token):
+        return tokens.get(token)
+    rtmt.acs_media_lookup = lookup
+    async def serve(request, acs_media):
+        return web.json_response(acs_media)
+    rtmt._serve_session = serve
+    return rtmt
+
+def test_acs_media_socket_needs_a_known_token():
+    async def run():
+        rtmt = _rtmt({ "secret": { "sample_rate": 16000 } })
+        statuses = []
+        for query in ["transport=acs", "transport=acs&token=guess", "transport=acs&token=secret", ""]:
+            response = await rtmt._websocket_handler(make_mocked_request("GET", "/realtime?" + query))
+            statuses.append(response.status)
+        return statuses
+    # The per-user limit of 0 turns away everyone but the placed call's media socket
+    assert asyncio.run(run()) == [403, 403, 200, 429]
@@ -0,0 +1,23 @@
+import os
+import pytest
+from aiohttp.test_utils import make_mocked_request
+from azure.core.credentials import AzureKeyCredential
+
+from backend.rtmt import RTMiddleTier
+
+def _archive_directory(tmp_path, request_id: str) -> str:
+    rtmt = RTMiddleTier("https://localhost", "stand-in", AzureKeyCredential("stand-in"))
+    rtmt.archive_dir = str(tmp_path)
+    request = make_mocked_request("GET", "/realtime", headers={ "x-ms-client-request-id": request_id })
+    return rtmt._create_archive(request).directory
+
+def test_client_request_id_names_the_archive(tmp_path):
+    directory = _archive_directory(tmp_path, "3f2b7c1e-9a4d-4e0b-8c6f-1d2e3a4b5c6d")
+    assert os.path.dirname(directory) == str(tmp_path)
+    assert directory.endswith("-3f2b7c1e-9a4d-4e0b-8c6f-1d2e3a4b5c6d")
+
+@pytest.mark.parametrize("request_id", ["../../etc/cron.d/x", "/tmp/x", "a/b", "..", "a" * 65])
+def test_unsafe_client_request_id_is_replaced(tmp_path, request_id):
+    directory = _archive_directory(tmp_path, request_id)
+    assert os.path.dirname(directory) == str(tmp_path)
+    assert request_id not in directory
@@ -0,0 +1,84 @@
+import asyncio
+import json
+import pytest
+from azure.core.credentials import AzureKeyCredential
+
+from backend.argstream import ArgumentStream
+from backend.rtmt import RTMiddleTier, RTSession, RTToolCall, Tool
+
+def _feed(pieces: list[str]) -> tuple[ArgumentStream, list[str]]:
+    stream = ArgumentStream()
+    completed = []
+    for piece in pieces:
+        completed += stream.feed(piece)
+    return stream, completed
+
+def _splits(text: str):
+    # Every way of cutting the text in two, plus one character per delta
+    for i in range(len(text) + 1):
+        yield [text[:i], text[i:]]
+    yield list(text)
+
+_ESCAPED = r'{"note": "line\nbreak \"quoted\" \\ tab\t \u00e9 é \ud83d\ude00 😀 end", "count": 2}'
+_NESTED = r'{"a": {"b": "}]\"{[", "c": [1, {"d": "]"}, []]}, "e": ["{", "}"], "f": "x"}'
+
+@pytest.mark.parametrize("text", [_ESCAPED, _NESTED])
+def test_values_survive_any_split(text):
+    for pieces in _splits(text):
+        stream, completed = _feed(pieces)
+        assert stream.values == json.loads(text)
+        assert completed == list(json.loads(text))
+        assert stream.done
+
+@pytest.mark.parametrize("text", ['{"a": 1}', '{"a": true}', '{"a": null}', '{"a":-1.5e3}', '{"s": "x","a": false}'])
+def test_scalar_at_the_end_completes_on_the_closing_brace(text):
+    stream = ArgumentStream()
+    assert "a" not in stream.feed(text[:-1])
+    assert stream.feed(text[-1]) == ["a"]
+    assert stream.values == json.loads(text)
+
+@pytest.mark.parametrize("text", ['[1]', '{"a" 1}', '{"a": 1 "b": 2}', '{"a": 1,}', '{"a": tru}', '{1: 2}'])
+def test_malformed_arguments_raise_value_error(text):
+    with pytest.raises(ValueError):
+        _feed(list(text))
+
+def test_snapshot_shows_the_open_string_so_far():
+    stream = ArgumentStream()
+    stream.feed(r'{"done": 1, "text": "Hello \u00e')
+    # An escape cut short by the delta is left out until the rest of it arrives
+    assert stream.snapshot() == { "done": 1, "text": "Hello " }
+    stream.feed(r'9 \ud83d')
+    # So is the first half of a surrogate pair
+    assert stream.snapshot() == { "done": 1, "text": "Hello é " }
+    stream.feed(r'\ude00 \\')
+    assert stream.snapshot() == { "done": 1, "text": "Hello é \U0001f600 \\" }
+    stream.feed('"}')
+    assert stream.snapshot() == { "done": 1, "text": "Hello é \U0001f600 \\" }
+
+def test_partial_results_are_throttled_to_the_stream_interval(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("backend.rtmt.time.perf_counter", lambda: now[0])
+
+    async def run():
+        rtmt = RTMiddleTier("https://localhost", "stand-in", AzureKeyCredential("stand-in"))
+        rtmt.tool_stream_interval = 0.1
+        rtmt.tools["report"] = Tool(target=None, schema={ "type": "function", "name": "report" }, stream_arguments=True)
+        rt_session = RTSession(None)
+        tool_call = RTToolCall("call_1", "item_0", "report")
+        tool_call.arguments = ArgumentStream()
+        sent = []
+        for at, delta in [(100.0, '{"feedback": "Good'), (100.05, " meet"), (100.08, "ing"), (100.2, " today"),
+                          (100.21, '", "score": 4'), (100.22, "}")]:
+            now[0] = at
+            await rtmt._on_arguments_delta(tool_call, delta, rt_session)
+            while len(rt_session.client_queue) > 0:
+                message = json.loads((await rt_session.client_queue.get())[0])
+                sent.append((at, json.loads(message["tool_result"])))
+        return sent
+    # Text within the interval of the last update waits, completed values always go out
+    assert asyncio.run(run()) == [
+        (100.0, { "feedback": "Good" }),
+        (100.2, { "feedback": "Good meeting today" }),
+        (100.21, { "feedback": "Good meeting today" }),
+        (100.22, { "feedback": "Good meeting today", "score": 4 }),
+    ]
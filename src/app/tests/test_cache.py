@@ -0,0 +1,83 @@
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from reportstore.cache import AsyncTTLCache
+from reportstore.cosmosdb import CosmosDBStore
+
+def test_concurrent_misses_share_one_load():
+    async def run():
+        cache = AsyncTTLCache()
+        loads = 0
+
+        async def loader():
+            nonlocal loads
+            loads += 1
+            await asyncio.sleep(0.01)
+            return "value"
+        values = await asyncio.gather(*(cache.get("key", loader) for _ in range(10)))
+        return cache, loads, values
+    cache, loads, values = asyncio.run(run())
+    assert loads == 1
+    assert values == ["value"] * 10
+    assert cache.coalesced == 9
+
+def test_load_in_flight_during_invalidation_is_not_cached():
+    async def run():
+        cache = AsyncTTLCache()
+        release = asyncio.Event()
+        versions = iter(["stale", "fresh"])
+
+        async def loader():
+            value = next(versions)
+            if value == "stale":
+                await release.wait()
+            return value
+        stale = asyncio.create_task(cache.get("key", loader))
+        await asyncio.sleep(0)
+        cache.invalidate("key")
+        # Doesn't join the load that started before the invalidation
+        fresh = await cache.get("key", loader)
+        release.set()
+        await stale
+        return stale.result(), fresh, await cache.get("key", loader)
+    assert asyncio.run(run()) == ("stale", "fresh", "fresh")
+
+def test_invalidating_everything_discards_loads_in_flight():
+    async def run():
+        cache = AsyncTTLCache()
+
+        async def loader():
+            await asyncio.sleep(0.01)
+            return "stale"
+        stale = asyncio.create_task(cache.get("key", loader))
+        await asyncio.sleep(0)
+        cache.invalidate()
+        await stale
+        return cache.stats()["size"]
+    assert asyncio.run(run()) == 0
+
+def _admin_client(token) -> TestClient:
+    store = CosmosDBStore("https://localhost", "db", "templates")
+    store.admin_token = token
+    app = web.Application()
+    store.attach_to_app(app)
+    # Startup would connect to Cosmos DB, only the routes are under test
+    app.on_startup.clear()
+    app.on_cleanup.clear()
+    return TestClient(TestServer(app))
+
+def test_admin_endpoints_require_the_token():
+    async def run():
+        async with _admin_client("secret") as client:
+            anonymous = await client.post("/admin/schema-cache/invalidate")
+            wrong = await client.post("/admin/schema-cache/invalidate", headers={ "Authorization": "Bearer nope" })
+            allowed = await client.post("/admin/schema-cache/invalidate", headers={ "Authorization": "Bearer secret" })
+            return anonymous.status, wrong.status, allowed.status
+    assert asyncio.run(run()) == (401, 401, 200)
+
+def test_admin_endpoints_are_off_without_a_token():
+    async def run():
+        async with _admin_client(None) as client:
+            return (await client.post("/admin/schema-cache/invalidate")).status
+    assert asyncio.run(run()) == 404
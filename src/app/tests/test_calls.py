@@ -0,0 +1,126 @@
+import asyncio
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from azure.core.messaging import CloudEvent
+
+from acs.caller import OutboundCall
+from acs.campaign import CallCampaign
+from backend.admission import AdmissionController
+
+def _caller() -> OutboundCall:
+    return OutboundCall("endpoint=https://localhost/;accesskey=a2V5", "+15550100", "localhost")
+
+@pytest.mark.parametrize("value", [24000, "16000"])
+def test_supported_sample_rates_are_accepted(value):
+    assert OutboundCall.parse_sample_rate(value) == int(value)
+
+@pytest.mark.parametrize("value", [8000, 44100, "fast", None, [24000]])
+def test_unsupported_sample_rates_are_rejected(value):
+    with pytest.raises(ValueError):
+        OutboundCall.parse_sample_rate(value)
+
+def test_campaign_with_unsupported_sample_rate_is_a_bad_request():
+    async def run():
+        app = web.Application()
+        CallCampaign(_caller()).attach_to_app(app, "/calls")
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post("/calls", json={ "target_numbers": ["+15550101"], "sample_rate": 8000 })
+            return response.status, await response.json()
+    status, body = asyncio.run(run())
+    assert status == 400
+    assert "sample_rate" in body["error"]
+
+def test_campaign_status_is_served_by_any_worker_sharing_the_call_store():
+    async def run():
+        caller = _caller()
+        placed = asyncio.Event()
+        async def place_call(target_number: str, sample_rate: int) -> str:
+            placed.set()
+            return "connection-" + target_number
+        caller.place_call = place_call
+        # A second worker, it only shares the call store with the one dialing
+        other = OutboundCall("endpoint=https://localhost/;accesskey=a2V5", "+15550100", "localhost", caller.call_store)
+        dialing, reporting = web.Application(), web.Application()
+        CallCampaign(caller).attach_to_app(dialing, "/calls")
+        CallCampaign(other).attach_to_app(reporting, "/calls")
+        async with TestClient(TestServer(dialing)) as first, TestClient(TestServer(reporting)) as second:
+            response = await first.post("/calls", json={ "target_numbers": ["+15550101"] })
+            campaign_id = (await response.json())["campaign_id"]
+            await asyncio.wait_for(placed.wait(), 5)
+            await asyncio.sleep(0.01)
+            response = await second.get(f"/calls/{campaign_id}")
+            return response.status, await response.json()
+    status, body = asyncio.run(run())
+    assert status == 200
+    assert body["calls"] == [{ "target_number": "+15550101", "state": "placed", "attempts": 1, "connection_id": "connection-+15550101" }]
+
+def test_campaign_batch_size_is_capped():
+    async def run():
+        app = web.Application()
+        campaign = CallCampaign(_caller())
+        campaign.attach_to_app(app, "/calls")
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post("/calls", json={ "target_numbers": ["+15550101"] * (campaign.max_batch_size + 1) })
+            return response.status
+    assert asyncio.run(run()) == 400
+
+def test_media_token_is_forgotten_when_the_call_ends():
+    async def run():
+        caller = _caller()
+        await caller.call_store.set(caller.media_token_prefix + "secret", { "sample_rate": 16000 })
+        await caller.call_store.set("call-1", { "state": "connected", "media_token": "secret" })
+        before = await caller.lookup_media_token("secret")
+        await caller._on_call_disconnected(CloudEvent.from_dict({
+            "id": "1", "source": "calling/callConnections/call-1", "type": "Microsoft.Communication.CallDisconnected",
+            "specversion": "1.0", "data": { "callConnectionId": "call-1" } }))
+        return before, await caller.lookup_media_token("secret"), await caller.call_store.get("call-1")
+    assert asyncio.run(run()) == ({ "sample_rate": 16000 }, None, None)
+
+def _call_admission(downstream: AdmissionController) -> AdmissionController:
+    return AdmissionController("call", max_concurrent=10, max_concurrent_per_user=2, rate=100, burst=100,
+                               rate_per_user=0.01, burst_per_user=1, queue_timeout=0, downstream=downstream)
+
+def test_campaign_submission_counts_against_the_user_limits():
+    async def run():
+        realtime = AdmissionController("realtime", max_concurrent=10, max_concurrent_per_user=10, rate=100, burst=100,
+                                       rate_per_user=100, burst_per_user=100)
+        caller = _caller()
+        async def place_call(target_number: str, sample_rate: int) -> str:
+            return "connection"
+        caller.place_call = place_call
+        app = web.Application()
+        CallCampaign(caller, admission=_call_admission(realtime)).attach_to_app(app, "/calls")
+        async with TestClient(TestServer(app)) as client:
+            statuses = []
+            for _ in range(2):
+                response = await client.post("/calls", json={ "target_numbers": ["+15550101"] })
+                statuses.append(response.status)
+            return statuses
+    assert asyncio.run(run()) == [202, 429]
+
+def test_campaign_waits_while_realtime_sessions_are_full():
+    async def run():
+        realtime = AdmissionController("realtime", max_concurrent=1, max_concurrent_per_user=1, rate=100, burst=100,
+                                       rate_per_user=100, burst_per_user=100)
+        session = await realtime.acquire("someone")
+        caller = _caller()
+        placed = []
+        async def place_call(target_number: str, sample_rate: int) -> str:
+            placed.append(target_number)
+            return "connection"
+        caller.place_call = place_call
+        campaign = CallCampaign(caller, admission=_call_admission(realtime))
+        campaign.capacity_poll_interval = 0.01
+        campaign_id = await campaign.submit(["+15550101"])
+        await asyncio.sleep(0.1)
+        waiting = dict((await caller.call_store.get(campaign.key_prefix + campaign_id))["calls"][0])
+        before = list(placed)
+        session.release()
+        await asyncio.wait_for(asyncio.gather(*campaign._tasks), 1)
+        done = (await caller.call_store.get(campaign.key_prefix + campaign_id))["calls"][0]
+        return waiting, before, done
+    waiting, before, done = asyncio.run(run())
+    assert waiting == { "target_number": "+15550101", "state": "waiting_for_capacity", "attempts": 0 }
+    assert before == []
+    assert done["state"] == "placed" and done["attempts"] == 1
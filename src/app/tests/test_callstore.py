@@ -0,0 +1,61 @@
+import asyncio
+import time
+from typing import Optional
+
+from acs.callstore import InMemoryCallStore, RedisCallStore, create_call_store
+
+class _FakeRedis:
+    # The part of redis.asyncio.Redis the store uses, values come back as bytes like from a server
+    def __init__(self):
+        self.values: dict[str, tuple[bytes, float]] = {}
+        self.closed = False
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self.values.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    async def set(self, key: str, value: str, ex: int):
+        self.values[key] = (value.encode("utf-8"), time.monotonic() + ex)
+
+    async def delete(self, key: str):
+        self.values.pop(key, None)
+
+    async def aclose(self):
+        self.closed = True
+
+def _stores(server: _FakeRedis, count: int) -> list[RedisCallStore]:
+    stores = [RedisCallStore("redis://localhost:6379/0", ttl=60) for _ in range(count)]
+    for store in stores:
+        store._redis = server
+    return stores
+
+def test_create_call_store_picks_redis_when_configured():
+    assert isinstance(create_call_store("redis://localhost:6379/0"), RedisCallStore)
+    assert isinstance(create_call_store(None), InMemoryCallStore)
+
+def test_call_state_is_shared_between_workers():
+    async def run():
+        server = _FakeRedis()
+        first, second = _stores(server, 2)
+        await first.set("call-1", { "state": "created", "sample_rate": 16000 })
+        seen = await second.get("call-1")
+        await second.delete("call-1")
+        return server, seen, await first.get("call-1")
+    server, seen, after_delete = asyncio.run(run())
+    assert seen == { "state": "created", "sample_rate": 16000 }
+    assert after_delete is None
+    assert server.values == {}
+
+def test_calls_are_stored_under_the_prefix_with_the_ttl():
+    async def run():
+        server = _FakeRedis()
+        store, = _stores(server, 1)
+        await store.set("call-1", { "state": "created" })
+        await store.close()
+        return server
+    server = asyncio.run(run())
+    assert list(server.values) == ["acs:call:call-1"]
+    assert 55 < server.values["acs:call:call-1"][1] - time.monotonic() <= 60
+    assert server.closed
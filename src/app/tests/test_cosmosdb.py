@@ -0,0 +1,146 @@
+import asyncio
+import json
+import os
+
+from perf.fakecosmos import FakeDatabase
+from reportstore.cosmosdb import CosmosDBStore
+from reportstore.reportwriter import ReportWriter
+
+def _store(tmp_path, latency: float = 0) -> CosmosDBStore:
+    store = CosmosDBStore("https://localhost", "db", "templates", spill_path=str(tmp_path / "spill.jsonl"))
+    store.db = FakeDatabase(latency)
+    return store
+
+def _department(index: int, department: str) -> dict:
+    return { "id": str(index), "department": department, "fields": [{ "name": "customer", "type": "string" }] }
+
+def test_seeding_upserts_every_template(tmp_path):
+    async def run():
+        store = _store(tmp_path)
+        await store.create_container("templates")
+        return store
+    store = asyncio.run(run())
+    with open(os.path.join(os.path.dirname(__file__), "..", "reportstore", "templates.json")) as file:
+        templates = json.load(file)
+    assert sorted(item["id"] for item in store.container.items()) == sorted(template["id"] for template in templates)
+    assert set(store.department_index) == { template["department"] for template in templates }
+
+def test_seeding_is_concurrent_and_bounded(tmp_path):
+    async def run():
+        store = _store(tmp_path, latency=0.01)
+        store.seed_concurrency = 3
+        store.container = await store.db.create_container_if_not_exists("templates", { "paths": ["/department"] })
+        await store.insert_departments([_department(i, f"department {i}") for i in range(12)])
+        return store
+    store = asyncio.run(run())
+    assert len(store.container.items()) == 12
+    assert 1 < store.container.max_in_flight <= 3
+
+def test_seeding_continues_past_a_failed_upsert(tmp_path):
+    async def run():
+        store = _store(tmp_path)
+        store.seed_concurrency = 1
+        store.container = await store.db.create_container_if_not_exists("templates", { "paths": ["/department"] })
+        store.container.failures = [None, 500]
+        await store.insert_departments([_department(i, f"department {i}") for i in range(4)])
+        return store
+    store = asyncio.run(run())
+    assert sorted(item["id"] for item in store.container.items()) == ["0", "2", "3"]
+    assert "department 1" not in store.department_index
+
+def test_seeded_departments_are_point_read_from_their_partition(tmp_path):
+    async def run():
+        store = _store(tmp_path)
+        await store.create_container("templates")
+        return store, await store.get_schema_from_database("sales")
+    store, fields = asyncio.run(run())
+    assert [field["department"] for field in fields] == ["sales"]
+    assert store.container.calls.get("read_item") == 1
+    assert "query_items" not in store.container.calls
+
+def test_unindexed_departments_are_queried_within_the_partition(tmp_path):
+    async def run():
+        store = _store(tmp_path)
+        store.container = await store.db.create_container_if_not_exists("templates", { "paths": ["/department"] })
+        # Written by someone else, so not in the index
+        await store.container.upsert_item(_department(7, "legal"))
+        first = await store.get_schema_from_database("legal")
+        second = await store.get_schema_from_database("legal")
+        return store, first, second
+    store, first, second = asyncio.run(run())
+    assert first == second == [_department(7, "legal")]
+    assert store.container.calls["query_items"] == 1
+    assert store.container.calls["read_item"] == 1
+
+def test_reports_are_spilled_and_replayed(tmp_path):
+    spill_path = str(tmp_path / "spill.jsonl")
+    reports = [{ "id": str(i), "customer": f"customer {i}" } for i in range(3)]
+
+    async def run():
+        database = FakeDatabase()
+        container = await database.create_container_if_not_exists("reports", { "paths": ["/id"] })
+        container.failures = [500] * len(reports)
+        writer = ReportWriter(spill_path, batch_interval=0.01)
+        await writer.start(container)
+        for report in reports:
+            writer.submit(report)
+        await asyncio.sleep(0.1)
+        await writer.close()
+        spilled = container.items()
+
+        replaying = ReportWriter(spill_path)
+        await replaying.start(container)
+        await replaying.close()
+        return spilled, container.items()
+    spilled, replayed = asyncio.run(run())
+    assert spilled == []
+    assert sorted(replayed, key=lambda report: report["id"]) == reports
+    assert not os.path.exists(spill_path)
+
+def test_throttled_report_writes_are_retried(tmp_path):
+    async def run():
+        database = FakeDatabase()
+        container = await database.create_container_if_not_exists("reports", { "paths": ["/id"] })
+        container.failures = [429, 429]
+        writer = ReportWriter(str(tmp_path / "spill.jsonl"), batch_interval=0.01)
+        await writer.start(container)
+        writer.submit({ "id": "1" })
+        await asyncio.sleep(0.1)
+        await writer.close()
+        return container
+    container = asyncio.run(run())
+    assert container.items() == [{ "id": "1" }]
+    assert container.calls["upsert_item"] == 3
+    assert not os.path.exists(tmp_path / "spill.jsonl")
+
+def test_report_writer_starts_once_the_reports_container_can_be_created(tmp_path):
+    async def run():
+        store = _store(tmp_path)
+        store.init_retry_delay = 0.01
+        store.db.failures = [503, 503]
+        store.report_writer.batch_interval = 0.01
+        store.report_writer.submit({ "id": "1" })
+        await store._start_report_writer()
+        await asyncio.sleep(0.1)
+        await store.report_writer.close()
+        return store
+    store = asyncio.run(run())
+    assert store.db.containers["reports"].items() == [{ "id": "1" }]
+    assert not os.path.exists(tmp_path / "spill.jsonl")
+
+def test_template_seeding_is_retried_until_it_succeeds(tmp_path):
+    async def run():
+        store = _store(tmp_path)
+        store.init_retry_delay = 0.01
+        container = await store.db.create_container_if_not_exists("templates", { "paths": ["/department"] })
+        # RBAC still propagating on the first attempt, seeding throttled on the second
+        store.db.failures = [403, None, None]
+        container.failures = [429]
+        await store._seed_templates()
+        return store, container
+    store, container = asyncio.run(run())
+    with open(os.path.join(os.path.dirname(__file__), "..", "reportstore", "templates.json")) as file:
+        templates = json.load(file)
+    assert len(container.items()) == len(templates)
+    assert len(store.db.failures) == 0
+    assert set(store.department_index) == { template["department"] for template in templates }
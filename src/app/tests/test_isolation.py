@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+from backend.rtmt import Tool, ToolResult, ToolResultDirection
+from tests.realtime import ScriptedUpstream, function_call_response, middle_tier, of_type, wait_until
+
+_SESSIONS = 8
+
+def _schema(name: str) -> dict:
+    return { "type": "function", "name": name, "parameters": { "type": "object", "properties": {} } }
+
+def _session_of(message: dict) -> int:
+    return int(message["event_id"].removeprefix("client-"))
+
+def _respond(message: dict, connection: int) -> list[dict]:
+    # Each client names itself in the event_id of its commit, and gets tool calls carrying its own number
+    if message["type"] != "input_audio_buffer.commit":
+        return []
+    session = _session_of(message)
+    arguments = json.dumps({ "session": session })
+    return function_call_response(f"r{session}", [
+        { "id": f"item_lookup_{session}", "call_id": f"lookup_{session}", "name": "lookup", "arguments": arguments },
+        { "id": f"item_show_{session}", "call_id": f"show_{session}", "name": "show", "arguments": arguments },
+    ])
+
+def test_concurrent_sessions_only_see_their_own_tool_traffic():
+    upstream = ScriptedUpstream(_respond)
+
+    async def lookup(args):
+        # Slower for the first sessions, so their outputs are still pending while later sessions finish
+        await asyncio.sleep(0.01 * (_SESSIONS - args["session"]))
+        return ToolResult({ "looked_up": args["session"] }, ToolResultDirection.TO_SERVER)
+    async def show(args):
+        return ToolResult({ "shown": args["session"] }, ToolResultDirection.TO_CLIENT)
+
+    async def client(client_app, session: int) -> list[dict]:
+        received = []
+        async with client_app.ws_connect("/realtime") as ws:
+            await ws.send_str(json.dumps({ "type": "input_audio_buffer.commit", "event_id": f"client-{session}" }))
+            # Anything another session's tools would leak in arrives before every session has moved on
+            await wait_until(lambda: sum(len(of_type(messages, "response.create")) for messages in upstream.received) == _SESSIONS)
+            await asyncio.sleep(0.05)
+            while True:
+                try:
+                    msg = await ws.receive(timeout=0.01)
+                except asyncio.TimeoutError:
+                    break
+                received.append(json.loads(msg.data))
+        return received
+
+    async def run():
+        async with middle_tier(upstream) as (rtmt, client_app):
+            rtmt.tools["lookup"] = Tool(target=lookup, schema=_schema("lookup"))
+            rtmt.tools["show"] = Tool(target=show, schema=_schema("show"))
+            return await asyncio.gather(*(client(client_app, session) for session in range(_SESSIONS)))
+    clients = asyncio.run(run())
+
+    assert len(upstream.received) == _SESSIONS
+    for messages in upstream.received:
+        session = _session_of(of_type(messages, "input_audio_buffer.commit")[0])
+        outputs = { message["item"]["call_id"]: message["item"]["output"] for message in of_type(messages, "conversation.item.create") }
+        assert outputs == { f"lookup_{session}": json.dumps({ "looked_up": session }), f"show_{session}": "" }
+        assert len(of_type(messages, "response.create")) == 1
+    for session, messages in enumerate(clients):
+        tool_responses = of_type(messages, "extension.middle_tier_tool_response")
+        assert [(message["tool_name"], json.loads(message["tool_result"])) for message in tool_responses] == [("show", { "shown": session })]
@@ -0,0 +1,74 @@
+import asyncio
+import json
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from azure.core.credentials import AzureKeyCredential
+
+from backend.rtmt import RTMiddleTier, Tool, ToolResult, ToolResultDirection
+
+_SESSION_CREATED = json.dumps({ "type": "session.created", "session": { "id": "sess_1" } })
+_CALL = { "id": "f1", "type": "function_call", "call_id": "c1", "name": "lookup" }
+
+class _DroppingUpstream:
+    # Realtime API stand-in that drops the first two connections: the first after a completed tool call,
+    # the second once it has echoed the replayed items. Records what each connection received
+    def __init__(self):
+        self.received: list[list[dict]] = []
+
+    async def handler(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        connection = len(self.received)
+        received = []
+        self.received.append(received)
+        await ws.send_str(_SESSION_CREATED)
+        async for msg in ws:
+            message = json.loads(msg.data)
+            received.append(message)
+            if connection == 0 and message["type"] == "session.update" and len(received) == 1:
+                await ws.send_json({ "type": "response.created", "response": { "id": "r1" } })
+                await ws.send_json({ "type": "conversation.item.created", "previous_item_id": None, "item": { **_CALL, "arguments": "" } })
+                await ws.send_json({ "type": "response.output_item.done", "item": { **_CALL, "arguments": '{"q": "x"}' } })
+                await ws.send_json({ "type": "response.done", "response": { "id": "r1", "output": [{ **_CALL, "arguments": '{"q": "x"}' }] } })
+            elif message["type"] == "conversation.item.create":
+                item = { "id": "o1", **message["item"] } if connection == 0 else message["item"]
+                await ws.send_json({ "type": "conversation.item.created", "item": item })
+            if connection == 0 and message["type"] == "response.create":
+                break
+            if connection == 1 and sum(m["type"] == "conversation.item.create" for m in received) == 2:
+                await asyncio.sleep(0.05)
+                break
+        await ws.close()
+        return ws
+
+def _replayed_items(messages: list[dict]) -> list[dict]:
+    return [message["item"] for message in messages if message["type"] == "conversation.item.create"]
+
+def test_tool_call_survives_two_upstream_drops():
+    async def run():
+        upstream = _DroppingUpstream()
+        upstream_app = web.Application()
+        upstream_app.router.add_get("/openai/realtime", upstream.handler)
+        async with TestServer(upstream_app) as upstream_server:
+            rtmt = RTMiddleTier(str(upstream_server.make_url("/")), "stand-in", AzureKeyCredential("stand-in"))
+            rtmt.reconnect_backoff = 0.01
+            async def lookup(args):
+                return ToolResult({ "answer": 42 }, ToolResultDirection.TO_SERVER)
+            rtmt.tools["lookup"] = Tool(target=lookup, schema={ "type": "function", "name": "lookup", "parameters": {} })
+            app = web.Application()
+            rtmt.attach_to_app(app, "/realtime")
+            async with TestClient(TestServer(app)) as client:
+                async with client.ws_connect("/realtime") as ws:
+                    await ws.send_str(json.dumps({ "type": "session.update", "session": { "voice": "alloy" } }))
+                    for _ in range(200):
+                        if len(upstream.received) == 3 and len(_replayed_items(upstream.received[2])) >= 2:
+                            break
+                        await asyncio.sleep(0.01)
+        return upstream.received
+    received = asyncio.run(run())
+    assert len(received) == 3
+    for replay in received[1:]:
+        items = _replayed_items(replay)
+        assert [item["id"] for item in items] == ["f1", "o1"]
+        assert items[0]["arguments"] == '{"q": "x"}'
+        assert items[1]["call_id"] == "c1"
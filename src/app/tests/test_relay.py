@@ -0,0 +1,30 @@
+import asyncio
+
+from backend.relay import RelayQueue
+
+def test_slow_consumer_keeps_queue_bounded_and_drops_oldest_audio():
+    async def run():
+        queue = RelayQueue("to_client", high_water=8)
+        for i in range(100):
+            await queue.put(f"audio {i}", float(i), droppable=True)
+            assert len(queue) <= 8
+        # Control frames still get through, the audio that made room for them is the oldest
+        await queue.put("response.done", 100.0)
+        received = [(await queue.get())[0] for _ in range(len(queue))]
+        assert received == [f"audio {i}" for i in range(93, 100)] + ["response.done"]
+        assert queue.dropped == 93
+    asyncio.run(run())
+
+def test_control_frames_wait_for_the_consumer_instead_of_dropping():
+    async def run():
+        queue = RelayQueue("to_server", high_water=2)
+        await queue.put("a", 0.0)
+        await queue.put("b", 0.0)
+        blocked = asyncio.create_task(queue.put("c", 0.0))
+        await asyncio.sleep(0.01)
+        assert not blocked.done() and len(queue) == 2
+        assert (await queue.get())[0] == "a"
+        await asyncio.wait_for(blocked, 1)
+        assert [(await queue.get())[0] for _ in range(2)] == ["b", "c"]
+        assert queue.dropped == 0
+    asyncio.run(run())
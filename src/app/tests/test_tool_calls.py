@@ -0,0 +1,83 @@
+import asyncio
+import json
+
+from backend.rtmt import Tool, ToolResult, ToolResultDirection
+from tests.realtime import ScriptedUpstream, function_call_response, middle_tier, of_type, wait_until
+
+_SESSION_UPDATE = json.dumps({ "type": "session.update", "session": { "voice": "alloy" } })
+
+def _schema(name: str) -> dict:
+    return { "type": "function", "name": name, "parameters": { "type": "object", "properties": {} } }
+
+def _calling(*calls: tuple[str, str]) -> ScriptedUpstream:
+    # Answers the client's session.update with one response calling the given (call_id, name) tools
+    def respond(message: dict, connection: int) -> list[dict]:
+        if message["type"] == "session.update" and message["session"].get("voice") == "alloy":
+            return function_call_response("r1", [{ "id": f"item_{call_id}", "call_id": call_id, "name": name, "arguments": "{}" }
+                                                 for call_id, name in calls])
+        return []
+    return ScriptedUpstream(respond)
+
+def _outputs(messages: list[dict]) -> dict[str, str]:
+    return { message["item"]["call_id"]: message["item"]["output"] for message in of_type(messages, "conversation.item.create") }
+
+def _run(upstream: ScriptedUpstream, tools: dict[str, Tool], until) -> list[dict]:
+    async def run():
+        async with middle_tier(upstream) as (rtmt, client):
+            rtmt.tools.update(tools)
+            async with client.ws_connect("/realtime") as ws:
+                await ws.send_str(_SESSION_UPDATE)
+                await wait_until(lambda: len(upstream.received) > 0 and until(upstream.received[0]))
+        return upstream.received[0]
+    return asyncio.run(run())
+
+def _has_response_create(messages: list[dict]) -> bool:
+    return len(of_type(messages, "response.create")) > 0
+
+def test_unknown_tool_gets_an_error_output_before_the_next_response():
+    received = _run(_calling(("c1", "no_such_tool")), {}, _has_response_create)
+    assert "Unknown tool 'no_such_tool'" in json.loads(_outputs(received)["c1"])["error"]
+    assert received[-1]["type"] == "response.create"
+
+def test_timed_out_tool_reports_the_timeout():
+    async def slow(args):
+        await asyncio.sleep(5)
+    received = _run(_calling(("c1", "slow")), { "slow": Tool(target=slow, schema=_schema("slow"), timeout=0.05) }, _has_response_create)
+    assert json.loads(_outputs(received)["c1"]) == { "error": "Tool 'slow' timed out" }
+
+def test_response_is_created_only_after_every_output():
+    async def fast(args):
+        return ToolResult({ "fast": True }, ToolResultDirection.TO_SERVER)
+    async def slow(args):
+        await asyncio.sleep(0.1)
+        return ToolResult({ "slow": True }, ToolResultDirection.TO_SERVER)
+    tools = { "fast": Tool(target=fast, schema=_schema("fast")), "slow": Tool(target=slow, schema=_schema("slow")) }
+    received = _run(_calling(("c1", "slow"), ("c2", "fast")), tools, _has_response_create)
+    types = [message["type"] for message in received]
+    assert _outputs(received) == { "c1": '{"slow": true}', "c2": '{"fast": true}' }
+    assert types.count("response.create") == 1
+    assert types.index("response.create") > max(i for i, t in enumerate(types) if t == "conversation.item.create")
+
+def test_tools_are_cancelled_when_the_client_leaves():
+    started, cancelled = asyncio.Event(), asyncio.Event()
+    async def slow(args):
+        started.set()
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+    upstream = _calling(("c1", "slow"))
+
+    async def run():
+        async with middle_tier(upstream) as (rtmt, client):
+            rtmt.tools["slow"] = Tool(target=slow, schema=_schema("slow"))
+            async with client.ws_connect("/realtime") as ws:
+                await ws.send_str(_SESSION_UPDATE)
+                await asyncio.wait_for(started.wait(), 2)
+            await asyncio.wait_for(cancelled.wait(), 2)
+            await asyncio.sleep(0.05)
+        return upstream.received[0]
+    received = asyncio.run(run())
+    assert _outputs(received) == {}
+    assert not _has_response_create(received)
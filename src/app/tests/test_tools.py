@@ -0,0 +1,108 @@
+import asyncio
+import copy
+import hashlib
+import json
+import pytest
+
+from backend.rtmt import Tool, ToolResult, ToolResultDirection
+from backend.tools import ReportSchemaRegistry, compile_report_tool_schema
+from tests.realtime import ScriptedUpstream, function_call_response, middle_tier, of_type, wait_until
+
+_TEMPLATE = {
+    "id": "368814",
+    "department": "sales",
+    "fields": [
+        { "id": "1", "name": "customer", "type": "string", "description": "Name of the customer" },
+        { "id": "2", "name": "demo_date", "type": "date", "description": "Date of the demo" },
+        { "id": "3", "name": "attendees", "type": "integer" },
+        { "id": "4", "name": "budget", "type": "number" },
+        { "id": "5", "name": "follow_up", "type": "boolean" },
+        { "id": "6", "name": "notes", "type": "free text" },
+    ]
+}
+
+_VALID = { "customer": "Contoso", "demo_date": "2024-11-05", "attendees": 3, "budget": 12.5, "follow_up": False, "notes": "" }
+
+def test_schema_asks_for_every_template_field():
+    parameters = compile_report_tool_schema(_TEMPLATE).schema["parameters"]
+    assert parameters["required"] == ["customer", "demo_date", "attendees", "budget", "follow_up", "notes"]
+    assert parameters["additionalProperties"] is False
+    assert parameters["properties"]["demo_date"] == { "type": "string", "description": "Date of the demo (YYYY-MM-DD)" }
+    assert parameters["properties"]["attendees"] == { "type": "integer", "description": "attendees" }
+    # Unknown field types are treated as strings
+    assert parameters["properties"]["notes"]["type"] == "string"
+
+def test_valid_arguments_pass():
+    assert compile_report_tool_schema(_TEMPLATE).validate(_VALID) == []
+
+@pytest.mark.parametrize("field, value, error", [
+    ("demo_date", "05/11/2024", "'demo_date' must be a date formatted as YYYY-MM-DD"),
+    ("demo_date", "next Tuesday", "'demo_date' must be a date formatted as YYYY-MM-DD"),
+    ("attendees", True, "'attendees' must be an integer"),
+    ("attendees", 2.5, "'attendees' must be an integer"),
+    ("budget", False, "'budget' must be a number"),
+    ("budget", "12.5", "'budget' must be a number"),
+    ("follow_up", 0, "'follow_up' must be true or false"),
+    ("customer", None, "'customer' must be a string"),
+])
+def test_wrongly_typed_argument_is_reported(field, value, error):
+    assert compile_report_tool_schema(_TEMPLATE).validate({ **_VALID, field: value }) == [error]
+
+def test_missing_and_unknown_fields_are_reported():
+    args = { key: value for key, value in _VALID.items() if key != "budget" }
+    args["rating"] = 5
+    assert compile_report_tool_schema(_TEMPLATE).validate(args) == ["'budget' must be a number", "Unknown field 'rating'"]
+    assert compile_report_tool_schema(_TEMPLATE).validate([_VALID]) == ["Arguments must be a JSON object"]
+
+def test_registry_only_recompiles_changed_templates(monkeypatch):
+    fingerprints = []
+    sha1 = hashlib.sha1
+    monkeypatch.setattr("backend.tools.hashlib.sha1", lambda data: fingerprints.append(data) or sha1(data))
+    registry = ReportSchemaRegistry()
+    compiled = registry.get(_TEMPLATE)
+    # The same template object again, as handed out by the schema cache, isn't even fingerprinted
+    assert registry.get(_TEMPLATE) is compiled
+    assert len(fingerprints) == 1
+    # Reloaded from the database without changes
+    reloaded = copy.deepcopy(_TEMPLATE)
+    assert registry.get(reloaded) is compiled
+    assert registry.get(reloaded) is compiled
+    assert len(fingerprints) == 2
+    # A field was added
+    changed = copy.deepcopy(_TEMPLATE)
+    changed["fields"].append({ "id": "7", "name": "competitor", "type": "string" })
+    recompiled = registry.get(changed)
+    assert recompiled is not compiled
+    assert "competitor" in recompiled.schema["parameters"]["properties"]
+    # Other templates are kept apart
+    other = { **copy.deepcopy(_TEMPLATE), "id": "368815", "department": "support" }
+    assert registry.get(other) is not recompiled
+    assert registry.get(changed) is recompiled
+
+def test_session_tools_reach_the_model_before_the_tool_output():
+    compiled = compile_report_tool_schema(_TEMPLATE)
+    async def get_questions(args):
+        report_tool = Tool(target=None, schema=compiled.schema, validator=compiled.validate)
+        return ToolResult(_TEMPLATE["fields"], ToolResultDirection.TO_SERVER, { "generate_report": report_tool })
+
+    def respond(message: dict, connection: int) -> list[dict]:
+        if message["type"] == "input_audio_buffer.commit":
+            return function_call_response("r1", [{ "id": "item_1", "call_id": "c1", "name": "get_questions", "arguments": "{}" }])
+        return []
+    upstream = ScriptedUpstream(respond)
+
+    async def run():
+        async with middle_tier(upstream) as (rtmt, client):
+            rtmt.tools["get_questions"] = Tool(target=get_questions, schema={ "type": "function", "name": "get_questions" })
+            async with client.ws_connect("/realtime") as ws:
+                await ws.send_str(json.dumps({ "type": "input_audio_buffer.commit" }))
+                await wait_until(lambda: len(upstream.received) > 0 and len(of_type(upstream.received[0], "response.create")) > 0)
+        return upstream.received[0]
+    received = asyncio.run(run())
+
+    types = [message["type"] for message in received]
+    updates = [index for index, message in enumerate(received)
+               if message["type"] == "session.update" and compiled.schema in message["session"]["tools"]]
+    assert len(updates) == 1
+    assert [tool["name"] for tool in received[updates[0]]["session"]["tools"]] == ["get_questions", "generate_report"]
+    assert updates[0] < types.index("conversation.item.create") < types.index("response.create")
@@ -0,0 +1,109 @@
+import aiohttp
+import asyncio
+import pytest
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from azure.core.credentials import AzureKeyCredential
+
+from backend.rtmt import RTMiddleTier
+from backend.upstream import Upstream
+from tests.realtime import ScriptedUpstream, middle_tier
+
+def _rtmt(endpoint: str) -> RTMiddleTier:
+    rtmt = RTMiddleTier(endpoint, "stand-in", AzureKeyCredential("stand-in"))
+    # The circuit was open and has just expired, the next connect is the trial
+    rtmt.upstreams.upstreams[0].open_until = time.monotonic() - 1
+    rtmt.upstreams.upstreams[0].open_for = 15
+    return rtmt
+
+def _session() -> SimpleNamespace:
+    return SimpleNamespace(client_request_id=None, upstream=None)
+
+def test_trial_connect_without_credentials_frees_the_upstream():
+    async def run():
+        rtmt = _rtmt("https://localhost")
+        async def no_token(upstream):
+            raise RuntimeError("No token")
+        rtmt._get_auth_headers = no_token
+        with pytest.raises(RuntimeError):
+            await rtmt._connect_upstream(_session())
+        return rtmt.upstreams
+    pool = asyncio.run(run())
+    assert not pool.upstreams[0].half_open
+    assert pool.select(set()) is pool.upstreams[0]
+
+def test_cancelled_trial_connect_frees_the_upstream():
+    async def run():
+        rtmt = _rtmt("https://localhost")
+        async def hang(upstream):
+            await asyncio.Event().wait()
+        rtmt._get_auth_headers = hang
+        task = asyncio.create_task(rtmt._connect_upstream(_session()))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return rtmt.upstreams
+    pool = asyncio.run(run())
+    assert not pool.upstreams[0].half_open
+    assert pool.select(set()) is pool.upstreams[0]
+
+def test_rejected_trial_connect_reopens_the_circuit():
+    async def run():
+        async def unauthorized(request):
+            return web.Response(status=401)
+        app = web.Application()
+        app.router.add_get("/openai/realtime", unauthorized)
+        async with TestServer(app) as server:
+            rtmt = _rtmt(str(server.make_url("/")))
+            with pytest.raises(aiohttp.WSServerHandshakeError):
+                await rtmt._connect_upstream(_session())
+            await rtmt._client_session.close()
+        return rtmt.upstreams
+    pool = asyncio.run(run())
+    upstream = pool.upstreams[0]
+    assert not upstream.half_open
+    assert upstream.open_until > time.monotonic() and upstream.open_for == 30
+
+def test_missing_endpoint_is_a_configuration_error():
+    with pytest.raises(ValueError, match="No endpoint configured for realtime deployment 'stand-in'"):
+        RTMiddleTier(None, "stand-in", AzureKeyCredential("stand-in"))
+
+class _Span:
+    def __init__(self, attributes: dict):
+        self.attributes = dict(attributes)
+
+    def set_attribute(self, name: str, value):
+        self.attributes[name] = value
+
+class _Tracer:
+    def __init__(self):
+        self.spans = []
+
+    @contextmanager
+    def start_as_current_span(self, name: str, attributes: dict):
+        span = _Span(attributes)
+        self.spans.append((name, span))
+        yield span
+
+def test_session_span_names_the_upstream_it_connected_to(monkeypatch):
+    tracer = _Tracer()
+    monkeypatch.setattr("backend.metrics._tracer", tracer)
+    upstream = ScriptedUpstream(lambda message, connection: [])
+
+    async def run():
+        async with middle_tier(upstream) as (rtmt, client):
+            primary = rtmt.upstreams.upstreams[0]
+            # The primary deployment is out, the session fails over to the second one
+            rtmt.upstreams.add(Upstream(primary.endpoint, "second", "stand-in"))
+            primary.open_until = time.monotonic() + 60
+            async with client.ws_connect("/realtime") as ws:
+                await ws.receive_json(timeout=2)
+            return rtmt.upstreams.upstreams[1].name
+    name = asyncio.run(run())
+    sessions = [span for span_name, span in tracer.spans if span_name == "realtime.session"]
+    assert len(sessions) == 1
+    assert sessions[0].attributes["deployment"] == "second"
+    assert sessions[0].attributes["upstream"] == name
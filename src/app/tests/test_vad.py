@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from backend.vad import SilenceSuppressor
+
+_RATE = 24000
+_CHUNK = _RATE // 50
+
+def _noise(dbfs: float, seconds: float, seed: int = 1) -> np.ndarray:
+    return np.random.default_rng(seed).normal(0, 32768 * 10 ** (dbfs / 20), int(_RATE * seconds))
+
+def _chunks(signal: np.ndarray) -> list[bytes]:
+    pcm = np.clip(signal, -32768, 32767).astype("<i2")
+    return [pcm[i:i + _CHUNK].tobytes() for i in range(0, len(pcm) - _CHUNK + 1, _CHUNK)]
+
+@pytest.mark.parametrize("dbfs", [-38, -30])
+def test_steady_noise_is_suppressed(dbfs):
+    vad = SilenceSuppressor(_RATE)
+    sent = [vad.process(chunk) is not None for chunk in _chunks(_noise(dbfs, 10))]
+    # Only the start goes out, before the noise floor is known and while the hangover runs
+    assert not any(sent[len(sent) // 5:])
+    assert vad.bytes_suppressed > 0.75 * vad.bytes_in
+
+def test_speech_over_steady_noise_is_sent():
+    vad = SilenceSuppressor(_RATE)
+    for chunk in _chunks(_noise(-30, 3)):
+        vad.process(chunk)
+    # Voiced syllables 20 dB above the noise
+    t = np.arange(_RATE * 2) / _RATE
+    voiced = sum(np.sin(2 * np.pi * 150 * harmonic * t) / harmonic for harmonic in range(1, 6))
+    syllables = (t % 0.5 < 0.3) * voiced / np.abs(voiced).max() * 32768 * 10 ** (-12 / 20)
+    chunks = _chunks(_noise(-30, 2, seed=2) + syllables)
+    assert all(vad.is_speech(chunk) for chunk, on in zip(chunks, (t[::_CHUNK] % 0.5) < 0.3) if on)